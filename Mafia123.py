@@ -8,15 +8,28 @@ Render serveriga moslashtirilgan versiya
 """
 
 import os
+import sys
+import asyncio
+import atexit
+import functools
+import heapq
+import itertools
 import json
 import random
 import logging
+import signal
+import sqlite3
+import tempfile
 import threading
 import time
-from collections import Counter
-from typing import Dict, Any, List, Optional
+import weakref
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Iterator
 
-from telebot import TeleBot, types
+import requests
+from requests.adapters import HTTPAdapter
+from telebot import TeleBot, apihelper, types
 
 # ============================ KONFIGURATSIYA ============================
 TOKEN = os.getenv("MAFIA_BOT_TOKEN", "8216533427:AAEkuTATPEXPJPlfrhQ6n3NAINt5Mwpzu5c")
@@ -25,9 +38,92 @@ BOT_USERNAME = os.getenv("MAFIA_BOT_USERNAME", "mafiaganneBot")
 
 DATA_DIR = "data"
 PROFILES_FILE = os.path.join(DATA_DIR, "profiles.json")
-GAMES_FILE = os.path.join(DATA_DIR, "games.json")
-HISTORY_FILE = os.path.join(DATA_DIR, "history.json")
+GAMES_FILE = os.path.join(DATA_DIR, "games.json")  # eski yagona fayl, GAMES_DIR ga ko'chiriladi
+HISTORY_FILE = os.path.join(DATA_DIR, "history.json")  # eski yagona fayl, HISTORY_DIR ga ko'chiriladi
+HISTORY_DIR = os.path.join(DATA_DIR, "history")  # oylik segmentlar: YYYY-MM.jsonl + stats.json
 ADMINS_FILE = os.path.join(DATA_DIR, "admins.json")
+PROFILES_LOG = os.path.join(DATA_DIR, "profiles.log")
+GAMES_LOG = os.path.join(DATA_DIR, "games.log")
+GAMES_DIR = os.path.join(DATA_DIR, "games")  # har bir chat uchun alohida snapshot + jurnal
+SQLITE_FILE = os.path.join(DATA_DIR, "mafia.db")
+BROADCAST_FILE = os.path.join(DATA_DIR, "broadcast.json")  # ommaviy xabar checkpoint'i
+
+# "json" (standart) yoki "sqlite"
+STORAGE_BACKEND = os.getenv("MAFIA_STORAGE", "json").lower()
+
+# Diskka yozishlar orasidagi eng kam vaqt (ms). Crash paytida shuncha vaqtlik
+# o'zgarish yo'qolishi mumkin. 0 - har bir persist_* chaqiruvida sinxron yozish.
+PERSIST_INTERVAL_MS = int(os.getenv("MAFIA_PERSIST_INTERVAL_MS", "500"))
+
+# Log shu qadar yozuvdan oshsa (va ma'lumotlar sonidan ko'p bo'lsa) snapshot qayta yoziladi
+COMPACT_MIN_RECORDS = int(os.getenv("MAFIA_COMPACT_MIN_RECORDS", "1000"))
+# Bitta chat jurnalida shuncha qatordan keyin snapshot qayta yoziladi
+GAME_SHARD_COMPACT_RECORDS = int(os.getenv("MAFIA_GAME_SHARD_COMPACT_RECORDS", "100"))
+# Snapshotlar orasidagi eng ko'p vaqt (soniya). Qayta ishga tushganda faqat shu
+# oraliqdagi jurnal qayta o'qiladi.
+SNAPSHOT_INTERVAL = int(os.getenv("MAFIA_SNAPSHOT_INTERVAL", "300"))
+# Xotirada saqlanadigan oxirgi o'yinlar soni (qolgani faqat diskda)
+HISTORY_TAIL = int(os.getenv("MAFIA_HISTORY_TAIL", "200"))
+# Qayta ishga tushgandan keyin o'yin taymeriga beriladigan eng kam vaqt
+RESUME_GRACE = 10
+
+# Foydalanuvchi ismlari keshi (get_username_id): hajm, TTL va xato bo'lgan so'rovlar uchun TTL
+NAME_CACHE_SIZE = int(os.getenv("MAFIA_NAME_CACHE_SIZE", "5000"))
+NAME_CACHE_TTL = int(os.getenv("MAFIA_NAME_CACHE_TTL", "600"))
+NAME_CACHE_NEGATIVE_TTL = int(os.getenv("MAFIA_NAME_CACHE_NEGATIVE_TTL", "60"))
+
+# Taymer callback'larini bajaradigan oqimlar soni (o'yinlar soniga bog'liq emas)
+TIMER_WORKERS = int(os.getenv("MAFIA_TIMER_WORKERS", "4"))
+
+# Chiquvchi xabarlar navbatini bo'shatadigan oqimlar soni (0 - sinxron yuborish)
+OUTBOX_WORKERS = int(os.getenv("MAFIA_OUTBOX_WORKERS", "8"))
+
+# Telegram limitlari: umumiy xabar/s, guruhga xabar/daqiqa (va ketma-ket ruxsat), shaxsiy chatga xabar/s.
+# Shuncha soniyadan ko'p kutgan kosmetik xabarlar (ovoz e'lonlari, tozalash) yuborilmaydi.
+RATE_GLOBAL = float(os.getenv("MAFIA_RATE_GLOBAL", "30"))
+RATE_GROUP_PER_MIN = float(os.getenv("MAFIA_RATE_GROUP_PER_MIN", "20"))
+RATE_GROUP_BURST = float(os.getenv("MAFIA_RATE_GROUP_BURST", "5"))
+RATE_PRIVATE = float(os.getenv("MAFIA_RATE_PRIVATE", "1"))
+OUTBOX_COSMETIC_TTL = float(os.getenv("MAFIA_OUTBOX_COSMETIC_TTL", "15"))
+# deleteMessages bitta so'rovda o'chiradigan xabarlar soni (Telegram chegarasi 100)
+DELETE_BATCH_SIZE = 100
+
+# Xato bo'lgan so'rovlarni qayta yuborish: navbatdagi urinishlar soni, backoff (soniya),
+# navbatdan tashqari (safe_api) urinishlar soni va ular uchun eng uzoq kutish
+OUTBOX_MAX_RETRIES = int(os.getenv("MAFIA_OUTBOX_MAX_RETRIES", "5"))
+API_BACKOFF_BASE = float(os.getenv("MAFIA_API_BACKOFF_BASE", "0.5"))
+API_BACKOFF_MAX = float(os.getenv("MAFIA_API_BACKOFF_MAX", "30"))
+SAFE_API_RETRIES = int(os.getenv("MAFIA_SAFE_API_RETRIES", "1"))
+SAFE_API_MAX_WAIT = float(os.getenv("MAFIA_SAFE_API_MAX_WAIT", "3"))
+
+# Ommaviy xabar bo'lagi: shuncha foydalanuvchiga bir vaqtda navbatga qo'yiladi, bo'lak tugagach
+# checkpoint yoziladi (qayta ishga tushganda eng ko'pi bilan bitta bo'lak qayta yuboriladi)
+BROADCAST_CHUNK = int(os.getenv("MAFIA_BROADCAST_CHUNK", "200"))
+BROADCAST_PROGRESS_INTERVAL = 3  # admin'dagi jarayon xabarini yangilash oralig'i (soniya)
+BROADCAST_CHUNK_GRACE = 60  # bo'lak kutish vaqtiga qo'shimcha (qayta urinishlar uchun, soniya)
+
+# Ishlash rejimi: "threads" - oqimlar pool'i; "asyncio" - Telegram so'rovlari (AsyncTeleBot,
+# aiohttp kerak) va taymerlar bitta event loop'da, o'yin mantig'i o'sha chat mailbox'larida
+ENGINE = os.getenv("MAFIA_ENGINE", "threads").lower()
+
+# O'yin mailbox'larini (har bir chat hodisalari ketma-ket) bajaradigan oqimlar soni
+CHAT_WORKERS = int(os.getenv("MAFIA_CHAT_WORKERS", "8"))
+
+# Kiruvchi update'larni qayta ishlaydigan oqimlar va navbat chegaralari
+# (umumiy / bitta chat uchun). Navbat to'lsa webhook 503 qaytaradi va Telegram qayta yuboradi.
+UPDATE_WORKERS = int(os.getenv("MAFIA_UPDATE_WORKERS", "8"))
+UPDATE_QUEUE_LIMIT = int(os.getenv("MAFIA_UPDATE_QUEUE_LIMIT", "1000"))
+UPDATE_CHAT_QUEUE_LIMIT = int(os.getenv("MAFIA_UPDATE_CHAT_QUEUE_LIMIT", "100"))
+
+# Bot API ulanishlari: pool hajmi (0 - barcha oqimlar soniga qarab) va timeout'lar (soniya)
+HTTP_POOL_SIZE = int(os.getenv("MAFIA_HTTP_POOL_SIZE", "0"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("MAFIA_HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("MAFIA_HTTP_READ_TIMEOUT", "30"))
+
+# Ro'yxat xabari ko'pi bilan shuncha soniyada bir marta tahrirlanadi (guruh limiti ~20 xabar/daqiqa)
+REGISTRATION_EDIT_INTERVAL = float(os.getenv("MAFIA_REGISTRATION_EDIT_INTERVAL", "3"))
+# Kunduzgi ovozlar jadvali (ovoz berish xabari) ko'pi bilan shuncha soniyada bir marta yangilanadi
+VOTE_TALLY_INTERVAL = float(os.getenv("MAFIA_VOTE_TALLY_INTERVAL", "3"))
 
 REGISTRATION_TIMEOUT = 60
 MIN_PLAYERS = 3
@@ -44,28 +140,185 @@ bot_message_history: Dict[str, List[int]] = {}  # chat_id -> [message_ids]
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 logger = logging.getLogger("mafia_bot")
 
+# ============================ HTTP ULANISHLAR ============================
+class HttpPool:
+    """Barcha Bot API so'rovlari uchun bitta requests.Session (keep-alive).
+
+    telebot standart holatda har bir oqimga alohida sessiya ochadi va uni har
+    10 daqiqada yangilaydi - har bir oqim uchun yangi TLS handshake. Bu yerda
+    barcha oqimlar bitta urllib3 pool'idan (thread-safe) foydalanadi. Hajm
+    oqimlar soniga teng; hammasi band bo'lsa qo'shimcha ulanish ochiladi,
+    lekin pool'da saqlanmaydi.
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=size)
+        self.session = requests.Session()
+        self.session.mount("https://", self.adapter)
+        self.session.mount("http://", self.adapter)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors: Counter = Counter()  # istisno turi -> soni
+        self.time_total = 0.0
+        self.time_max = 0.0
+
+    def request(self, method: str, url: str, params=None, files=None, timeout=None, proxies=None):
+        """apihelper.CUSTOM_REQUEST_SENDER: timeout - (ulanish, o'qish)"""
+        started = time.monotonic()
+        try:
+            return self.session.request(method, url, params=params, files=files,
+                                        timeout=timeout, proxies=proxies)
+        except requests.RequestException as e:
+            with self.lock:
+                self.errors[type(e).__name__] += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - started
+            with self.lock:
+                self.requests += 1
+                self.time_total += elapsed
+                self.time_max = max(self.time_max, elapsed)
+
+    def connections(self) -> int:
+        """Ochilgan (yangi) ulanishlar soni; qolgan so'rovlar mavjud ulanishdan foydalangan"""
+        pools = self.adapter.poolmanager.pools
+        return sum(pools[key].num_connections for key in list(pools.keys()) if key in pools)
+
+    def stats(self) -> Dict[str, Any]:
+        connections = self.connections()
+        with self.lock:
+            n = self.requests
+            return {
+                "pool_size": self.size,
+                "requests": n,
+                "connections": connections,
+                "reused": max(n - connections, 0),
+                "avg_ms": self.time_total / n * 1000 if n else 0.0,
+                "max_ms": self.time_max * 1000,
+                "errors": dict(self.errors),
+            }
+
+# Har bir ishchi oqim bir vaqtda bitta so'rov yuboradi (+ polling/webhook/ommaviy xabar uchun zaxira)
+HTTP = HttpPool(HTTP_POOL_SIZE or OUTBOX_WORKERS + UPDATE_WORKERS + CHAT_WORKERS + TIMER_WORKERS + 4)
+apihelper.CUSTOM_REQUEST_SENDER = HTTP.request
+apihelper.CONNECT_TIMEOUT = HTTP_CONNECT_TIMEOUT
+apihelper.READ_TIMEOUT = HTTP_READ_TIMEOUT
+
 # ============================ BOT ============================
-bot = TeleBot(TOKEN, parse_mode="HTML")
+# Middleware: har bir update'dan foydalanuvchi/chat ma'lumotlarini yig'ish uchun (DIRECTORY)
+apihelper.ENABLE_MIDDLEWARE = True
+
+class MafiaBot(TeleBot):
+    """Handlerlar UPDATES pool'ida bajariladi (threaded=False: telebot'ning tartibsiz pool'i o'rniga)"""
+
+    def process_new_updates(self, updates: List[types.Update]) -> None:
+        # Polling: offset shu yerda suriladi, navbat to'lsa polling joy bo'shashini kutadi
+        for update in updates:
+            self.last_update_id = max(self.last_update_id, update.update_id)
+            UPDATES.submit_update(update, block=True)
+
+    def handle_updates(self, updates: List[types.Update]) -> None:
+        super().process_new_updates(updates)
+
+bot = MafiaBot(TOKEN, parse_mode="HTML", threaded=False)
+
+if ENGINE == "asyncio":
+    try:
+        import aiohttp  # faqat shu rejimda kerak
+    except ImportError:
+        sys.exit("MAFIA_ENGINE=asyncio uchun aiohttp kerak: pip install -r requirements-asyncio.txt")
+    from telebot import asyncio_helper
+    from telebot.async_telebot import AsyncTeleBot
+    # aiohttp sessiyasi ham bitta: ulanishlar soni va timeout yuqoridagi sozlamalar bo'yicha
+    asyncio_helper.REQUEST_LIMIT = HTTP.size
+    asyncio_helper.REQUEST_TIMEOUT = HTTP_CONNECT_TIMEOUT + HTTP_READ_TIMEOUT
+    async_bot: Optional["AsyncTeleBot"] = AsyncTeleBot(TOKEN, parse_mode="HTML")
+else:
+    async_bot = None
 
 # ============================ GLOBAL STATE ============================
-LOCK = threading.RLock()
+# Lock'lar. Bir nechtasi kerak bo'lsa, faqat shu tartibda olinadi:
+#   chat_lock(chat) -> PROFILE_LOCK -> GAMES_LOCK -> PERSIST_LOCK -> FLUSH_LOCK
+# Bir oqim bir vaqtda ikki xil chat lock'ini ushlamaydi. GAMES_LOCK, PERSIST_LOCK
+# va FLUSH_LOCK ostida hech qanday boshqa lock yoki tarmoq so'rovi bajarilmaydi.
+PROFILE_LOCK = threading.RLock()  # profiles, diamond_orders, waiting_* va ADMIN_IDS
+GAMES_LOCK = threading.Lock()     # games / player_games / CHAT_LOCKS lug'atlari tarkibi
+# chat -> o'sha chat o'yini va xabarlari lock'i. Kuchsiz havolalar: lock'ni ishlatayotganlar
+# uni ushlab turadi, hech kim ushlamasa yozuv o'zi o'chadi (eski guruhlar xotirada qolmaydi)
+CHAT_LOCKS: "weakref.WeakValueDictionary[str, threading.RLock]" = weakref.WeakValueDictionary()
+
+def chat_lock(chat_id) -> threading.RLock:
+    """Bitta guruh o'yini holati uchun lock (boshqa guruhlarni to'xtatmaydi)"""
+    key = str(int(chat_id))
+    lock = CHAT_LOCKS.get(key)
+    if lock is None:
+        with GAMES_LOCK:
+            lock = CHAT_LOCKS.setdefault(key, threading.RLock())
+    return lock
 
 profiles: Dict[str, Dict[str, Any]] = {}
 games: Dict[str, Dict[str, Any]] = {}
-history: List[Dict[str, Any]] = []
+player_games: Dict[int, str] = {}  # o'yinchi -> boshlangan o'yin chati (shaxsiy chatdagi tugmalar uchun)
+target_renders: Dict[str, tuple] = {}  # chat -> (versiya, ismlar, {tur: tugmalar}) - target_markup keshi
+game_tokens: Dict[str, str] = {}  # o'yin tokeni -> chat (callback_data dagi qisqa o'yin belgisi)
+
+def new_game_token() -> str:
+    """6 belgili tasodifiy token; GAMES_LOCK ostida chaqiriladi"""
+    while True:
+        token = "%06x" % random.getrandbits(24)
+        if token not in game_tokens:
+            return token
+
+def register_game(key: str, game: Dict[str, Any]) -> None:
+    with GAMES_LOCK:
+        old = games.get(key)
+        if old is not None:
+            game_tokens.pop(old.get("token"), None)
+        game["token"] = new_game_token()
+        game_tokens[game["token"]] = key
+        games[key] = game
+
+def unregister_game(key: str) -> Optional[Dict[str, Any]]:
+    with GAMES_LOCK:
+        game = games.pop(key, None)
+        target_renders.pop(key, None)
+        game_tokens.pop((game or {}).get("token"), None)
+        for p in (game or {}).get("players", []):
+            if player_games.get(int(p)) == key:
+                player_games.pop(int(p), None)
+    return game
+
+def index_players(key: str, players: List[int]) -> None:
+    with GAMES_LOCK:
+        player_games.update({int(p): key for p in players})
+
+def player_game_chat(uid: int) -> Optional[int]:
+    """O'yinchi qatnashayotgan boshlangan o'yin chati (tungi tugmalar shaxsiy chatdan keladi)"""
+    with GAMES_LOCK:
+        key = player_games.get(int(uid))
+    return None if key is None else int(key)
+
+def active_games_count() -> int:
+    with GAMES_LOCK:
+        return sum(1 for g in games.values() if g.get("state") == "started")
+history: deque = deque(maxlen=HISTORY_TAIL)  # faqat oxirgi o'yinlar, qolgani HISTORY_DIR da
+history_stats: Dict[str, Any] = {}  # tugagan o'yinlar bo'yicha yig'ma statistika
 diamond_orders: Dict[str, Dict[str, Any]] = {}
 waiting_for_custom_amount: set[int] = set()
 waiting_for_check: Dict[int, str] = {}  
 waiting_for_broadcast: Dict[int, str] = {}  # admin -> broadcast message
 waiting_for_admin_add: Dict[int, Any] = {}  # admin -> waiting for user_id
 waiting_for_admin_remove: Dict[int, bool] = {}  # admin -> waiting for user_id
-timers: Dict[str, Dict[str, Optional[threading.Timer]]] = {}
 
 # ============================ PERSISTENCE ============================
 def ensure_data_dir() -> None:
     if not os.path.exists(DATA_DIR):
         os.makedirs(DATA_DIR)
 
+def ensure_parent_dir(path: str) -> None:
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
 def default_serializer(obj):
     if isinstance(obj, set):
         return list(obj)
@@ -73,7 +326,7 @@ def default_serializer(obj):
 
 def save_json(path: str, data: Any) -> None:
     try:
-        ensure_data_dir()
+        ensure_parent_dir(path)
         tmp = path + ".tmp"
         with open(tmp, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2, default=default_serializer)
@@ -90,45 +343,959 @@ def load_json(path: str):
         logger.exception("load_json %s error: %s", path, e)
     return None
 
-def persist_profiles() -> None:
-    with LOCK:
-        save_json(PROFILES_FILE, profiles)
-
-def persist_games() -> None:
-    safe_games = {}
-    with LOCK:
-        for k, g in games.items():
-            copyg = {}
-            for kk, vv in g.items():
-                if isinstance(vv, set):
-                    copyg[kk] = list(vv)
-                else:
-                    copyg[kk] = vv
-            safe_games[k] = copyg
-        save_json(GAMES_FILE, safe_games)
+def dump_record(data: Any) -> str:
+    return json.dumps(data, ensure_ascii=False, separators=(",", ":"), default=default_serializer)
+
+def write_text_atomic(path: str, text: str) -> None:
+    try:
+        ensure_parent_dir(path)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, path)
+    except Exception as e:
+        logger.exception("write_text_atomic %s error: %s", path, e)
+
+class KeyedLog:
+    """Snapshot fayli + kalitli append log.
+
+    Har bir o'zgarish logga bitta qator bo'lib qo'shiladi, shuning uchun yozish
+    narxi faqat o'zgargan yozuvlarga bog'liq. Log yetarlicha o'sganda yoki
+    SNAPSHOT_INTERVAL o'tganda snapshot qayta yoziladi va log tozalanadi
+    (compaction). Snapshot xotiradagi serializatsiya qilingan nusxadan (records)
+    yoziladi, jonli dict'larga tegmaydi.
+
+    Log qatorlari: {"k", "v"} - yozuv holati, {"k", "del"} - o'chirilgan,
+    {"k", "ev", "ts", "i"} - hodisa (jurnal uchun, holatga ta'sir qilmaydi).
+    """
 
-def persist_history() -> None:
-    with LOCK:
-        save_json(HISTORY_FILE, history)
+    def __init__(self, snapshot_path: str, log_path: str, compact_min: Optional[int] = None) -> None:
+        self.snapshot_path = snapshot_path
+        self.log_path = log_path
+        self.compact_min = compact_min
+        self.log_records = 0
+        self.records: Dict[str, str] = {}
+        self.compacted_at = time.monotonic()
+
+    def load(self) -> Dict[str, Any]:
+        data = load_json(self.snapshot_path) or {}
+        self.log_records = 0
+        if os.path.exists(self.log_path):
+            try:
+                with open(self.log_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            rec = json.loads(line)
+                        except ValueError:
+                            # Crash paytida yarim yozilgan oxirgi qator
+                            logger.warning("%s: buzilgan qator o'tkazib yuborildi", self.log_path)
+                            continue
+                        if rec.get("del"):
+                            data.pop(rec["k"], None)
+                        elif "v" in rec:
+                            data[rec["k"]] = rec["v"]
+                        self.log_records += 1
+            except Exception as e:
+                logger.exception("KeyedLog.load %s error: %s", self.log_path, e)
+        self.records = {k: dump_record(v) for k, v in data.items()}
+        return data
+
+    def append(self, changes: Dict[str, Optional[str]], events: Optional[Dict[str, List[Dict[str, Any]]]] = None) -> None:
+        """changes: kalit -> tayyor JSON matn (None - yozuv o'chirilgan); events: kalit -> hodisalar"""
+        if not changes and not events:
+            return
+        lines = []
+        for k, evs in (events or {}).items():
+            for ev in evs:
+                lines.append('{"k":%s,%s\n' % (json.dumps(k), dump_record(ev)[1:]))
+        for k, payload in changes.items():
+            if payload is None:
+                self.records.pop(k, None)
+                lines.append('{"k":%s,"del":true}\n' % json.dumps(k))
+            else:
+                self.records[k] = payload
+                lines.append('{"k":%s,"v":%s}\n' % (json.dumps(k), payload))
+        try:
+            ensure_parent_dir(self.log_path)
+            with open(self.log_path, "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+            self.log_records += len(lines)
+        except Exception as e:
+            logger.exception("KeyedLog.append %s error: %s", self.log_path, e)
+
+    def needs_compaction(self) -> bool:
+        compact_min = COMPACT_MIN_RECORDS if self.compact_min is None else self.compact_min
+        if self.log_records > max(compact_min, len(self.records)):
+            return True
+        return self.log_records > 0 and time.monotonic() - self.compacted_at >= SNAPSHOT_INTERVAL
+
+    def compact(self, records: Optional[Dict[str, str]] = None) -> None:
+        if records is not None:
+            self.records = dict(records)
+        # Avval to'liq snapshot, keyin log. Oradagi crash xavfsiz: log qayta o'qilganda natija o'zgarmaydi
+        body = ",\n".join(f"{json.dumps(k)}:{v}" for k, v in self.records.items())
+        write_text_atomic(self.snapshot_path, "{" + body + "}")
+        try:
+            with open(self.log_path, "w", encoding="utf-8"):
+                pass
+            self.log_records = 0
+            self.compacted_at = time.monotonic()
+        except Exception as e:
+            logger.exception("KeyedLog.compact %s error: %s", self.log_path, e)
+
+    def write(self, changes: Dict[str, Optional[str]], events=None) -> None:
+        self.append(changes, events)
+        if self.needs_compaction():
+            self.compact()
+
+    def remove(self) -> None:
+        for path in (self.snapshot_path, self.log_path):
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except Exception as e:
+                logger.exception("KeyedLog.remove %s error: %s", path, e)
+
+class ShardedLog:
+    """Har bir kalit (chat) uchun alohida KeyedLog: <papka>/<cid>.json + <cid>.log.
+
+    Bitta guruhdagi yozish boshqa guruhlarning fayllariga tegmaydi, shuning uchun
+    yozish narxi faol guruhlar soniga bog'liq emas. O'yin tugaganda uning fayllari
+    o'chiriladi.
+    """
+
+    def __init__(self, directory: str, legacy: Optional[KeyedLog] = None) -> None:
+        self.directory = directory
+        self.legacy = legacy
+        self.shards: Dict[str, KeyedLog] = {}
+
+    def shard(self, key: str) -> KeyedLog:
+        sh = self.shards.get(key)
+        if sh is None:
+            base = os.path.join(self.directory, key)
+            sh = KeyedLog(base + ".json", base + ".log", compact_min=GAME_SHARD_COMPACT_RECORDS)
+            self.shards[key] = sh
+        return sh
+
+    def migrate_legacy(self) -> None:
+        """Eski yagona games.json/games.log ni chatlar bo'yicha bo'lib chiqish"""
+        legacy = self.legacy
+        if not legacy or not (os.path.exists(legacy.snapshot_path) or os.path.exists(legacy.log_path)):
+            return
+        old = legacy.load()
+        for k, v in old.items():
+            self.shard(k).compact({k: dump_record(v)})
+        for path in (legacy.snapshot_path, legacy.log_path):
+            if os.path.exists(path):
+                os.replace(path, path + ".bak")
+        logger.info("%d ta o'yin %s papkasiga ko'chirildi", len(old), self.directory)
+
+    def load(self) -> Dict[str, Any]:
+        self.migrate_legacy()
+        data: Dict[str, Any] = {}
+        if not os.path.isdir(self.directory):
+            return data
+        keys = {name.rsplit(".", 1)[0] for name in os.listdir(self.directory)
+                if name.endswith(".json") or name.endswith(".log")}
+        for key in sorted(keys):
+            data.update(self.shard(key).load())
+        return data
+
+    def write(self, changes: Dict[str, Optional[str]], events=None) -> None:
+        events = events or {}
+        for key in set(changes) | set(events):
+            sh = self.shard(key)
+            if key in changes and changes[key] is None:
+                # O'yin tugadi - chat fayllarini o'chirish
+                sh.remove()
+                self.shards.pop(key, None)
+                continue
+            sh.write({key: changes[key]} if key in changes else {},
+                     {key: events[key]} if key in events else None)
+
+    def compact(self, records: Dict[str, str]) -> None:
+        for key in list(self.shards):
+            if key not in records:
+                self.shards.pop(key).remove()
+        for key, payload in records.items():
+            self.shard(key).compact({key: payload})
+
+def new_history_stats() -> Dict[str, Any]:
+    return {
+        "games": 0,
+        "per_chat": {},    # chat_id -> o'yinlar soni
+        "winners": {},     # g'olib tomon -> o'yinlar soni
+        "role_wins": {},   # rol -> g'olib tomonda bo'lgan o'yinchilar soni
+        "duration": {"count": 0, "total": 0, "min": None, "max": None},
+    }
+
+def winning_roles(record: Dict[str, Any]) -> List[str]:
+    roles = (record.get("roles") or {}).values()
+    winner = record.get("winner")
+    if winner == "Мафия":
+        return [r for r in roles if "Дон" in r]
+    if winner == "Мирные жители":
+        return [r for r in roles if "Дон" not in r]
+    return []  # admin to'xtatgan o'yinlar
+
+def update_history_stats(stats: Dict[str, Any], record: Dict[str, Any]) -> None:
+    stats["games"] += 1
+    chat = str(record.get("chat_id"))
+    stats["per_chat"][chat] = stats["per_chat"].get(chat, 0) + 1
+    winner = record.get("winner") or "?"
+    stats["winners"][winner] = stats["winners"].get(winner, 0) + 1
+    for role in winning_roles(record):
+        stats["role_wins"][role] = stats["role_wins"].get(role, 0) + 1
+    took = record.get("duration")
+    if took is not None:
+        d = stats["duration"]
+        d["count"] += 1
+        d["total"] += took
+        d["min"] = took if d["min"] is None else min(d["min"], took)
+        d["max"] = took if d["max"] is None else max(d["max"], took)
+
+def build_history_stats(records) -> Dict[str, Any]:
+    stats = new_history_stats()
+    for r in records:
+        update_history_stats(stats, r)
+    return stats
+
+def read_last_lines(path: str, n: int) -> List[str]:
+    """Fayl oxiridan n ta qatorni o'qish (butun faylni o'qimasdan)"""
+    if n <= 0:
+        return []
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        pos = f.tell()
+        buf = b""
+        while pos > 0 and buf.count(b"\n") <= n:
+            step = min(65536, pos)
+            pos -= step
+            f.seek(pos)
+            buf = f.read(step) + buf
+    lines = [line for line in buf.decode("utf-8", errors="replace").splitlines() if line.strip()]
+    return lines[-n:]
+
+class HistoryArchive:
+    """Tarix arxivi: oylik append-only segmentlar (<papka>/YYYY-MM.jsonl) + stats.json.
+
+    O'yin tugaganda joriy segment oxiriga bitta qator qo'shiladi. Ishga tushganda
+    faqat oxirgi qatorlar o'qiladi; eski segmentlar faqat iter() orqali
+    so'ralganda ochiladi. Yig'ma statistika alohida kichik faylda saqlanadi.
+    """
+
+    def __init__(self, directory: str, legacy_file: Optional[str] = None) -> None:
+        self.directory = directory
+        self.legacy_file = legacy_file
+        self.stats_file = os.path.join(directory, "stats.json")
+
+    @staticmethod
+    def segment_name(ts: int) -> str:
+        return time.strftime("%Y-%m", time.gmtime(ts)) + ".jsonl"
+
+    def segments(self) -> List[str]:
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(name for name in os.listdir(self.directory) if name.endswith(".jsonl"))
+
+    def migrate_legacy(self) -> None:
+        """Eski yagona history.json ni segmentlarga bo'lib chiqish"""
+        if not self.legacy_file or not os.path.exists(self.legacy_file):
+            return
+        old = load_json(self.legacy_file) or []
+        self.append(old)
+        self.save_stats(dump_record(build_history_stats(self.iter())))
+        os.replace(self.legacy_file, self.legacy_file + ".bak")
+        logger.info("%d ta o'yin tarixi %s papkasiga ko'chirildi", len(old), self.directory)
+
+    def append(self, records: List[Dict[str, Any]]) -> None:
+        by_segment: Dict[str, List[str]] = {}
+        for r in records:
+            by_segment.setdefault(self.segment_name(r.get("finished_at", 0)), []).append(dump_record(r) + "\n")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for name, lines in by_segment.items():
+                with open(os.path.join(self.directory, name), "a", encoding="utf-8") as f:
+                    f.write("".join(lines))
+        except Exception as e:
+            logger.exception("HistoryArchive.append %s error: %s", self.directory, e)
+
+    def parse(self, lines) -> Iterator[Dict[str, Any]]:
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                logger.warning("%s: buzilgan tarix qatori o'tkazib yuborildi", self.directory)
+
+    def tail(self, limit: int) -> List[Dict[str, Any]]:
+        out: List[Dict[str, Any]] = []
+        for name in reversed(self.segments()):
+            if len(out) >= limit:
+                break
+            lines = read_last_lines(os.path.join(self.directory, name), limit - len(out))
+            out[:0] = self.parse(lines)
+        return out
+
+    def iter(self, since: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        first = self.segment_name(since) if since else ""
+        for name in self.segments():
+            if name < first:
+                continue
+            with open(os.path.join(self.directory, name), "r", encoding="utf-8") as f:
+                for rec in self.parse(f):
+                    if since is None or rec.get("finished_at", 0) >= since:
+                        yield rec
+
+    def load_stats(self) -> Dict[str, Any]:
+        stats = load_json(self.stats_file)
+        if stats is None:
+            # stats.json yo'q yoki buzilgan - segmentlardan qayta hisoblash
+            stats = build_history_stats(self.iter())
+            if stats["games"]:
+                self.save_stats(dump_record(stats))
+        return stats
+
+    def save_stats(self, payload: str) -> None:
+        write_text_atomic(self.stats_file, payload)
+
+class JsonStorage:
+    """Fayl backend: profillar va o'yinlar KeyedLog orqali, tarix segmentlarda, adminlar JSON faylda"""
+
+    name = "json"
+
+    def __init__(self, data_dir: str = DATA_DIR) -> None:
+        def path(name: str) -> str:
+            return os.path.join(data_dir, os.path.basename(name))
+        self.history = HistoryArchive(path(HISTORY_DIR), legacy_file=path(HISTORY_FILE))
+        self.admins_file = path(ADMINS_FILE)
+        self.stores = {
+            "profiles": KeyedLog(path(PROFILES_FILE), path(PROFILES_LOG)),
+            "games": ShardedLog(path(GAMES_DIR), legacy=KeyedLog(path(GAMES_FILE), path(GAMES_LOG))),
+        }
+
+    def load(self, collection: str) -> Dict[str, Any]:
+        return self.stores[collection].load()
+
+    def write(self, collection: str, changes: Dict[str, Optional[str]], events=None) -> None:
+        self.stores[collection].write(changes, events)
+
+    def snapshot(self, collection: str, records: Dict[str, str]) -> None:
+        self.stores[collection].compact(records)
+
+    def load_history(self, limit: int) -> List[Dict[str, Any]]:
+        self.history.migrate_legacy()
+        return self.history.tail(limit)
+
+    def iter_history(self, since: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        self.history.migrate_legacy()
+        return self.history.iter(since)
+
+    def append_history(self, records: List[Dict[str, Any]]) -> None:
+        self.history.append(records)
+
+    def load_history_stats(self) -> Dict[str, Any]:
+        self.history.migrate_legacy()
+        return self.history.load_stats()
+
+    def save_history_stats(self, payload: str) -> None:
+        self.history.save_stats(payload)
+
+    def load_admins(self) -> List[int]:
+        return load_json(self.admins_file) or []
+
+    def save_admins(self, ids) -> None:
+        save_json(self.admins_file, list(ids))
+
+def prune_orphan_events(conn) -> None:
+    """games jadvalida yozuvi qolmagan chatlar jurnalini o'chirish"""
+    conn.execute("DELETE FROM game_events WHERE chat_id NOT IN (SELECT chat_id FROM games)")
+
+class SqliteStorage:
+    """SQLite backend (WAL). Har bir persist chaqiruvi - bitta tranzaksiya, faqat o'zgargan qatorlar."""
+
+    name = "sqlite"
+
+    TABLES = {"profiles": "uid", "games": "chat_id"}
+
+    def __init__(self, path: str) -> None:
+        ensure_parent_dir(path)
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS profiles (uid TEXT PRIMARY KEY, data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS games (chat_id TEXT PRIMARY KEY, data TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                finished_at INTEGER NOT NULL,
+                winner TEXT,
+                data TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS history_chat ON history(chat_id, finished_at);
+            CREATE INDEX IF NOT EXISTS history_finished ON history(finished_at);
+            CREATE TABLE IF NOT EXISTS admins (uid INTEGER PRIMARY KEY);
+            CREATE TABLE IF NOT EXISTS game_events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id TEXT NOT NULL,
+                ts INTEGER NOT NULL,
+                kind TEXT NOT NULL,
+                data TEXT
+            );
+            CREATE INDEX IF NOT EXISTS game_events_chat ON game_events(chat_id, id);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, data TEXT NOT NULL);
+        """)
+        # Avvalgi versiyalar tugagan o'yinlar jurnalini o'chirmas edi
+        self._tx(prune_orphan_events)
+
+    def _tx(self, fn) -> None:
+        with self.lock:
+            try:
+                self.conn.execute("BEGIN")
+                fn(self.conn)
+                self.conn.execute("COMMIT")
+            except Exception as e:
+                self.conn.execute("ROLLBACK")
+                logger.exception("sqlite %s error: %s", self.path, e)
+
+    def load(self, collection: str) -> Dict[str, Any]:
+        key_col = self.TABLES[collection]
+        with self.lock:
+            rows = self.conn.execute(f"SELECT {key_col}, data FROM {collection}").fetchall()
+        return {k: json.loads(v) for k, v in rows}
+
+    def write(self, collection: str, changes: Dict[str, Optional[str]], events=None) -> None:
+        if not changes and not events:
+            return
+        key_col = self.TABLES[collection]
+        upserts = [(k, v) for k, v in changes.items() if v is not None]
+        deletes = [(k,) for k, v in changes.items() if v is None]
+        event_rows = [(k, ev["ts"], ev["ev"], dump_record(ev["i"]) if "i" in ev else None)
+                      for k, evs in (events or {}).items() for ev in evs]
+
+        def run(conn):
+            if event_rows:
+                conn.executemany("INSERT INTO game_events (chat_id, ts, kind, data) VALUES (?, ?, ?, ?)", event_rows)
+            if upserts:
+                conn.executemany(
+                    f"INSERT INTO {collection} ({key_col}, data) VALUES (?, ?) "
+                    f"ON CONFLICT({key_col}) DO UPDATE SET data = excluded.data", upserts)
+            if deletes:
+                conn.executemany(f"DELETE FROM {collection} WHERE {key_col} = ?", deletes)
+                if collection == "games":
+                    # Jurnal o'yin bilan birga o'chadi (ShardedLog chat fayllarini o'chirgani kabi)
+                    conn.executemany("DELETE FROM game_events WHERE chat_id = ?", deletes)
+        self._tx(run)
+
+    def snapshot(self, collection: str, records: Dict[str, str]) -> None:
+        key_col = self.TABLES[collection]
+        rows = list(records.items())
+
+        def run(conn):
+            conn.execute(f"DELETE FROM {collection}")
+            conn.executemany(f"INSERT INTO {collection} ({key_col}, data) VALUES (?, ?)", rows)
+            if collection == "games":
+                prune_orphan_events(conn)
+        self._tx(run)
+
+    def load_history(self, limit: int) -> List[Dict[str, Any]]:
+        with self.lock:
+            rows = self.conn.execute("SELECT data FROM history ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [json.loads(r[0]) for r in reversed(rows)]
+
+    def iter_history(self, since: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+        last_id = 0
+        while True:
+            with self.lock:
+                rows = self.conn.execute(
+                    "SELECT id, data FROM history WHERE id > ? AND finished_at >= ? ORDER BY id LIMIT 1000",
+                    (last_id, since or 0)).fetchall()
+            if not rows:
+                return
+            for row_id, data in rows:
+                last_id = row_id
+                yield json.loads(data)
+
+    def append_history(self, records: List[Dict[str, Any]]) -> None:
+        self.insert_history(records)
+
+    def load_history_stats(self) -> Dict[str, Any]:
+        with self.lock:
+            row = self.conn.execute("SELECT data FROM meta WHERE key = 'history_stats'").fetchone()
+        if row:
+            return json.loads(row[0])
+        stats = build_history_stats(self.iter_history())
+        if stats["games"]:
+            self.save_history_stats(dump_record(stats))
+        return stats
+
+    def save_history_stats(self, payload: str) -> None:
+        self._tx(lambda conn: conn.execute(
+            "INSERT INTO meta (key, data) VALUES ('history_stats', ?) "
+            "ON CONFLICT(key) DO UPDATE SET data = excluded.data", (payload,)))
+
+    def insert_history(self, records: List[Dict[str, Any]]) -> None:
+        rows = [(int(r.get("chat_id", 0)), int(r.get("finished_at", 0)), r.get("winner"), dump_record(r))
+                for r in records]
+        self._tx(lambda conn: conn.executemany(
+            "INSERT INTO history (chat_id, finished_at, winner, data) VALUES (?, ?, ?, ?)", rows))
+
+    def load_admins(self) -> List[int]:
+        with self.lock:
+            return [r[0] for r in self.conn.execute("SELECT uid FROM admins").fetchall()]
+
+    def save_admins(self, ids) -> None:
+        rows = [(int(i),) for i in ids]
+
+        def run(conn):
+            conn.execute("DELETE FROM admins")
+            conn.executemany("INSERT INTO admins (uid) VALUES (?)", rows)
+        self._tx(run)
+
+def migrate_json_to_sqlite(path: str = SQLITE_FILE) -> Dict[str, int]:
+    """JSON fayllardagi barcha ma'lumotni SQLite bazaga bir martalik ko'chirish"""
+    src = JsonStorage()
+    dst = SqliteStorage(path)
+    counts = {}
+    for collection in ("profiles", "games"):
+        data = src.load(collection)
+        dst.snapshot(collection, {k: dump_record(v) for k, v in data.items()})
+        counts[collection] = len(data)
+    dst._tx(lambda conn: conn.execute("DELETE FROM history"))
+    batch: List[Dict[str, Any]] = []
+    counts["history"] = 0
+    for rec in src.iter_history():
+        batch.append(rec)
+        if len(batch) >= 10000:
+            dst.insert_history(batch)
+            counts["history"] += len(batch)
+            batch = []
+    dst.insert_history(batch)
+    counts["history"] += len(batch)
+    dst.save_history_stats(dump_record(src.load_history_stats()))
+    admins = src.load_admins()
+    dst.save_admins(admins)
+    counts["admins"] = len(admins)
+    logger.info("JSON -> SQLite ko'chirildi (%s): %s", path, counts)
+    return counts
+
+def open_storage():
+    if STORAGE_BACKEND == "sqlite":
+        first_run = not os.path.exists(SQLITE_FILE)
+        legacy = (PROFILES_FILE, GAMES_FILE, GAMES_DIR, HISTORY_FILE, HISTORY_DIR, ADMINS_FILE)
+        if first_run and any(os.path.exists(f) for f in legacy):
+            migrate_json_to_sqlite(SQLITE_FILE)
+        return SqliteStorage(SQLITE_FILE)
+    return JsonStorage()
+
+STORAGE = open_storage()
+
+# Yozilishi kerak bo'lgan o'zgarishlar. persist_* chaqirilganda yozuv o'z lock'i
+# (PROFILE_LOCK yoki chat_lock) ostida darhol serializatsiya qilinadi, shuning
+# uchun flush paytida hech qanday holat lock'i olinmaydi.
+pending_changes: Dict[str, Dict[str, Optional[str]]] = {"profiles": {}, "games": {}}
+pending_snapshots: Dict[str, Dict[str, str]] = {}  # to'liq qayta yoziladigan kolleksiyalar
+pending_history: List[Dict[str, Any]] = []
+history_stats_dirty = False
+game_events: Dict[str, List[Dict[str, Any]]] = {}  # chat -> hali yozilmagan jurnal hodisalari
+pending_admins: Optional[List[int]] = None
+
+PERSIST_LOCK = threading.Lock()  # yuqoridagi navbatlar va history/history_stats
+# Yozish faqat FLUSH_LOCK ostida, PERSIST_LOCK qo'yib yuborilgandan keyin.
+FLUSH_LOCK = threading.Lock()
+
+def flush_dirty() -> None:
+    """Navbatdagi (oldindan serializatsiya qilingan) o'zgarishlarni diskka yozish"""
+    global pending_admins, history_stats_dirty
+    PERSIST_LOCK.acquire()
+    try:
+        events = dict(game_events)
+        game_events.clear()
+        snapshots = dict(pending_snapshots)
+        pending_snapshots.clear()
+        changes = {name: dict(c) for name, c in pending_changes.items()}
+        for c in pending_changes.values():
+            c.clear()
+        new_history = pending_history[:]
+        pending_history.clear()
+        stats_payload = dump_record(history_stats) if history_stats_dirty else None
+        history_stats_dirty = False
+        admin_ids = pending_admins
+        pending_admins = None
+        # Navbatni saqlash: keyingi yig'uvchi bu partiya yozilmaguncha kutadi
+        FLUSH_LOCK.acquire()
+    finally:
+        PERSIST_LOCK.release()
+    try:
+        for name in ("profiles", "games"):
+            if name in snapshots:
+                STORAGE.snapshot(name, snapshots[name])
+            # Hodisalar o'yin holati bilan bitta yozishda ketadi
+            if changes[name] or (name == "games" and events):
+                STORAGE.write(name, changes[name], events if name == "games" else None)
+        if new_history:
+            STORAGE.append_history(new_history)
+        if stats_payload is not None:
+            STORAGE.save_history_stats(stats_payload)
+        if admin_ids is not None:
+            STORAGE.save_admins(admin_ids)
+    finally:
+        FLUSH_LOCK.release()
+
+class PersistFlusher:
+    """Write-behind: persist_* faqat belgilaydi va uyg'otadi, yozish fon oqimida.
+
+    Ketma-ket yozishlar orasida kamida interval_ms o'tadi, shu vaqt ichidagi
+    barcha o'zgarishlar bitta yozishga birlashadi. interval_ms - crash paytida
+    yo'qolishi mumkin bo'lgan eng ko'p vaqt oralig'i; 0 - sinxron yozish.
+    """
+
+    def __init__(self, interval_ms: int) -> None:
+        self.interval = interval_ms / 1000.0
+        self.wake = threading.Event()
+        self.stopping = False
+        self.thread: Optional[threading.Thread] = None
+        self.last_flush = 0.0
+        self.flushes = 0
+
+    def start(self) -> None:
+        if self.interval <= 0 or self.thread:
+            return
+        self.thread = threading.Thread(target=self._run, name="persist-flusher", daemon=True)
+        self.thread.start()
+
+    def notify(self) -> None:
+        if self.thread is None:
+            flush_dirty()
+            return
+        self.wake.set()
+
+    def _run(self) -> None:
+        while not self.stopping:
+            self.wake.wait()
+            delay = self.last_flush + self.interval - time.monotonic()
+            if delay > 0 and not self.stopping:
+                time.sleep(delay)
+            self.wake.clear()
+            try:
+                flush_dirty()
+            except Exception as e:
+                logger.exception("persist flusher error: %s", e)
+            self.last_flush = time.monotonic()
+            self.flushes += 1
+
+    def stop(self) -> None:
+        """Oqimni to'xtatib, qolgan o'zgarishlarni yozish (shutdown)"""
+        self.stopping = True
+        self.wake.set()
+        if self.thread and self.thread is not threading.current_thread():
+            self.thread.join(timeout=5)
+        # Shundan keyingi persist_* chaqiruvlari sinxron yoziladi
+        self.thread = None
+        flush_dirty()
+
+FLUSHER = PersistFlusher(PERSIST_INTERVAL_MS)
+
+def queue_changes(name: str, payloads: Dict[str, Optional[str]], snapshot: bool = False) -> None:
+    with PERSIST_LOCK:
+        if snapshot:
+            pending_snapshots[name] = payloads
+            pending_changes[name].clear()
+        else:
+            pending_changes[name].update(payloads)
+
+def persist_profiles(*keys) -> None:
+    """Berilgan profillarni yozish navbatiga qo'yish. Kalitsiz chaqirilsa - to'liq snapshot."""
+    with PROFILE_LOCK:
+        if keys:
+            payloads = {}
+            for k in keys:
+                rec = profiles.get(str(k))
+                payloads[str(k)] = None if rec is None else dump_record(rec)
+        else:
+            payloads = {k: dump_record(v) for k, v in profiles.items()}
+        queue_changes("profiles", payloads, snapshot=not keys)
+    FLUSHER.notify()
+
+def snapshot_game(key: str) -> Optional[str]:
+    with chat_lock(key):
+        game = games.get(key)
+        return None if game is None else dump_record(game)
+
+def persist_games(*keys) -> None:
+    """Berilgan o'yinlarni yozish navbatiga qo'yish. Kalitsiz chaqirilsa - to'liq snapshot.
+
+    Chaqiruvchi o'sha o'yinning chat_lock'ini ushlab turgan bo'lishi mumkin
+    (lock qayta kiriladigan); boshqa chat lock'ini ushlab turmasligi kerak.
+    """
+    if keys:
+        queue_changes("games", {str(k): snapshot_game(str(k)) for k in keys})
+    else:
+        with GAMES_LOCK:
+            all_keys = list(games)
+        payloads = {k: snapshot_game(k) for k in all_keys}
+        queue_changes("games", {k: v for k, v in payloads.items() if v is not None}, snapshot=True)
+    FLUSHER.notify()
+
+def journal_game(key: str, kind: str, **info) -> None:
+    """O'yin hodisasini jurnalga yozish (o'yin holati ham birga yoziladi).
+
+    Hodisalar: registration, join, roles, mafia_kill, doctor_save, comissar_check,
+    night_end, day, vote, execution, victory. Qayta ishga tushganda snapshot +
+    jurnal dumidan oxirgi holat tiklanadi. Jurnal faqat o'yin yozuvi bor
+    ekan saqlanadi: yozuv o'chirilganda ikkala backend ham chat jurnalini
+    o'chiradi.
+    """
+    event: Dict[str, Any] = {"ev": kind, "ts": int(time.time())}
+    if info:
+        event["i"] = info
+    key = str(key)
+    payload = snapshot_game(key)
+    with PERSIST_LOCK:
+        game_events.setdefault(key, []).append(event)
+        pending_changes["games"][key] = payload
+    FLUSHER.notify()
+
+def append_history(record: Dict[str, Any]) -> None:
+    """Tugagan o'yinni tarix segmentiga qo'shish va yig'ma statistikani yangilash"""
+    global history_stats_dirty
+    with PERSIST_LOCK:
+        history.append(record)
+        pending_history.append(record)
+        update_history_stats(history_stats, record)
+        history_stats_dirty = True
+    FLUSHER.notify()
+
+def iter_history(since: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Diskdagi to'liq tarix (eski segmentlar faqat shu yerda o'qiladi)"""
+    flush_dirty()
+    return STORAGE.iter_history(since)
 
 def persist_admins() -> None:
-    with LOCK:
-        save_json(ADMINS_FILE, list(ADMIN_IDS))
+    global pending_admins
+    with PROFILE_LOCK:
+        ids = list(ADMIN_IDS)
+    with PERSIST_LOCK:
+        pending_admins = ids
+    FLUSHER.notify()
 
 def persist_all() -> None:
     persist_profiles()
     persist_games()
-    persist_history()
     persist_admins()
 
-# initial load
-with LOCK:
-    profiles.update(load_json(PROFILES_FILE) or {})
-    games.update(load_json(GAMES_FILE) or {})
-    history = load_json(HISTORY_FILE) or []
-    loaded_admins = load_json(ADMINS_FILE)
+# initial load (hali boshqa oqimlar yo'q)
+with PROFILE_LOCK, GAMES_LOCK:
+    profiles.update(STORAGE.load("profiles"))
+    games.update(STORAGE.load("games"))
+    # victory yozilgan, lekin o'chirilishiga ulgurmagan o'yinlar tiklanmaydi
+    finished_games = [cid for cid, g in games.items() if g.get("state") == "finished"]
+    for cid in finished_games:
+        games.pop(cid)
+    for cid, g in games.items():
+        if g.get("state") == "started":
+            player_games.update({int(p): cid for p in g.get("players", [])})
+        if not g.get("token"):
+            g["token"] = new_game_token()
+        game_tokens[g["token"]] = cid
+    history.extend(STORAGE.load_history(HISTORY_TAIL))
+    history_stats.update(new_history_stats())
+    history_stats.update(STORAGE.load_history_stats())
+    loaded_admins = STORAGE.load_admins()
     if loaded_admins:
         ADMIN_IDS.update(set(loaded_admins))
+if finished_games:
+    persist_games(*finished_games)
+
+FLUSHER.start()
+
+def shutdown_persistence(*_args) -> None:
+    FLUSHER.stop()
+
+def handle_sigterm(signum, frame) -> None:
+    # Render qayta deploy qilganda SIGTERM yuboradi; atexit orqali oxirgi flush bajariladi
+    sys.exit(0)
+
+atexit.register(shutdown_persistence)
+try:
+    signal.signal(signal.SIGTERM, handle_sigterm)
+except ValueError:
+    # Asosiy oqimdan tashqarida import qilinganda signal o'rnatib bo'lmaydi
+    pass
+
+# ============================ TAYMERLAR ============================
+class TimerScheduler:
+    """Barcha taymerlar uchun bitta oqim va muddatlar heap'i.
+
+    Taymerlar (chat, tur) kaliti bilan qo'yiladi; shu kalit bilan qayta qo'yish
+    eskisini almashtiradi, cancel() bekor qiladi. Muddati kelgan callback'lar
+    TIMER_WORKERS ta oqimli pool'da bajariladi, shuning uchun oqimlar soni
+    o'yinlar soniga qarab o'smaydi. Bekor qilingan yozuvlar heap'dan dangasa
+    (muddati kelganda yoki heap juda o'sganda) olib tashlanadi.
+    """
+
+    def __init__(self, workers: int) -> None:
+        self.workers = workers
+        self.cond = threading.Condition()
+        self.heap: List[tuple] = []  # (muddat, seq, kalit)
+        self.entries: Dict[Any, tuple] = {}  # kalit -> (muddat, seq, callback)
+        self.seq = itertools.count()
+        self.thread: Optional[threading.Thread] = None
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.fired = 0
+        self.cancelled = 0
+        self.late_total = 0.0
+        self.late_max = 0.0
+
+    def start(self) -> None:
+        # Birinchi taymerda ishga tushadi (import va servis buyruqlarida oqim ochilmaydi)
+        if self.thread is None:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="timer")
+            self.thread = threading.Thread(target=self._run, name="timer-scheduler", daemon=True)
+            self.thread.start()
+
+    def schedule(self, key, delay: float, fn) -> Any:
+        """delay soniyadan keyin fn() ni chaqirish. key=None - bekor qilinmaydigan bir martalik ish."""
+        with self.cond:
+            self.start()
+            seq = next(self.seq)
+            if key is None:
+                key = ("job", seq)
+            deadline = time.monotonic() + max(delay, 0)
+            self.entries[key] = (deadline, seq, fn)
+            heapq.heappush(self.heap, (deadline, seq, key))
+            if len(self.heap) > 2 * len(self.entries) + 64:
+                self.heap = [(d, sq, k) for k, (d, sq, _) in self.entries.items()]
+                heapq.heapify(self.heap)
+            self.cond.notify()
+        return key
+
+    def call_later(self, delay: float, fn) -> Any:
+        return self.schedule(None, delay, fn)
+
+    def cancel(self, key) -> bool:
+        with self.cond:
+            if self.entries.pop(key, None) is None:
+                return False
+            self.cancelled += 1
+            return True
+
+    def remaining(self, key) -> Optional[float]:
+        with self.cond:
+            entry = self.entries.get(key)
+            return None if entry is None else max(entry[0] - time.monotonic(), 0.0)
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                while True:
+                    now = time.monotonic()
+                    if self.heap and self.heap[0][0] <= now:
+                        deadline, seq, key = heapq.heappop(self.heap)
+                        entry = self.entries.get(key)
+                        if entry is None or entry[1] != seq:
+                            continue  # bekor qilingan yoki qayta qo'yilgan
+                        del self.entries[key]
+                        break
+                    self.cond.wait(self.heap[0][0] - now if self.heap else None)
+                late = now - deadline
+                self.fired += 1
+                self.late_total += late
+                self.late_max = max(self.late_max, late)
+            self.executor.submit(self._call, key, entry[2])
+
+    @staticmethod
+    def _call(key, fn) -> None:
+        try:
+            fn()
+        except Exception as e:
+            logger.exception("timer %s error: %s", key, e)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.cond:
+            return {
+                "pending": len(self.entries),
+                "fired": self.fired,
+                "cancelled": self.cancelled,
+                "late_avg_ms": self.late_total / self.fired * 1000 if self.fired else 0.0,
+                "late_max_ms": self.late_max * 1000,
+            }
+
+class EventLoopThread:
+    """asyncio rejimi: bitta event loop alohida oqimda (taymerlar va Telegram so'rovlari)"""
+
+    def __init__(self) -> None:
+        self.loop = asyncio.new_event_loop()
+        self.thread: Optional[threading.Thread] = None
+        self.start_lock = threading.Lock()
+
+    def start(self) -> None:
+        with self.start_lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop.run_forever, name="event-loop", daemon=True)
+                self.thread.start()
+
+    def in_loop(self) -> bool:
+        return threading.current_thread() is self.thread
+
+    def call_soon(self, fn, *args) -> None:
+        self.start()
+        self.loop.call_soon_threadsafe(fn, *args)
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Korutinani loop'da bajarib, natijani chaqiruvchi oqimda kutish (loop oqimidan chaqirilmaydi)"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+class AsyncTimerScheduler(TimerScheduler):
+    """TimerScheduler interfeysi, lekin muddatlar loop.call_at orqali (heap oqimi yo'q).
+
+    cancel() va qayta qo'yish yozuvni almashtiradi; loop'dagi eski chaqiruv
+    seq mos kelmagani uchun hech narsa qilmaydi.
+    """
+
+    def __init__(self, loop_thread: EventLoopThread, workers: int) -> None:
+        super().__init__(workers)
+        self.loop_thread = loop_thread
+
+    def start(self) -> None:
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.workers, thread_name_prefix="timer")
+
+    def schedule(self, key, delay: float, fn) -> Any:
+        with self.cond:
+            self.start()
+            seq = next(self.seq)
+            if key is None:
+                key = ("job", seq)
+            deadline = time.monotonic() + max(delay, 0)
+            self.entries[key] = (deadline, seq, fn)
+        # loop.time() ham time.monotonic() - muddat to'g'ridan-to'g'ri beriladi
+        self.loop_thread.call_soon(self.loop_thread.loop.call_at, deadline, self._fire, key, seq)
+        return key
+
+    def _fire(self, key, seq) -> None:
+        with self.cond:
+            entry = self.entries.get(key)
+            if entry is None or entry[1] != seq:
+                return
+            del self.entries[key]
+            late = time.monotonic() - entry[0]
+            self.fired += 1
+            self.late_total += late
+            self.late_max = max(self.late_max, late)
+        self.executor.submit(self._call, key, entry[2])
+
+EVENT_LOOP = EventLoopThread() if ENGINE == "asyncio" else None
+SCHEDULER = AsyncTimerScheduler(EVENT_LOOP, TIMER_WORKERS) if EVENT_LOOP else TimerScheduler(TIMER_WORKERS)
 
 # ============================ YORDAMCHI FUNKSIYALAR ============================
 def uid_str(uid: int) -> str:
@@ -147,20 +1314,176 @@ def get_username_obj(user) -> str:
     except Exception:
         return str(getattr(user, "id", "unknown"))
 
+class NameCache:
+    """Chegaralangan LRU kesh, har bir yozuv TTL bilan.
+
+    Muvaffaqiyatsiz so'rovlar ham (negative) qisqaroq TTL bilan saqlanadi, shunda
+    bloklagan yoki topilmagan foydalanuvchi uchun har safar API chaqirilmaydi.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, negative_ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.lock = threading.Lock()
+        self.items: "OrderedDict[int, tuple]" = OrderedDict()  # uid -> (qiymat, muddat)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: int) -> Optional[str]:
+        with self.lock:
+            item = self.items.get(key)
+            if item is None or item[1] < time.monotonic():
+                if item is not None:
+                    del self.items[key]
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key: int, value: str, negative: bool = False) -> None:
+        ttl = self.negative_ttl if negative else self.ttl
+        with self.lock:
+            self.items[key] = (value, time.monotonic() + ttl)
+            self.items.move_to_end(key)
+            while len(self.items) > self.maxsize:
+                self.items.popitem(last=False)
+
+    def invalidate(self, key: int) -> None:
+        with self.lock:
+            self.items.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"size": len(self.items), "hits": self.hits, "misses": self.misses}
+
+NAME_CACHE = NameCache(NAME_CACHE_SIZE, NAME_CACHE_TTL, NAME_CACHE_NEGATIVE_TTL)
+CHAT_TITLES = NameCache(NAME_CACHE_SIZE, NAME_CACHE_TTL, NAME_CACHE_NEGATIVE_TTL)
+
+class UpdateDirectory:
+    """Kelgan update'lardagi from_user va chat ma'lumotlari (tarmoq so'rovisiz).
+
+    Ismlar NAME_CACHE ga, guruh nomlari CHAT_TITLES ga yoziladi va har bir yangi
+    update bilan TTL yangilanadi. Telegramdan faqat keshda yo'q yoki eskirgan
+    yozuvlar so'raladi. Username bo'yicha ham qidirish mumkin.
+    """
+
+    def __init__(self, users: NameCache, chats: NameCache) -> None:
+        self.users = users
+        self.chats = chats
+        self.lock = threading.Lock()
+        self.usernames: Dict[str, int] = {}  # username (kichik harflarda) -> uid
+
+    def observe_user(self, user) -> None:
+        if user is None or getattr(user, "is_bot", False):
+            return
+        name = get_username_obj(user)
+        self.users.put(user.id, name)
+        if getattr(user, "username", None):
+            with self.lock:
+                self.usernames[user.username.lower()] = user.id
+        key = uid_str(user.id)
+        with PROFILE_LOCK:
+            prof = profiles.get(key)
+            changed = prof is not None and prof.get("name") != name
+            if changed:
+                prof["name"] = name
+        if changed:
+            persist_profiles(key)
+
+    def observe_chat(self, chat) -> None:
+        if chat is None or getattr(chat, "type", "private") == "private":
+            return
+        if getattr(chat, "title", None):
+            self.chats.put(chat.id, chat.title)
+
+    def find_username(self, username: str) -> Optional[int]:
+        with self.lock:
+            return self.usernames.get(username.lstrip("@").lower())
+
+DIRECTORY = UpdateDirectory(NAME_CACHE, CHAT_TITLES)
+
+@bot.middleware_handler()
+def harvest_update_metadata(bot_instance, update) -> None:
+    for obj in (update.message, update.edited_message, update.callback_query,
+                update.my_chat_member, update.chat_member):
+        if obj is None:
+            continue
+        DIRECTORY.observe_user(getattr(obj, "from_user", None))
+        chat = getattr(obj, "chat", None)
+        if chat is None and getattr(obj, "message", None) is not None:
+            chat = obj.message.chat
+        DIRECTORY.observe_chat(chat)
+    msg = update.message
+    if msg is not None and msg.chat.type == "private" and msg.from_user is not None:
+        # Botga shaxsiy chatda yozgan foydalanuvchiga yana xabar yuborish mumkin
+        # (guruhdagi xabar yoki tugma bosish bloklanmaganini bildirmaydi)
+        mark_unreachable(msg.from_user.id, False)
+    member = update.my_chat_member
+    if member is not None and member.chat.type == "private":
+        # Foydalanuvchi botni bloklasa Telegram "kicked" holatini yuboradi
+        mark_unreachable(member.chat.id, member.new_chat_member.status == "kicked")
+
+def get_chat_title(cid: int) -> str:
+    cid = int(cid)
+    cached = CHAT_TITLES.get(cid)
+    if cached is not None:
+        return cached
+    try:
+        chat = call_api(bot.get_chat, cid)
+        title = chat.title or f"Chat {cid}"
+        CHAT_TITLES.put(cid, title)
+        return title
+    except Exception:
+        CHAT_TITLES.put(cid, f"Chat {cid}", negative=True)
+        return f"Chat {cid}"
+
+def resolve_user_ref(text: str) -> int:
+    """Raqamli ID yoki @username (bot ko'rgan foydalanuvchilar) -> uid. Topilmasa ValueError."""
+    text = (text or "").strip()
+    if text.startswith("@"):
+        uid = DIRECTORY.find_username(text)
+        if uid is None:
+            raise ValueError(text)
+        return uid
+    return int(text)
+
 def get_username_id(uid: int) -> str:
+    uid = int(uid)
+    cached = NAME_CACHE.get(uid)
+    if cached is not None:
+        return cached
     try:
-        ch = bot.get_chat(uid)
+        ch = call_api(bot.get_chat, uid)
         if getattr(ch, "username", None):
-            return f"@{ch.username}"
-        if getattr(ch, "first_name", None):
-            return ch.first_name
-        return str(uid)
+            name = f"@{ch.username}"
+        elif getattr(ch, "first_name", None):
+            name = ch.first_name
+        else:
+            name = str(uid)
+        NAME_CACHE.put(uid, name)
+        return name
     except Exception:
+        NAME_CACHE.put(uid, str(uid), negative=True)
         return str(uid)
 
+def mark_unreachable(uid: int, flag: bool) -> None:
+    """Profilga "xabar yetkazib bo'lmaydi" belgisini qo'yish / olib tashlash"""
+    key = uid_str(uid)
+    with PROFILE_LOCK:
+        prof = profiles.get(key)
+        if prof is None or ("unreachable" in prof) == flag:
+            return
+        if flag:
+            prof["unreachable"] = int(time.time())
+        else:
+            prof.pop("unreachable", None)
+        persist_profiles(key)
+
 def ensure_profile(uid: int, name: str = "") -> Dict[str, Any]:
     key = uid_str(uid)
-    with LOCK:
+    with PROFILE_LOCK:
         if key not in profiles:
             profiles[key] = {
                 "name": name or str(uid),
@@ -172,7 +1495,7 @@ def ensure_profile(uid: int, name: str = "") -> Dict[str, Any]:
                 "games_played": 0,
                 "wins": 0,
             }
-            persist_profiles()
+            persist_profiles(key)
         else:
             prof = profiles[key]
             prof.setdefault("money", 0)
@@ -188,7 +1511,7 @@ def ensure_profile(uid: int, name: str = "") -> Dict[str, Any]:
 def add_bot_message_to_history(chat_id: int, message_id: int) -> None:
     """Bot yuborgan xabarlar ID sini saqlash"""
     key = cid_str(chat_id)
-    with LOCK:
+    with chat_lock(chat_id):
         if key not in bot_message_history:
             bot_message_history[key] = []
         bot_message_history[key].append(message_id)
@@ -202,24 +1525,19 @@ def cleanup_bot_messages(chat_id: int) -> None:
     key = cid_str(chat_id)
     message_ids = []
     
-    with LOCK:
+    with chat_lock(chat_id):
         if key in bot_message_history:
             message_ids = bot_message_history.pop(key, [])
     
     # Har bir xabarni o'chirish
-    for msg_id in message_ids:
-        try:
-            safe_api(bot.delete_message, chat_id, msg_id)
-        except Exception as e:
-            # Agar xabar allaqachon o'chirilgan bo'lsa, xato berishi mumkin
-            pass
+    queue_deletes(chat_id, message_ids)
 
 def cleanup_old_bot_messages(chat_id: int, keep_last: int = 5) -> None:
     """Eski bot xabarlarini o'chirish, faqat oxirgi bir nechtasini saqlash"""
     key = cid_str(chat_id)
     to_delete = []  # Xatoni bartaraf etish uchun
     
-    with LOCK:
+    with chat_lock(chat_id):
         if key in bot_message_history and len(bot_message_history[key]) > keep_last:
             # Eski xabarlarni olish
             to_delete = bot_message_history[key][:-keep_last]
@@ -227,78 +1545,845 @@ def cleanup_old_bot_messages(chat_id: int, keep_last: int = 5) -> None:
             bot_message_history[key] = bot_message_history[key][-keep_last:]
     
     # Eski xabarlarni o'chirish
-    for msg_id in to_delete:
+    queue_deletes(chat_id, to_delete)
+
+def queue_deletes(chat_id: int, message_ids: List[int]) -> None:
+    """O'chirishni navbatga qo'yish: kosmetik, chat limitiga kirmaydi, band paytda tashlanishi mumkin.
+
+    ID lar DELETE_BATCH_SIZE talik deleteMessages so'rovlariga bo'linadi.
+    """
+    ids = sorted(set(message_ids))
+    for i in range(0, len(ids), DELETE_BATCH_SIZE):
+        OUTBOX.call(chat_id, delete_message_batch, chat_id, ids[i:i + DELETE_BATCH_SIZE],
+                    priority=PRIORITY_COSMETIC, per_chat=False)
+
+def delete_message_batch(chat_id: int, message_ids: List[int]) -> Optional[bool]:
+    """Bitta deleteMessages so'rovi; u ishlamasa xabarlar bittalab o'chiriladi.
+
+    Qayta urinish mumkin bo'lgan xatolar (429, timeout) ko'tariladi - OUTBOX
+    butun partiyani o'zi qayta yuboradi.
+    """
+    if len(message_ids) == 1:
+        return call_api(bot.delete_message, chat_id, message_ids[0])
+    try:
+        return call_api(bot.delete_messages, chat_id, message_ids)
+    except Exception as e:
+        if classify_api_error(e)[0] in RETRYABLE_API_ERRORS:
+            raise
+        log_api_error("delete_messages", e)
+    for msg_id in message_ids:
+        OUTBOX.call(chat_id, bot.delete_message, chat_id, msg_id, priority=PRIORITY_COSMETIC, per_chat=False)
+    return None
+
+# YANGI: Obuna tekshirish funksiyalari
+def check_user_subscribed(user_id: int) -> bool:
+    """Foydalanuvchi botga /start bosganligini tekshirish"""
+    try:
+        # Foydalanuvchi profilida "money" maydoni borligini tekshirish
+        # Agar profil mavjud bo'lsa, u /start bosgan deb hisoblanadi
+        ensure_profile(user_id)
+        return True
+    except Exception:
+        return False
+
+# YANGI: Safe send funksiyasi - xabar yuborilganda uni saqlash
+def safe_send_message(chat_id, text, **kwargs):
+    """Xabar yuborish va uni saqlash"""
+    sent_msg = safe_api(bot.send_message, chat_id, text, **kwargs)
+    if sent_msg:
+        add_bot_message_to_history(chat_id, sent_msg.message_id)
+    return sent_msg
+
+def safe_send_and_reply(chat_id, reply_to_msg_id, text, **kwargs):
+    """Xabar yuborish va javob berish"""
+    sent_msg = safe_api(bot.send_message, chat_id, text, reply_to_message_id=reply_to_msg_id, **kwargs)
+    if sent_msg:
+        add_bot_message_to_history(chat_id, sent_msg.message_id)
+    return sent_msg
+
+# Telegram xatolari turlari: qayta urinish mumkin bo'lganlari va darhol voz kechiladiganlari
+API_RETRY_AFTER = "retry_after"  # 429 - parameters.retry_after soniya kutish kerak
+API_TRANSIENT = "transient"      # timeout, aloqa uzilishi, 5xx
+API_PERMANENT = "permanent"      # bot bloklangan, chat topilmadi, /start bosilmagan
+API_STALE = "stale"              # eskirgan callback, o'zgarmagan/o'chirilgan xabar
+API_BAD_REQUEST = "bad_request"
+API_UNKNOWN = "unknown"
+RETRYABLE_API_ERRORS = {API_RETRY_AFTER, API_TRANSIENT}
+
+PERMANENT_PATTERNS = ("bot was blocked", "bot can't initiate conversation", "chat not found",
+                      "user is deactivated", "bot was kicked", "not enough rights", "have no rights",
+                      "group chat was upgraded")
+STALE_PATTERNS = ("query is too old", "query id is invalid", "message is not modified",
+                  "message to delete not found", "message to edit not found", "message can't be deleted")
+
+API_ERRORS: Counter = Counter()  # tur -> soni; "retried" / "dropped" - navbatdagi qayta urinishlar
+API_ERRORS_LOCK = threading.Lock()
+
+def classify_api_error(e: Exception) -> tuple:
+    """(tur, retry_after) - sinxron va asyncio telebot xatolari uchun"""
+    code = getattr(e, "error_code", None)
+    text = str(getattr(e, "description", None) or e).lower()
+    if code == 429:
+        params = (getattr(e, "result_json", None) or {}).get("parameters") or {}
+        return API_RETRY_AFTER, float(params.get("retry_after", 1))
+    if any(p in text for p in STALE_PATTERNS):
+        return API_STALE, 0.0
+    if code == 403 or any(p in text for p in PERMANENT_PATTERNS):
+        return API_PERMANENT, 0.0
+    if (isinstance(code, int) and code >= 500) or isinstance(e, (OSError, TimeoutError)) \
+            or "timed out" in text or "timeout" in text or "connection" in text:
+        return API_TRANSIENT, 0.0
+    if code == 400:
+        return API_BAD_REQUEST, 0.0
+    return API_UNKNOWN, 0.0
+
+def count_api_event(kind: str) -> None:
+    with API_ERRORS_LOCK:
+        API_ERRORS[kind] += 1
+
+def api_error_stats() -> Dict[str, int]:
+    with API_ERRORS_LOCK:
+        return dict(API_ERRORS)
+
+def backoff_delay(attempt: int) -> float:
+    """Jitter'li eksponensial kutish: 0.5, 1, 2, 4 ... (API_BACKOFF_MAX gacha), [50%, 100%] oralig'ida"""
+    return min(API_BACKOFF_BASE * 2 ** attempt, API_BACKOFF_MAX) * random.uniform(0.5, 1.0)
+
+def retry_delay(kind: str, retry_after: float, attempt: int) -> float:
+    # retry_after aynan hurmat qilinadi, qolganlari backoff bilan
+    return retry_after if kind == API_RETRY_AFTER else backoff_delay(attempt)
+
+def call_api(fn, *args, **kwargs):
+    """Telegram so'rovini bajarish (xato ko'tariladi)"""
+    if async_bot is not None and getattr(fn, "__self__", None) is bot and not EVENT_LOOP.in_loop():
+        # asyncio rejimi: barcha Telegram so'rovlari bitta aiohttp sessiyasi orqali
+        return EVENT_LOOP.run(getattr(async_bot, fn.__name__)(*args, **kwargs))
+    return fn(*args, **kwargs)
+
+def safe_api(fn, *args, **kwargs):
+    """So'rov; xatoda None. Navbatdan tashqari chaqiruvlar handler oqimini band qiladi,
+    shuning uchun bu yerda faqat qisqa kutish bilan (SAFE_API_MAX_WAIT) qayta uriniladi;
+    uzoq qayta urinishlar OUTBOX'da."""
+    for attempt in range(SAFE_API_RETRIES + 1):
+        try:
+            return call_api(fn, *args, **kwargs)
+        except Exception as e:
+            kind, retry_after = log_api_error(fn.__name__, e)
+            if kind not in RETRYABLE_API_ERRORS or attempt == SAFE_API_RETRIES:
+                return None
+            delay = retry_delay(kind, retry_after, attempt)
+            if delay > SAFE_API_MAX_WAIT:
+                return None
+            time.sleep(delay)
+
+def log_api_error(name: str, e: Exception) -> tuple:
+    """Xatoni turlash, hisoblash va log qilish; (tur, retry_after) qaytaradi"""
+    kind, retry_after = classify_api_error(e)
+    count_api_event(kind)
+    if kind == API_RETRY_AFTER:
+        logger.info("Telegram limiti (%s): %.0f soniya kutish kerak", name, retry_after)
+    elif kind == API_TRANSIENT:
+        logger.info("Telegram API vaqtinchalik xatosi (%s): %s", name, e)
+    elif kind == API_PERMANENT:
+        logger.debug("Foydalanuvchi/chat mavjud emas yoki bot bloklangan (%s): %s", name, e)
+    elif kind == API_STALE:
+        logger.debug("Callback yoki xabar eskirgan (%s): %s", name, e)
+    else:
+        logger.warning("API call failed: %s, error: %s", name, e)
+    return kind, retry_after
+
+def safe_answer_callback(cb_query, text=None, show_alert=False):
+    try:
+        if text:
+            return safe_api(bot.answer_callback_query, cb_query.id, text, show_alert=show_alert)
+        else:
+            return safe_api(bot.answer_callback_query, cb_query.id)
+    except Exception as e:
+        logger.debug(f"answer_callback failed: {e}")
+        return None
+
+# ============================ CHIQUVCHI XABARLAR ============================
+class KeyedWorkerPool:
+    """Kalit bo'yicha tartiblangan oqimlar pool'i.
+
+    Bitta kalit (chat yoki foydalanuvchi) ishlari qo'yilgan tartibda, bittadan
+    bajariladi; turli kalitlar parallel. Kalit ishini tugatgach navbat oxiriga
+    qaytadi, shuning uchun bitta band chat boshqalarni to'sib qo'ymaydi.
+    max_pending / max_per_key (0 - cheksiz) to'lganda submit() False qaytaradi
+    yoki block=True bo'lsa joy bo'shashini kutadi.
+    """
+
+    def __init__(self, name: str, workers: int, max_pending: int = 0, max_per_key: int = 0) -> None:
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self.max_per_key = max_per_key
+        self.cond = threading.Condition()
+        self.queues: Dict[Any, deque] = {}  # kalit -> (qo'yilgan vaqt, ish)
+        self.ready: deque = deque()  # ishi bor va hech bir oqim bajarmayotgan kalitlar
+        self.threads: List[threading.Thread] = []
+        self.pending = 0
+        self.peak = 0
+        self.done = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.busy_total = 0.0
+
+    def start(self) -> None:
+        # Birinchi ishda ishga tushadi (import va servis buyruqlarida oqim ochilmaydi)
+        if not self.threads:
+            for i in range(self.workers):
+                t = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                t.start()
+                self.threads.append(t)
+
+    def _full(self, key) -> bool:
+        if self.max_pending and self.pending >= self.max_pending:
+            return True
+        q = self.queues.get(key)
+        return bool(self.max_per_key and q and len(q) >= self.max_per_key)
+
+    def submit(self, key, job, block: bool = False, timeout: Optional[float] = None) -> bool:
+        if self.workers <= 0:
+            self._measure(key, (time.monotonic(), job))
+            return True
+        with self.cond:
+            if self._full(key):
+                if not block or not self.cond.wait_for(lambda: not self._full(key), timeout):
+                    self.rejected += 1
+                    return False
+            self.start()
+            q = self.queues.get(key)
+            if q is None:
+                q = self.queues[key] = deque()
+                self.ready.append(key)
+                self.cond.notify_all()
+            q.append((time.monotonic(), job))
+            self.pending += 1
+            self.peak = max(self.peak, self.pending)
+        return True
+
+    def _pick(self):
+        """cond ostida: keyingi (kalit, ish) yoki qancha kutish kerakligi (None - cheksiz)"""
+        if not self.ready:
+            return None
+        key = self.ready.popleft()
+        return key, self.queues[key].popleft()
+
+    def _run(self) -> None:
+        while True:
+            with self.cond:
+                picked = self._pick()
+                while not isinstance(picked, tuple):
+                    self.cond.wait(picked)
+                    picked = self._pick()
+            key, item = picked
+            self._measure(key, item)
+            with self.cond:
+                self.pending -= 1
+                self._release(key)
+                # Bo'sh ishchi, joy kutayotgan submit() va drain() ni uyg'otish
+                self.cond.notify_all()
+
+    def _release(self, key) -> None:
+        """cond ostida: kalit ishi tugadi - navbatda yana ish bo'lsa qaytarish"""
+        if self.queues[key]:
+            self.ready.append(key)
+        else:
+            del self.queues[key]
+
+    def _measure(self, key, item) -> None:
+        queued_at, job = item
+        started = time.monotonic()
+        try:
+            self._execute(key, job)
+        except Exception as e:
+            logger.exception("%s %s error: %s", self.name, key, e)
+        finished = time.monotonic()
+        with self.cond:
+            wait = started - queued_at
+            self.done += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.busy_total += finished - started
+
+    def _execute(self, key, job) -> None:
+        raise NotImplementedError
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """Navbat bo'shaguncha kutish (shutdown va servis buyruqlari uchun)"""
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.pending, timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.cond:
+            return {
+                "pending": self.pending,
+                "peak": self.peak,
+                "done": self.done,
+                "rejected": self.rejected,
+                "wait_avg_ms": self.wait_total / self.done * 1000 if self.done else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+                "busy_avg_ms": self.busy_total / self.done * 1000 if self.done else 0.0,
+            }
+
+# Chiquvchi xabarlar ustuvorligi: rol DM'lari, bosqich xabarlari - CRITICAL;
+# ovoz e'lonlari, tozalash (delete) - COSMETIC; ommaviy xabar - BULK (tashlanmaydi)
+PRIORITY_CRITICAL = 0
+PRIORITY_NORMAL = 1
+PRIORITY_COSMETIC = 2
+PRIORITY_BULK = 3
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = time.monotonic()
+
+    def refill(self, now: float) -> float:
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens
+
+    def delay(self, now: float, need: float = 1.0) -> float:
+        """need ta token yig'ilishi uchun kutish (soniya), 0 - hozir mumkin"""
+        missing = need - self.refill(now)
+        return max(missing, 0.0) / self.rate
+
+class RateLimiter:
+    """Telegram limitlari: umumiy (~30 xabar/s) va har bir chat uchun token bucket'lar.
+
+    Guruhga daqiqasiga ~20 xabar, shaxsiy chatga soniyasiga ~1 xabar. Ustuvorlik
+    umumiy bucket'da zaxira orqali: NORMAL ishlar bucket'da zaxiradan ortiq token
+    bo'lsagina, COSMETIC va BULK esa undan ham ko'p bo'lsagina yuboriladi, shuning
+    uchun band paytda limit birinchi navbatda CRITICAL xabarlarga ketadi, bo'sh
+    paytda esa ommaviy xabar butun limitdan foydalanadi. Thread-safe
+    emas - Outbox.cond ostida ishlatiladi.
+    """
+
+    def __init__(self, global_rate: float, group_per_min: float, group_burst: float, private_rate: float) -> None:
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.reserve = {PRIORITY_CRITICAL: 0.0, PRIORITY_NORMAL: global_rate * 0.1, PRIORITY_COSMETIC: global_rate * 0.3,
+                        PRIORITY_BULK: global_rate * 0.5}
+        self.group = (group_per_min / 60.0, group_burst)
+        self.private = (private_rate, max(private_rate, 1.0))
+        self.chats: Dict[Any, TokenBucket] = {}
+
+    def chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chats.get(chat_id)
+        if bucket is None:
+            if len(self.chats) >= 10000:
+                # To'lgan (uzoq ishlatilmagan) bucket'lar yangisidan farq qilmaydi
+                now = time.monotonic()
+                for k in [k for k, b in self.chats.items() if b.refill(now) >= b.burst]:
+                    del self.chats[k]
+            rate, burst = self.group if int(chat_id) < 0 else self.private
+            bucket = self.chats[chat_id] = TokenBucket(rate, burst)
+        return bucket
+
+    def acquire(self, chat_id, priority: int, per_chat: bool, now: float) -> float:
+        """Token olish; olinmasa qancha kutish kerakligini qaytaradi"""
+        wait = self.global_bucket.delay(now, 1.0 + self.reserve[priority])
+        bucket = self.chat_bucket(chat_id) if per_chat else None
+        if bucket is not None:
+            wait = max(wait, bucket.delay(now))
+        if wait > 0:
+            return max(wait, 0.005)
+        self.global_bucket.tokens -= 1
+        if bucket is not None:
+            bucket.tokens -= 1
+        return 0.0
+
+class Outbox(KeyedWorkerPool):
+    """Chiquvchi Telegram so'rovlari navbati (cheksiz, faqat eskirgan COSMETIC tashlanadi).
+
+    Handlerlar holatni lock ostida o'zgartiradi va yuborishni shu yerga qo'yadi;
+    oqimlar navbatni hech qanday lock ushlamasdan bo'shatadi. Manzil - guruh
+    yoki foydalanuvchi. Yuborilgan xabar kerak bo'lsa (join_msg_id, vote_msg_id)
+    u on_done callback orqali olinadi: callback o'sha manzilning keyingi
+    so'rovidan oldin chaqiriladi.
+
+    Har bir so'rov RateLimiter'dan token oladi. Token bo'lmasa manzil kutish
+    heap'iga o'tadi (oqim uxlamaydi, boshqa manzillar bilan ishlaydi). Manzil
+    navbatidagi eng yuqori ustuvorlik hisobga olinadi, shuning uchun CRITICAL
+    xabar o'z chatidagi oldingi xabarlarni ham o'zi bilan olib o'tadi.
+    OUTBOX_COSMETIC_TTL dan ko'p kutgan COSMETIC so'rov yuborilmaydi (shed).
+    """
+
+    def __init__(self, workers: int) -> None:
+        super().__init__("outbox", workers)
+        self.limiter = RateLimiter(RATE_GLOBAL, RATE_GROUP_PER_MIN, RATE_GROUP_BURST, RATE_PRIVATE)
+        self.delayed: List[tuple] = []  # (qachon, seq, manzil)
+        self.delay_seq = itertools.count()
+        self.throttled = 0
+        self.shed = 0
+        self.retry_at: Dict[Any, float] = {}  # qayta urinish kutayotgan manzillar
+
+    def call(self, target, fn, *args, on_done=None, priority: int = PRIORITY_NORMAL,
+             per_chat: bool = True, **kwargs) -> None:
+        """fn(*args, **kwargs) ni target navbatiga qo'yish; natija (xatoda None) on_done ga beriladi.
+
+        per_chat=False - chat limitiga kirmaydigan so'rovlar (delete), faqat umumiy limit.
+        """
+        self.submit(target, (fn, args, kwargs, on_done, priority, per_chat, 0))
+
+    def send(self, chat_id, text, on_sent=None, track: bool = True,
+             priority: int = PRIORITY_NORMAL, **kwargs) -> None:
+        """send_message ni navbatga qo'yish. track=True - xabar bot_message_history ga yoziladi"""
+        def on_done(sent):
+            if sent and track:
+                add_bot_message_to_history(chat_id, sent.message_id)
+            if on_sent:
+                on_sent(sent)
+        self.call(chat_id, bot.send_message, chat_id, text, on_done=on_done, priority=priority, **kwargs)
+
+    def _admit(self, key, q: deque, now: float) -> float:
+        """cond ostida: navbat boshidagi ishga ruxsat (0) yoki kutish vaqti"""
+        while q and q[0][1][4] == PRIORITY_COSMETIC and now - q[0][0] > OUTBOX_COSMETIC_TTL:
+            q.popleft()
+            self.pending -= 1
+            self.shed += 1
+            self.cond.notify_all()
+        if not q:
+            return 0.0
+        priority = min(job[4] for _, job in q)
+        wait = self.limiter.acquire(key, priority, q[0][1][5], now)
+        self.throttled += wait > 0
+        return wait
+
+    def _pick(self):
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            self.ready.append(heapq.heappop(self.delayed)[2])
+        for _ in range(len(self.ready)):
+            key = self.ready.popleft()
+            q = self.queues[key]
+            wait = self._admit(key, q, now)
+            if not q:
+                del self.queues[key]
+            elif wait:
+                heapq.heappush(self.delayed, (now + wait, next(self.delay_seq), key))
+            else:
+                return key, q.popleft()
+        return self.delayed[0][0] - now if self.delayed else None
+
+    def _release(self, key) -> None:
+        retry_at = self.retry_at.pop(key, None)
+        if retry_at is None:
+            super()._release(key)
+        else:
+            heapq.heappush(self.delayed, (retry_at, next(self.delay_seq), key))
+            self.cond.notify_all()
+
+    def attempt(self, target, job):
+        """So'rovni bajarish: (natija, None) yoki qayta urinish kerak bo'lsa (None, kutish)"""
+        fn, args, kwargs = job[:3]
+        try:
+            return call_api(fn, *args, **kwargs), None
+        except Exception as e:
+            return None, self.failed(target, job, e)
+
+    def failed(self, target, job, e: Exception) -> Optional[float]:
+        """Xato: qayta urinish kerak bo'lsa kutish vaqti, aks holda None (permanent/stale - darhol)"""
+        name, attempts = job[0].__name__, job[6]
+        kind, retry_after = log_api_error(name, e)
+        if kind == API_PERMANENT and name == "send_message" and int(target) > 0:
+            # Bloklagan / o'chirilgan foydalanuvchi: keyingi ommaviy xabarlarda o'tkazib yuboriladi
+            mark_unreachable(target, True)
+        if kind not in RETRYABLE_API_ERRORS:
+            return None
+        if attempts >= OUTBOX_MAX_RETRIES:
+            count_api_event("dropped")
+            logger.warning("%s: %d urinishdan keyin yuborilmadi (%s)", name, attempts + 1, kind)
+            return None
+        count_api_event("retried")
+        if kind == API_RETRY_AFTER and job[5]:
+            # Shu chatga keyingi xabarlar ham limit tiklanguncha kutadi
+            with self.cond:
+                bucket = self.limiter.chat_bucket(target)
+                bucket.tokens = min(bucket.tokens, 0.0)
+        return retry_delay(kind, retry_after, attempts)
+
+    def _execute(self, target, job) -> None:
+        result, delay = self.attempt(target, job)
+        while delay is not None and self.workers <= 0:
+            # Sinxron rejim: shu joyning o'zida kutib qayta urinish
+            time.sleep(delay)
+            job = job[:6] + (job[6] + 1,)
+            result, delay = self.attempt(target, job)
+        if delay is not None:
+            # Navbat boshiga qaytadi - shu manzildagi tartib buzilmaydi
+            with self.cond:
+                self.queues[target].appendleft((time.monotonic(), job[:6] + (job[6] + 1,)))
+                self.pending += 1
+                self.retry_at[target] = time.monotonic() + delay
+            return
+        on_done = job[3]
+        if on_done:
+            on_done(result)
+
+    def stats(self) -> Dict[str, Any]:
+        data = super().stats()
+        with self.cond:
+            by_priority = Counter(job[4] for q in self.queues.values() for _, job in q)
+            data.update({
+                "critical": by_priority[PRIORITY_CRITICAL],
+                "normal": by_priority[PRIORITY_NORMAL],
+                "cosmetic": by_priority[PRIORITY_COSMETIC],
+                "bulk": by_priority[PRIORITY_BULK],
+                "throttled": self.throttled,
+                "shed": self.shed,
+                "tokens": self.limiter.global_bucket.refill(time.monotonic()),
+            })
+        return data
+
+class AsyncOutbox(Outbox):
+    """asyncio rejimi: har bir manzil navbati event loop'dagi alohida task.
+
+    Oqimlar o'rniga korutinalar: minglab manzillarga yuborish bir vaqtda
+    (gather kabi) ketadi, bitta manzil ichida esa tartib saqlanadi. bot
+    metodlari AsyncTeleBot orqali, boshqa ishlar (edit_registration_message)
+    executor'da bajariladi.
+    """
+
+    def __init__(self, loop_thread: EventLoopThread, client) -> None:
+        super().__init__(0)
+        self.loop_thread = loop_thread
+        self.client = client
+
+    def submit(self, key, job, block: bool = False, timeout: Optional[float] = None) -> bool:
+        with self.cond:
+            q = self.queues.get(key)
+            spawn = q is None
+            if spawn:
+                q = self.queues[key] = deque()
+            q.append((time.monotonic(), job))
+            self.pending += 1
+            self.peak = max(self.peak, self.pending)
+        if spawn:
+            self.loop_thread.call_soon(self.loop_thread.loop.create_task, self._drain_key(key))
+        return True
+
+    async def _drain_key(self, key) -> None:
+        while True:
+            with self.cond:
+                q = self.queues[key]
+                wait = self._admit(key, q, time.monotonic())
+                if not q:
+                    del self.queues[key]
+                    return
+                if not wait:
+                    queued_at, job = q.popleft()
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            started = time.monotonic()
+            try:
+                await self._execute_async(key, job)
+            except Exception as e:
+                logger.exception("%s %s error: %s", self.name, key, e)
+            finished = time.monotonic()
+            with self.cond:
+                self.pending -= 1
+                self.done += 1
+                self.wait_total += started - queued_at
+                self.wait_max = max(self.wait_max, started - queued_at)
+                self.busy_total += finished - started
+                self.cond.notify_all()
+
+    async def _execute_async(self, target, job) -> None:
+        fn, args, kwargs, on_done = job[:4]
+        loop = asyncio.get_running_loop()
+        while True:
+            if getattr(fn, "__self__", None) is bot:
+                result, delay = await self.attempt_async(target, job)
+            else:
+                result, delay = await loop.run_in_executor(None, functools.partial(self.attempt, target, job))
+            if delay is None:
+                break
+            # Bu task faqat shu manzilniki: kutish boshqa manzillarni to'xtatmaydi, tartib saqlanadi
+            await asyncio.sleep(delay)
+            job = job[:6] + (job[6] + 1,)
+        if on_done:
+            # on_done chat_lock oladi va get_chat qilishi mumkin - loop'da emas, executor oqimida;
+            # await tartibni saqlaydi (shu manzilning keyingi so'rovi undan keyin)
+            await loop.run_in_executor(None, on_done, result)
+
+    async def attempt_async(self, target, job):
+        fn, args, kwargs = job[:3]
+        try:
+            return await getattr(self.client, fn.__name__)(*args, **kwargs), None
+        except Exception as e:
+            return None, self.failed(target, job, e)
+
+OUTBOX = AsyncOutbox(EVENT_LOOP, async_bot) if EVENT_LOOP else Outbox(OUTBOX_WORKERS)
+# atexit teskari tartibda ishlaydi: navbat persistence flush'dan oldin bo'shatiladi
+atexit.register(OUTBOX.drain, 5)
+
+def send_game_message(chat_id: int, text: str, field: Optional[str] = None, on_sent=None,
+                      priority: int = PRIORITY_CRITICAL, **kwargs) -> None:
+    """O'yin xabarini navbat orqali yuborish; ID o'yinning bot_messages (va field) ga yoziladi.
+
+    O'yin obyekti hozir olinadi: xabar yuborilguncha o'yin tugasa ham ID
+    yakuniy tozalash ro'yxatiga tushadi.
+    """
+    key = cid_str(chat_id)
+    game = games.get(key)
+
+    def record(sent):
+        if sent and game is not None:
+            with chat_lock(chat_id):
+                game["bot_messages"].append(sent.message_id)
+                if field:
+                    game[field] = sent.message_id
+                if games.get(key) is game:
+                    persist_games(key)
+        if on_sent:
+            on_sent(sent)
+    OUTBOX.send(chat_id, text, on_sent=record, priority=priority, **kwargs)
+
+def fan_out(messages: Dict[int, tuple], on_complete=None, priority: int = PRIORITY_CRITICAL) -> None:
+    """Shaxsiy xabarlar to'plamini bir vaqtda yuborish: uid -> (matn, kwargs).
+
+    Har bir xabar o'z manzili navbatiga tushadi - manzillar parallel va
+    RateLimiter ichida yuboriladi. Hammasi yakunlangach (xatolar qayta
+    urinishlardan keyin) on_complete({uid: Message yoki None}) chaqiriladi.
+    """
+    results: Dict[int, Any] = {}
+    lock = threading.Lock()
+
+    def done(uid: int, sent) -> None:
+        with lock:
+            results[uid] = sent
+            last = len(results) == len(messages)
+        if last and on_complete:
+            on_complete(results)
+
+    if not messages and on_complete:
+        on_complete(results)
+    for uid, (text, kwargs) in messages.items():
+        OUTBOX.send(uid, text, on_sent=functools.partial(done, uid), track=False, priority=priority, **kwargs)
+
+def report_unreachable(chat_id: int, results: Dict[int, Any]) -> None:
+    """fan_out natijasi: xabar yetmagan o'yinchilarni guruhga bildirish"""
+    missing = [uid for uid, sent in results.items() if sent is None]
+    game = games.get(cid_str(chat_id))
+    if not missing or not game or game.get("state") != "started":
+        return
+    names = ", ".join(get_username_id(uid) for uid in missing)
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🤖 Botga o'tish", url=f"https://t.me/{BOT_USERNAME}"))
+    send_game_message(chat_id, f"📵 *XABAR YETMADI:* {names}\n\nBotga /start yozing va bloklamang!",
+                      reply_markup=kb)
+
+# ============================ CHAT MAILBOX'LARI ============================
+class ChatActors(KeyedWorkerPool):
+    """Har bir chat uchun mailbox: o'yin hodisalari shu chat navbatida ketma-ket bajariladi.
+
+    Callback'lar, taymerlar va admin amallari (o'yinni to'xtatish) mailbox'ga
+    xabar sifatida qo'yiladi, shuning uchun bitta o'yin holatini bir vaqtda
+    faqat bitta oqim o'zgartiradi, turli chatlar esa parallel ishlaydi.
+    chat_lock qoladi - u o'yinni mailbox'dan tashqarida o'qiydiganlar (admin
+    panel, persist) uchun; mailbox ichida u raqobatsiz.
+    """
+
+    def __init__(self, workers: int) -> None:
+        super().__init__("chat", workers)
+        self.local = threading.local()
+
+    def current(self) -> Optional[int]:
+        """Joriy oqim hozir bajarayotgan mailbox (chat ID) yoki None"""
+        return getattr(self.local, "chat", None)
+
+    def post(self, chat_id: int, fn, *args, **kwargs) -> None:
+        self.submit(int(chat_id), (fn, args, kwargs))
+
+    def _execute(self, chat_id, job) -> None:
+        fn, args, kwargs = job
+        self.local.chat = chat_id
         try:
-            safe_api(bot.delete_message, chat_id, msg_id)
-        except Exception:
-            pass
+            fn(*args, **kwargs)
+        finally:
+            self.local.chat = None
 
-# YANGI: Obuna tekshirish funksiyalari
-def check_user_subscribed(user_id: int) -> bool:
-    """Foydalanuvchi botga /start bosganligini tekshirish"""
-    try:
-        # Foydalanuvchi profilida "money" maydoni borligini tekshirish
-        # Agar profil mavjud bo'lsa, u /start bosgan deb hisoblanadi
-        ensure_profile(user_id)
-        return True
-    except Exception:
-        return False
+ACTORS = ChatActors(CHAT_WORKERS)
+atexit.register(ACTORS.drain, 5)
 
-# YANGI: Safe send funksiyasi - xabar yuborilganda uni saqlash
-def safe_send_message(chat_id, text, **kwargs):
-    """Xabar yuborish va uni saqlash"""
-    sent_msg = safe_api(bot.send_message, chat_id, text, **kwargs)
-    if sent_msg:
-        add_bot_message_to_history(chat_id, sent_msg.message_id)
-    return sent_msg
+def in_chat_actor(chat_of):
+    """Funksiyani chat mailbox'ida bajarish. chat_of(*args) - chat ID ni topadi.
 
-def safe_send_and_reply(chat_id, reply_to_msg_id, text, **kwargs):
-    """Xabar yuborish va javob berish"""
-    sent_msg = safe_api(bot.send_message, chat_id, text, reply_to_message_id=reply_to_msg_id, **kwargs)
-    if sent_msg:
-        add_bot_message_to_history(chat_id, sent_msg.message_id)
-    return sent_msg
+    Shu chat mailbox'i ichidan chaqirilsa darhol bajariladi (masalan
+    check_victory -> send_final_stats_and_cleanup), aks holda navbatga qo'yiladi.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            chat_id = int(chat_of(*args, **kwargs))
+            if ACTORS.current() == chat_id:
+                return fn(*args, **kwargs)
+            ACTORS.post(chat_id, fn, *args, **kwargs)
+        return wrapper
+    return decorator
 
-def safe_api(fn, *args, **kwargs):
-    try:
-        return fn(*args, **kwargs)
-    except Exception as e:
-        error_msg = str(e).lower()
-        
-        if "bot can't initiate conversation" in error_msg:
-            logger.debug("Foydalanuvchi botga /start yozmagan. Xabar yuborish mumkin emas.")
-            return None
-        
-        elif "query is too old" in error_msg or "query id is invalid" in error_msg:
-            logger.debug("Callback query eskirgan yoki noto'g'ri ID.")
-            return None
-        
-        elif "connection aborted" in error_msg or "connection reset" in error_msg:
-            logger.debug("Internet aloqasi uzildi.")
-            return None
-        
-        elif "read timed out" in error_msg or "timeout" in error_msg:
-            logger.debug("Telegram API ga murojaat vaqti tugadi.")
-            return None
-        
-        elif "api was unsuccessful" in error_msg:
-            logger.debug(f"Telegram API xatosi: {e}")
-            return None
-        
-        else:
-            logger.debug(f"API call failed: {fn.__name__}, error: {e}")
-            return None
+def chat_of_arg(chat_id, *args, **kwargs) -> int:
+    return chat_id
 
-def safe_answer_callback(cb_query, text=None, show_alert=False):
+def chat_of_message(msg) -> int:
+    return msg.chat.id
+
+def callback_game_chat(call) -> int:
+    """Tungi tugmalar o'yinchining shaxsiy chatiga yuboriladi - o'yin chatini indeksdan topish"""
+    game_chat = getattr(call, "game_chat", None)  # game_button tokendan topgan chat
+    if game_chat is not None:
+        return game_chat
+    if call.message.chat.type == "private":
+        chat_id = player_game_chat(call.from_user.id)
+        if chat_id is not None:
+            return chat_id
+    return call.message.chat.id
+
+def start_join_chat(msg) -> int:
+    """/start join_<chat_id> - qo'shilinadigan guruh ID si"""
     try:
-        if text:
-            return safe_api(bot.answer_callback_query, cb_query.id, text, show_alert=show_alert)
-        else:
-            return safe_api(bot.answer_callback_query, cb_query.id)
-    except Exception as e:
-        logger.debug(f"answer_callback failed: {e}")
+        return int(msg.text.strip().split('join_')[1])
+    except (IndexError, ValueError):
+        return msg.chat.id
+
+chat_timers: Dict[tuple, object] = {}  # (chat, tur) -> oxirgi qo'yilgan taymer belgisi
+
+def schedule_chat_timer(chat_id: int, kind: str, delay: float, fn, *args) -> None:
+    """Muddat kelganda fn(chat_id, *args) chat mailbox'iga qo'yiladi.
+
+    Taymer otilgan, lekin mailbox'da navbat kutayotgan paytda qayta qo'yilsa
+    yoki bekor qilinsa, eski chaqiruv bajarilmaydi.
+    """
+    key = (cid_str(chat_id), kind)
+    token = object()
+    chat_timers[key] = token
+
+    def fire():
+        if chat_timers.get(key) is token:
+            del chat_timers[key]
+            fn(chat_id, *args)
+    SCHEDULER.schedule(key, delay, lambda: ACTORS.post(chat_id, fire))
+
+def cancel_chat_timer(chat_id: int, kind: str) -> None:
+    key = (cid_str(chat_id), kind)
+    chat_timers.pop(key, None)
+    SCHEDULER.cancel(key)
+
+# ============================ MARSHRUTLASH ============================
+class Router:
+    """Callback va shaxsiy menyu matnlarini lug'at orqali handlerga yo'naltirish.
+
+    telebot har bir update'ni barcha func=lambda filtrlaridan ro'yxat
+    tartibida o'tkazadi - handler qo'shilgan sari narx oshadi. Bu yerda
+    callback_data bir marta (nom, argument) ga ajratiladi va handler
+    lug'atdan olinadi: aniq nom, "nom:arg" yoki "nom_arg" (admin_, buy_).
+    Natija call.route ga yoziladi. Menyu matni ham lug'atda ("🛡 Himoya
+    sotib olish (100 so'm)" kabi tugmalar " (" gacha qismi bo'yicha).
+    waiting_* holatlari soni o'zgarmas: ular ro'yxatdagi tartibda
+    tekshiriladi. Har bir marshrut uchun bajarilish vaqti hisoblanadi.
+    """
+
+    def __init__(self) -> None:
+        self.callbacks: Dict[str, Any] = {}
+        self.texts: Dict[str, Any] = {}
+        self.states: List[tuple] = []  # (holat lug'ati, qiymat sharti, faqat shaxsiy chat, handler)
+        self.lock = threading.Lock()
+        self.timing: Dict[str, List[float]] = {}  # handler -> [soni, umumiy vaqt, eng ko'p]
+        self.unmatched = 0
+
+    def callback(self, *names: str):
+        """names: aniq callback_data, "nom" ("nom:arg" uchun) yoki "nom_" ("nom_arg" uchun)"""
+        def register(fn):
+            for name in names:
+                self.callbacks[name] = fn
+            return fn
+        return register
+
+    def text(self, *texts: str):
+        def register(fn):
+            for text in texts:
+                self.texts[text] = fn
+            return fn
+        return register
+
+    def state(self, waiting: Dict[int, Any], check=None, private: bool = False):
+        """waiting da turgan foydalanuvchining istalgan matni (check(qiymat) - qo'shimcha shart)"""
+        def register(fn):
+            self.states.append((waiting, check, private, fn))
+            return fn
+        return register
+
+    def parse(self, data: str) -> Optional[tuple]:
+        """callback_data -> (handler, nom, argument) yoki None"""
+        fn = self.callbacks.get(data)
+        if fn is not None:
+            return fn, data, ""
+        name, _, args = data.partition(":")
+        fn = self.callbacks.get(name) if args else None
+        if fn is not None:
+            return fn, name, args
+        name, _, args = data.partition("_")
+        fn = self.callbacks.get(name + "_")
+        if fn is not None:
+            return fn, name + "_", args
+        return None
+
+    def message_route(self, msg):
+        uid = msg.from_user.id
+        private = msg.chat.type == "private"
+        for waiting, check, only_private, fn in self.states:
+            if uid in waiting and (private or not only_private) and (check is None or check(waiting.get(uid))):
+                return fn
+        if private and msg.text:
+            return self.texts.get(msg.text) or self.texts.get(msg.text.split(" (", 1)[0])
         return None
 
+    def match_message(self, msg) -> bool:
+        """telebot filtri: marshrut bir marta topiladi va msg.route ga yoziladi"""
+        msg.route = self.message_route(msg)
+        return msg.route is not None
+
+    def dispatch_message(self, msg) -> None:
+        self._timed(msg.route, msg)
+
+    def dispatch_callback(self, call) -> None:
+        route = self.parse(call.data or "")
+        if route is None:
+            with self.lock:
+                self.unmatched += 1
+            return
+        fn, name, args = route
+        call.route = (name, args)
+        self._timed(fn, call)
+
+    def _timed(self, fn, obj) -> None:
+        started = time.perf_counter()
+        try:
+            fn(obj)
+        finally:
+            # in_chat_actor handlerlari uchun - mailbox'ga qo'yish vaqti
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                t = self.timing.setdefault(fn.__name__, [0, 0.0, 0.0])
+                t[0] += 1
+                t[1] += elapsed
+                t[2] = max(t[2], elapsed)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            routes = {name: {"count": n, "avg_ms": total / n * 1000, "max_ms": peak * 1000}
+                      for name, (n, total, peak) in self.timing.items()}
+            return {"routes": routes, "unmatched": self.unmatched}
+
+ROUTER = Router()
+# Barcha callback'lar bitta handler orqali
+bot.callback_query_handler(func=lambda c: True)(ROUTER.dispatch_callback)
+
 # ============================ INLINE TUGMALAR (ADMIN PANEL) ============================
 def admin_panel_markup() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=2)
@@ -322,21 +2407,16 @@ def admin_panel_markup() -> types.InlineKeyboardMarkup:
 
 def admin_games_markup() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=2)
-    with LOCK:
+    with GAMES_LOCK:
         active_games = [(cid, g) for cid, g in games.items() if g.get("state") == "started"]
     
     if active_games:
         for cid, game in active_games[:5]:
-            chat_title = f"Chat {cid}"
-            try:
-                chat = bot.get_chat(int(cid))
-                chat_title = chat.title[:20] if chat.title else f"Chat {cid}"
-            except:
-                pass
+            chat_title = get_chat_title(int(cid))[:20]
             
             kb.add(types.InlineKeyboardButton(
                 f"⏹ {chat_title}", 
-                callback_data=f"admin_endgame:{cid}"
+                callback_data=f"admin_endgame:{game['token']}"
             ))
     
     kb.add(
@@ -347,7 +2427,7 @@ def admin_games_markup() -> types.InlineKeyboardMarkup:
 
 def admin_users_markup(page: int = 0) -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=2)
-    with LOCK:
+    with PROFILE_LOCK:
         user_list = list(profiles.items())
     
     items_per_page = 5
@@ -376,7 +2456,7 @@ def admin_users_markup(page: int = 0) -> types.InlineKeyboardMarkup:
 
 def admin_payments_markup() -> types.InlineKeyboardMarkup:
     kb = types.InlineKeyboardMarkup(row_width=2)
-    with LOCK:
+    with PROFILE_LOCK:
         pending_orders = [o for o in diamond_orders.values() if o.get("status") == "pending"]
     
     if pending_orders:
@@ -477,14 +2557,6 @@ def funny_day_message(victim_name: str = None) -> str:
         ]
     return random.choice(messages)
 
-def funny_vote_message(voter: str, target: str) -> str:
-    messages = [
-        f"🗳 {voter} ovoz berdi!\n👀 Kimga? {target}ga!",
-        f"📢 {voter}: 'Men {target}ga ishonmayman!'",
-        f"🎤 {voter}ning qo'li ko'tarildi!\nMaqsad: {target}"
-    ]
-    return random.choice(messages)
-
 def funny_execution_message(victim: str, role: str) -> str:
     messages = [
         f"⚖️ *HUKM CHIQDI!*\n\n😬 {victim} qatl qilindi!\nU aslida: {role} edi!",
@@ -551,8 +2623,8 @@ def admin_cmd(msg):
         safe_send_and_reply(msg.chat.id, msg.message_id, "🚫 Bu buyruq faqat adminlar uchun!")
         return
     
-    with LOCK:
-        active_games = sum(1 for g in games.values() if g.get("state") == "started")
+    active_games = active_games_count()
+    with PROFILE_LOCK:
         pending_orders = sum(1 for o in diamond_orders.values() if o.get("status") == "pending")
     
     admin_text = (
@@ -568,7 +2640,7 @@ def admin_cmd(msg):
     safe_api(bot.send_message, uid, admin_text, reply_markup=admin_panel_markup())
 
 # ============================ ADMIN CALLBACK HANDLERS ============================
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith('admin_'))
+@ROUTER.callback("admin_")
 def admin_callback_handler(call):
     uid = call.from_user.id
     if uid not in ADMIN_IDS:
@@ -578,8 +2650,8 @@ def admin_callback_handler(call):
     data = call.data
     
     if data == "admin_back":
-        with LOCK:
-            active_games = sum(1 for g in games.values() if g.get("state") == "started")
+        active_games = active_games_count()
+        with PROFILE_LOCK:
             pending_orders = sum(1 for o in diamond_orders.values() if o.get("status") == "pending")
         
         admin_text = (
@@ -599,7 +2671,7 @@ def admin_callback_handler(call):
         safe_answer_callback(call)
     
     elif data == "admin_games":
-        active_games = sum(1 for g in games.values() if g.get("state") == "started")
+        active_games = active_games_count()
         text = f"🎮 *FAOL O'YINLAR: {active_games} ta*\n\n"
         
         if active_games > 0:
@@ -656,7 +2728,7 @@ def admin_callback_handler(call):
         safe_answer_callback(call)
     
     elif data == "admin_payments":
-        with LOCK:
+        with PROFILE_LOCK:
             pending = sum(1 for o in diamond_orders.values() if o.get("status") == "pending")
         
         text = f"💎 *KUTILAYOTGAN TO'LOVLAR: {pending} ta*\n\n"
@@ -675,7 +2747,7 @@ def admin_callback_handler(call):
     elif data.startswith("admin_payment:"):
         user_id = int(data.split(":")[1])
         
-        with LOCK:
+        with PROFILE_LOCK:
             order_id = next((oid for oid, o in diamond_orders.items() 
                            if o["user_id"] == user_id and o["status"] == "pending"), None)
             order = diamond_orders.get(order_id)
@@ -709,18 +2781,19 @@ def admin_callback_handler(call):
     
     elif data.startswith("admin_confirm:"):
         user_id = int(data.split(":")[1])
+        name = get_username_id(user_id)
         
-        with LOCK:
+        with PROFILE_LOCK:
             order_id = next((oid for oid, o in diamond_orders.items() 
                            if o["user_id"] == user_id and o["status"] == "pending"), None)
             order = diamond_orders.get(order_id)
             
             if order:
-                prof = ensure_profile(user_id, get_username_id(user_id))
+                prof = ensure_profile(user_id, name)
                 prof["diamonds"] += order["count"]
                 waiting_for_check.pop(user_id, None)
                 diamond_orders.pop(order_id, None)
-                persist_profiles()
+                persist_profiles(user_id)
         
         safe_api(bot.send_message, user_id,
                 f"🎉 *TO'LOVINGIZ TASDIQLANDI!*\n\n"
@@ -732,19 +2805,19 @@ def admin_callback_handler(call):
                 call.message.chat.id,
                 call.message.message_id)
         
-        threading.Timer(2, lambda: bot.edit_message_text(
+        SCHEDULER.call_later(2, lambda: bot.edit_message_text(
             "👑 *ADMIN PANELI*\n\nTo'lov muvaffaqiyatli tasdiqlandi!",
             call.message.chat.id,
             call.message.message_id,
             reply_markup=admin_panel_markup()
-        )).start()
+        ))
         
         safe_answer_callback(call, "✅ To'lov tasdiqlandi!")
     
     elif data.startswith("admin_cancel:"):
         user_id = int(data.split(":")[1])
         
-        with LOCK:
+        with PROFILE_LOCK:
             order_id = next((oid for oid, o in diamond_orders.items() 
                            if o["user_id"] == user_id and o["status"] == "pending"), None)
             if order_id:
@@ -760,15 +2833,21 @@ def admin_callback_handler(call):
                 call.message.chat.id,
                 call.message.message_id)
         
-        threading.Timer(2, lambda: bot.edit_message_text(
+        SCHEDULER.call_later(2, lambda: bot.edit_message_text(
             "👑 *ADMIN PANELI*\n\nTo'lov bekor qilindi!",
             call.message.chat.id,
             call.message.message_id,
             reply_markup=admin_panel_markup()
-        )).start()
+        ))
         
         safe_answer_callback(call, "❌ To'lov bekor qilindi!")
     
+    elif data == "admin_broadcast_cancel":
+        if BROADCASTER.cancel():
+            safe_answer_callback(call, "⏹ To'xtatilmoqda...")
+        else:
+            safe_answer_callback(call, "Xabar yuborish allaqachon tugagan")
+    
     elif data == "admin_broadcast":
         waiting_for_broadcast[uid] = True
         safe_api(bot.edit_message_text,
@@ -782,7 +2861,7 @@ def admin_callback_handler(call):
         waiting_for_admin_add[uid] = True
         safe_api(bot.edit_message_text,
                 "➕ *ADMIN QO'SHISH*\n\n"
-                "Qo'shmoqchi bo'lgan adminning ID raqamini yozing:",
+                "Qo'shmoqchi bo'lgan adminning ID raqamini yoki @username ini yozing:",
                 call.message.chat.id,
                 call.message.message_id)
         safe_answer_callback(call)
@@ -797,12 +2876,12 @@ def admin_callback_handler(call):
         safe_answer_callback(call)
     
     elif data.startswith("admin_endgame:"):
-        chat_id = int(data.split(":")[1])
-        
-        with LOCK:
-            game = games.get(cid_str(chat_id))
+        # Token bo'yicha: ro'yxat eskirgan bo'lsa shu chatdagi yangi o'yin to'xtatilmaydi
+        key = game_tokens.get(data.split(":")[1])
+        game = games.get(key) if key else None
         
         if game and game.get("state") == "started":
+            chat_id = int(key)
             send_final_stats_and_cleanup(chat_id, "Admin tomonidan to'xtatildi")
             text = "✅ O'yin muvaffaqiyatli to'xtatildi!"
         else:
@@ -812,22 +2891,33 @@ def admin_callback_handler(call):
                 call.message.chat.id,
                 call.message.message_id)
         
-        threading.Timer(2, lambda: bot.edit_message_text(
+        SCHEDULER.call_later(2, lambda: bot.edit_message_text(
             "👑 *ADMIN PANELI*",
             call.message.chat.id,
             call.message.message_id,
             reply_markup=admin_panel_markup()
-        )).start()
+        ))
         
         safe_answer_callback(call, text)
     
     elif data == "admin_stats":
-        with LOCK:
+        with PROFILE_LOCK:
             total_players = len(profiles)
             total_money = sum(p.get("money", 0) for p in profiles.values())
             total_diamonds = sum(p.get("diamonds", 0) for p in profiles.values())
-            active_games = sum(1 for g in games.values() if g.get("state") == "started")
             pending_orders = sum(1 for o in diamond_orders.values() if o.get("status") == "pending")
+        active_games = active_games_count()
+        with PERSIST_LOCK:
+            finished_games = history_stats.get("games", 0)
+            winners = dict(history_stats.get("winners", {}))
+            duration = history_stats.get("duration", {})
+            avg_minutes = duration.get("total", 0) / duration["count"] / 60 if duration.get("count") else 0
+        names = NAME_CACHE.stats()
+        sched = SCHEDULER.stats()
+        outbox = OUTBOX.stats()
+        updates = UPDATES.stats()
+        api_errors = api_error_stats()
+        http = HTTP.stats()
         
         text = (
             "📊 *BOT STATISTIKASI*\n\n"
@@ -835,8 +2925,23 @@ def admin_callback_handler(call):
             f"💰 Umumiy pul: {total_money} so'm\n"
             f"💎 Umumiy olmoslar: {total_diamonds} ta\n"
             f"🎮 Faol o'yinlar: {active_games} ta\n"
+            f"🏁 Tugagan o'yinlar: {finished_games} ta\n"
+            f"🔪 Mafiya / 👨🏼 Tinchlar g'alabasi: {winners.get('Мафия', 0)} / {winners.get('Мирные жители', 0)}\n"
+            f"⏱ O'rtacha o'yin: {avg_minutes:.1f} daqiqa\n"
             f"⏳ Kutilayotgan to'lovlar: {pending_orders} ta\n"
-            f"👑 Adminlar: {len(ADMIN_IDS)} ta\n\n"
+            f"👑 Adminlar: {len(ADMIN_IDS)} ta\n"
+            f"🗂 Ismlar keshi: {names['size']} ta ({names['hits']} hit / {names['misses']} miss)\n"
+            f"⏲ Taymerlar: {sched['pending']} ta, kechikish {sched['late_avg_ms']:.1f} / {sched['late_max_ms']:.1f} ms\n"
+            f"📮 Navbat: {outbox['pending']} ta ({outbox['critical']} muhim / {outbox['cosmetic']} kosmetik), "
+            f"kutish {outbox['wait_avg_ms']:.1f} / {outbox['wait_max_ms']:.1f} ms\n"
+            f"🚦 Limit: {outbox['throttled']} marta kutildi, {outbox['shed']} kosmetik tashlandi\n"
+            f"⚠️ API xatolari: 429 {api_errors.get(API_RETRY_AFTER, 0)}, vaqtinchalik {api_errors.get(API_TRANSIENT, 0)}, "
+            f"doimiy {api_errors.get(API_PERMANENT, 0)}; qayta {api_errors.get('retried', 0)}, "
+            f"yo'qolgan {api_errors.get('dropped', 0)}\n"
+            f"📥 Update'lar: {updates['pending']} ta (eng ko'p {updates['peak']}), kutish {updates['wait_avg_ms']:.1f} / "
+            f"{updates['wait_max_ms']:.1f} ms, rad etilgan {updates['rejected']}\n"
+            f"🔌 HTTP: {http['requests']} so'rov, {http['connections']} ulanish, "
+            f"{http['avg_ms']:.1f} / {http['max_ms']:.1f} ms\n\n"
             "📈 Ma'lumotlar real vaqtda yangilanadi"
         )
         
@@ -896,8 +3001,182 @@ def admin_callback_handler(call):
     else:
         safe_answer_callback(call, "⚠️ Noma'lum buyruq!")
 
+# ============================ OMMAVIY XABAR ============================
+def broadcast_cancel_markup() -> types.InlineKeyboardMarkup:
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("⏹ To'xtatish", callback_data="admin_broadcast_cancel"))
+    return kb
+
+class Broadcaster:
+    """Ommaviy xabar: foydalanuvchilarga uid tartibida, BROADCAST_CHUNK ta bo'laklab.
+
+    Bo'lak OUTBOX'ga BULK ustuvorlik bilan qo'yiladi: yuborish parallel va
+    umumiy limit ichida, o'yin xabarlari esa oldinda. Bo'lak tugagach holat
+    (oxirgi uid va hisoblar) BROADCAST_FILE ga yoziladi - bot qayta ishga
+    tushsa ish shu joydan davom etadi. "unreachable" belgili foydalanuvchilar
+    o'tkazib yuboriladi. Bir vaqtda bitta ish.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.lock = threading.Lock()
+        self.job: Optional[Dict[str, Any]] = None
+        self.thread: Optional[threading.Thread] = None
+        self.cancelled = False
+
+    def running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, admin_id: int, text: str) -> bool:
+        """Yangi ish; oldingisi hali tugamagan bo'lsa False"""
+        now = int(time.time())
+        with self.lock:
+            if self.running():
+                return False
+            self._spawn({
+                "admin": admin_id, "text": text, "status": "running", "started_at": now,
+                "cursor": 0, "total": 0, "progress_msg_id": None,
+                "delivered": 0, "blocked": 0, "failed": 0, "skipped": 0,
+            })
+        return True
+
+    def resume(self) -> None:
+        """Qayta ishga tushgandan keyin tugallanmagan ishni davom ettirish"""
+        job = load_json(self.path)
+        if not isinstance(job, dict) or job.get("status") != "running":
+            return
+        with self.lock:
+            if self.running():
+                return
+            self._spawn(job)
+        logger.info("Ommaviy xabar davom ettirildi (uid > %s)", job["cursor"])
+
+    def cancel(self) -> bool:
+        with self.lock:
+            if not self.running():
+                return False
+            self.cancelled = True
+            return True
+
+    def _spawn(self, job: Dict[str, Any]) -> None:
+        self.job = job
+        self.cancelled = False
+        save_json(self.path, job)
+        self.thread = threading.Thread(target=self._run, args=(job,), name="broadcast", daemon=True)
+        self.thread.start()
+
+    def _run(self, job: Dict[str, Any]) -> None:
+        try:
+            self._send_all(job)
+        except Exception as e:
+            # Holat "running" qoladi: keyingi ishga tushishda davom etadi
+            logger.exception("broadcast error: %s", e)
+
+    def _send_all(self, job: Dict[str, Any]) -> None:
+        with PROFILE_LOCK:
+            targets = sorted(int(k) for k in profiles if int(k) > job["cursor"])
+        job["total"] = self.processed(job) + len(targets)
+        if job["progress_msg_id"] is None:
+            sent = safe_api(bot.send_message, job["admin"], self.progress_text(job),
+                            reply_markup=broadcast_cancel_markup())
+            job["progress_msg_id"] = sent.message_id if sent else None
+        shown = time.monotonic()
+        for i in range(0, len(targets), BROADCAST_CHUNK):
+            if self.cancelled:
+                break
+            chunk = targets[i:i + BROADCAST_CHUNK]
+            self._send_chunk(job, chunk)
+            job["cursor"] = chunk[-1]
+            save_json(self.path, job)
+            if time.monotonic() - shown >= BROADCAST_PROGRESS_INTERVAL:
+                shown = time.monotonic()
+                self.show(job, broadcast_cancel_markup())
+        job["status"] = "cancelled" if self.cancelled else "done"
+        job["finished_at"] = int(time.time())
+        save_json(self.path, job)
+        self.show(job, admin_panel_markup())
+        logger.info("Ommaviy xabar %s: %s", job["status"], self.counts(job))
+
+    def _send_chunk(self, job: Dict[str, Any], chunk: List[int]) -> None:
+        """Bo'lakni navbatga qo'yib, hammasi yakunlanguncha kutish"""
+        with PROFILE_LOCK:
+            targets = [uid for uid in chunk if "unreachable" not in profiles.get(uid_str(uid), {})]
+        job["skipped"] += len(chunk) - len(targets)
+        if not targets:
+            return
+        text = f"📢 *BOTDAN MUHIM XABAR:*\n\n{job['text']}"
+        finished = threading.Event()
+        results: Dict[int, Any] = {}
+
+        def complete(sent: Dict[int, Any]) -> None:
+            results.update(sent)
+            finished.set()
+
+        fan_out({uid: (text, {}) for uid in targets}, complete, priority=PRIORITY_BULK)
+        # Kutish BULK tezligi (global limitning yarmi) bo'yicha + zaxira. Yakun kelmasa
+        # (ish tashlab yuborilgan yoki callback xatosi) oqim osilib qolmaydi - natijasizlar failed
+        timeout = len(targets) / (RATE_GLOBAL * 0.5) + BROADCAST_CHUNK_GRACE
+        if not finished.wait(timeout):
+            logger.warning("Ommaviy xabar: bo'lak %.0f soniyada yakunlanmadi", timeout)
+        got = dict(results)
+        with PROFILE_LOCK:
+            # Doimiy xato bo'lsa Outbox.failed foydalanuvchini allaqachon belgilagan
+            for uid in targets:
+                sent = got.get(uid)
+                if uid not in got:
+                    job["failed"] += 1
+                elif sent:
+                    job["delivered"] += 1
+                elif "unreachable" in profiles.get(uid_str(uid), {}):
+                    job["blocked"] += 1
+                else:
+                    job["failed"] += 1
+
+    @staticmethod
+    def processed(job: Dict[str, Any]) -> int:
+        return job["delivered"] + job["blocked"] + job["failed"] + job["skipped"]
+
+    @staticmethod
+    def counts(job: Dict[str, Any]) -> Dict[str, int]:
+        return {k: job[k] for k in ("total", "delivered", "blocked", "failed", "skipped")}
+
+    def progress_text(self, job: Dict[str, Any]) -> str:
+        title = {
+            "running": "⏳ *XABAR YUBORILMOQDA...*",
+            "done": "📢 *XABAR YUBORILDI!*",
+            "cancelled": "⏹ *XABAR YUBORISH TO'XTATILDI*",
+        }[job["status"]]
+        return (
+            f"{title}\n\n"
+            f"📊 Jarayon: {self.processed(job)}/{job['total']}\n"
+            f"✅ Yetkazildi: {job['delivered']} ta\n"
+            f"🚫 Bloklagan: {job['blocked']} ta\n"
+            f"❌ Xato: {job['failed']} ta\n"
+            f"⏭ O'tkazib yuborildi: {job['skipped']} ta"
+        )
+
+    def show(self, job: Dict[str, Any], markup) -> None:
+        """Admin'dagi jarayon xabarini yangilash (navbat orqali)"""
+        text = self.progress_text(job)
+        if job["progress_msg_id"] is None:
+            OUTBOX.send(job["admin"], text, track=False, reply_markup=markup)
+        else:
+            OUTBOX.call(job["admin"], bot.edit_message_text, text, job["admin"],
+                        job["progress_msg_id"], reply_markup=markup)
+
+    def stats(self) -> Optional[Dict[str, Any]]:
+        job = self.job
+        if job is None:
+            return None
+        return {"status": job["status"], **self.counts(job)}
+
+BROADCASTER = Broadcaster(BROADCAST_FILE)
+
 # ============================ ADMIN TEXT HANDLERS ============================
-@bot.message_handler(func=lambda m: m.from_user.id in waiting_for_broadcast)
+# waiting_* holatlari va menyu matnlari: /start, /admin dan keyin, qolgan komandalardan oldin
+bot.message_handler(func=ROUTER.match_message)(ROUTER.dispatch_message)
+
+@ROUTER.state(waiting_for_broadcast)
 def handle_broadcast_message(msg):
     uid = msg.from_user.id
     if uid not in ADMIN_IDS:
@@ -906,31 +3185,11 @@ def handle_broadcast_message(msg):
     if uid in waiting_for_broadcast:
         waiting_for_broadcast.pop(uid, None)
         
-        broadcast_msg = msg.text
-        sent_count = 0
-        failed_count = 0
-        
-        with LOCK:
-            user_ids = list(profiles.keys())
-        
-        for user_key in user_ids:
-            try:
-                safe_api(bot.send_message, int(user_key),
-                        f"📢 *BOTDAN MUHIM XABAR:*\n\n{broadcast_msg}")
-                sent_count += 1
-            except Exception:
-                failed_count += 1
-        
-        admin_text = (
-            f"📢 *XABAR YUBORILDI!*\n\n"
-            f"✅ Muvaffaqiyatli: {sent_count} ta\n"
-            f"❌ Xato: {failed_count} ta\n\n"
-            f"Xabaringiz {sent_count} ta foydalanuvchiga yetkazildi."
-        )
-        
-        safe_api(bot.send_message, uid, admin_text, reply_markup=admin_panel_markup())
+        if not BROADCASTER.start(uid, msg.text):
+            safe_api(bot.send_message, uid, "⏳ Oldingi xabar hali yuborilmoqda!",
+                    reply_markup=admin_panel_markup())
 
-@bot.message_handler(func=lambda m: m.from_user.id in waiting_for_admin_add and isinstance(waiting_for_admin_add[m.from_user.id], bool))
+@ROUTER.state(waiting_for_admin_add, check=lambda v: isinstance(v, bool))
 def handle_admin_add(msg):
     uid = msg.from_user.id
     if uid not in ADMIN_IDS:
@@ -940,17 +3199,18 @@ def handle_admin_add(msg):
         waiting_for_admin_add.pop(uid, None)
         
         try:
-            new_admin_id = int(msg.text)
+            new_admin_id = resolve_user_ref(msg.text)
             
-            with LOCK:
-                if new_admin_id in ADMIN_IDS:
-                    safe_api(bot.send_message, uid,
-                            f"⚠️ {get_username_id(new_admin_id)} allaqachon admin!",
-                            reply_markup=admin_panel_markup())
-                    return
-                
+            with PROFILE_LOCK:
+                already = new_admin_id in ADMIN_IDS
                 ADMIN_IDS.add(new_admin_id)
-                persist_admins()
+            
+            if already:
+                safe_api(bot.send_message, uid,
+                        f"⚠️ {get_username_id(new_admin_id)} allaqachon admin!",
+                        reply_markup=admin_panel_markup())
+                return
+            persist_admins()
             
             try:
                 safe_api(bot.send_message, new_admin_id,
@@ -969,7 +3229,7 @@ def handle_admin_add(msg):
                     "⚠️ ID raqam noto'g'ri! Qayta urinib ko'ring.",
                     reply_markup=admin_panel_markup())
 
-@bot.message_handler(func=lambda m: m.from_user.id in waiting_for_admin_add and isinstance(waiting_for_admin_add[m.from_user.id], dict))
+@ROUTER.state(waiting_for_admin_add, check=lambda v: isinstance(v, dict))
 def handle_admin_add_value(msg):
     uid = msg.from_user.id
     if uid not in ADMIN_IDS:
@@ -988,24 +3248,25 @@ def handle_admin_add_value(msg):
                         reply_markup=admin_panel_markup())
                 return
             
-            with LOCK:
+            if action_type not in ("money", "diamonds"):
+                safe_api(bot.send_message, uid,
+                        "⚠️ Noma'lum amal turi!",
+                        reply_markup=admin_panel_markup())
+                return
+            
+            with PROFILE_LOCK:
                 prof = ensure_profile(target_user_id)
                 
                 if action_type == "money":
                     prof["money"] += amount
                     action_name = "pul"
                     emoji = "💰"
-                elif action_type == "diamonds":
+                else:
                     prof["diamonds"] += amount
                     action_name = "olmos"
                     emoji = "💎"
-                else:
-                    safe_api(bot.send_message, uid,
-                            "⚠️ Noma'lum amal turi!",
-                            reply_markup=admin_panel_markup())
-                    return
                 
-                persist_profiles()
+                persist_profiles(target_user_id)
             
             try:
                 safe_api(bot.send_message, target_user_id,
@@ -1025,7 +3286,7 @@ def handle_admin_add_value(msg):
                     "⚠️ Noto'g'ri format! Faqat raqam kiriting.",
                     reply_markup=admin_panel_markup())
 
-@bot.message_handler(func=lambda m: m.from_user.id in waiting_for_admin_remove)
+@ROUTER.state(waiting_for_admin_remove)
 def handle_admin_remove(msg):
     uid = msg.from_user.id
     if uid not in ADMIN_IDS:
@@ -1037,21 +3298,22 @@ def handle_admin_remove(msg):
         try:
             remove_admin_id = int(msg.text)
             
-            with LOCK:
-                if remove_admin_id not in ADMIN_IDS:
-                    safe_api(bot.send_message, uid,
-                            f"⚠️ {get_username_id(remove_admin_id)} admin emas!",
-                            reply_markup=admin_panel_markup())
-                    return
-                
-                if remove_admin_id == uid:
-                    safe_api(bot.send_message, uid,
-                            "⚠️ O'zingizni olib tashlay olmaysiz!",
-                            reply_markup=admin_panel_markup())
-                    return
-                
+            if remove_admin_id == uid:
+                safe_api(bot.send_message, uid,
+                        "⚠️ O'zingizni olib tashlay olmaysiz!",
+                        reply_markup=admin_panel_markup())
+                return
+            
+            with PROFILE_LOCK:
+                was_admin = remove_admin_id in ADMIN_IDS
                 ADMIN_IDS.discard(remove_admin_id)
-                persist_admins()
+            
+            if not was_admin:
+                safe_api(bot.send_message, uid,
+                        f"⚠️ {get_username_id(remove_admin_id)} admin emas!",
+                        reply_markup=admin_panel_markup())
+                return
+            persist_admins()
             
             try:
                 safe_api(bot.send_message, remove_admin_id,
@@ -1071,7 +3333,7 @@ def handle_admin_remove(msg):
 
 # ============================ OLMOS SOTIB OLISH FUNKSIYALARI ============================
 def show_order_confirmation(uid: int, order_id: str) -> None:
-    with LOCK:
+    with PROFILE_LOCK:
         order = diamond_orders.get(order_id)
     
     if not order:
@@ -1116,7 +3378,7 @@ def profile_reply_markup(uid: Optional[int] = None) -> types.ReplyKeyboardMarkup
     
     return m
 
-@bot.callback_query_handler(func=lambda c: c.data and (c.data.startswith("buy_") or c.data in ["buy_custom", "confirm_order", "cancel_order", "profile_back"]))
+@ROUTER.callback("buy_", "confirm_order", "cancel_order", "profile_back")
 def buy_callback_handler(call):
     uid = call.from_user.id
     data = call.data
@@ -1150,7 +3412,7 @@ def buy_callback_handler(call):
                     safe_answer_callback(call, "❌ Noto'g'ri son!", show_alert=True)
                     return
                     
-                with LOCK:
+                with PROFILE_LOCK:
                     order_id = f"{uid}_{int(time.time())}"
                     diamond_orders[order_id] = {
                         "user_id": uid,
@@ -1169,7 +3431,7 @@ def buy_callback_handler(call):
             return
 
         if data == "confirm_order":
-            with LOCK:
+            with PROFILE_LOCK:
                 order_id = waiting_for_check.get(uid)
                 order = diamond_orders.get(order_id)
                 
@@ -1209,7 +3471,7 @@ def buy_callback_handler(call):
             return
 
         if data == "cancel_order":
-            with LOCK:
+            with PROFILE_LOCK:
                 order_id = waiting_for_check.pop(uid, None)
                 if order_id:
                     diamond_orders.pop(order_id, None)
@@ -1225,7 +3487,7 @@ def buy_callback_handler(call):
         logger.exception(f"buy_callback_handler xatosi: {e}")
         safe_answer_callback(call, "❌ Xatolik yuz berdi!", show_alert=True)
 
-@bot.message_handler(func=lambda m: m.chat.type == "private" and m.from_user.id in waiting_for_custom_amount)
+@ROUTER.state(waiting_for_custom_amount, private=True)
 def handle_custom_amount(message):
     user_id = message.from_user.id
     if user_id not in waiting_for_custom_amount:
@@ -1240,7 +3502,7 @@ def handle_custom_amount(message):
             safe_api(bot.send_message, user_id, "❗ <b>Iltimos, musbat son kiriting.</b>")
             return
             
-        with LOCK:
+        with PROFILE_LOCK:
             order_id = f"{user_id}_{int(time.time())}"
             diamond_orders[order_id] = {
                 "user_id": user_id,
@@ -1263,7 +3525,7 @@ def handle_custom_amount(message):
 def handle_check(msg):
     uid = msg.from_user.id
     
-    with LOCK:
+    with PROFILE_LOCK:
         order_id = waiting_for_check.get(uid)
         order = diamond_orders.get(order_id)
     
@@ -1322,7 +3584,7 @@ def handle_check(msg):
                 "Chekni adminlarga yuborib bo'lmadi.\n"
                 "Iltimos, keyinroq qayta urinib ko'ring.")
     
-    with LOCK:
+    with PROFILE_LOCK:
         if order_id in diamond_orders:
             diamond_orders[order_id]["check_id"] = check_id
             diamond_orders[order_id]["check_type"] = file_type
@@ -1348,28 +3610,30 @@ def admin_confirm_order(message):
         safe_send_and_reply(message.chat.id, message.message_id, "❌ <b>Noto'g'ri ID format!</b>\nID faqat raqamlardan iborat bo'lishi kerak.")
         return
     
-    with LOCK:
+    name = get_username_id(user_id)
+    with PROFILE_LOCK:
         order_id = next(
             (oid for oid, o in diamond_orders.items() 
              if o["user_id"] == user_id and o.get("status") == "pending"),
             None
         )
         
-        if not order_id:
-            safe_send_and_reply(message.chat.id, message.message_id, 
-                    f"❌ <b>{get_username_id(user_id)} uchun kutilayotgan buyurtma topilmadi!</b>\n"
-                    "Yoki buyurtma allaqachon tasdiqlangan/bekor qilingan.")
-            return
-        
-        order = diamond_orders[order_id]
-        
-        prof = ensure_profile(user_id, get_username_id(user_id))
-        prof["diamonds"] += order["count"]
-        
-        waiting_for_check.pop(user_id, None)
-        diamond_orders.pop(order_id, None)
-        
-        persist_profiles()
+        if order_id:
+            order = diamond_orders[order_id]
+            
+            prof = ensure_profile(user_id, name)
+            prof["diamonds"] += order["count"]
+            
+            waiting_for_check.pop(user_id, None)
+            diamond_orders.pop(order_id, None)
+            
+            persist_profiles(user_id)
+    
+    if not order_id:
+        safe_send_and_reply(message.chat.id, message.message_id, 
+                f"❌ <b>{name} uchun kutilayotgan buyurtma topilmadi!</b>\n"
+                "Yoki buyurtma allaqachon tasdiqlangan/bekor qilingan.")
+        return
     
     try:
         safe_api(bot.send_message, user_id,
@@ -1409,7 +3673,7 @@ def admin_cancel_order(message):
         safe_send_and_reply(message.chat.id, message.message_id, "❌ <b>Noto'g'ri ID format!</b>")
         return
     
-    with LOCK:
+    with PROFILE_LOCK:
         order_id = next(
             (oid for oid, o in diamond_orders.items() 
              if o["user_id"] == user_id and o.get("status") == "pending"),
@@ -1419,29 +3683,138 @@ def admin_cancel_order(message):
         if order_id:
             diamond_orders.pop(order_id, None)
             waiting_for_check.pop(user_id, None)
-            
-            try:
-                safe_api(bot.send_message, user_id,
-                        "❌ <b>BUYURTMANGIZ BEKOR QILINDI!</b>\n\n"
-                        "Afsuski, to'lovingiz tasdiqlanmadi.\n"
-                        "Sabablari:\n"
-                        "• Chek aniq ko'rinmaydi\n"
-                        "• To'lov summasi to'g'ri emas\n"
-                        "• Boshqa texnik sabablar\n\n"
-                        "💡 Agar xato bo'lsa, admin bilan bog'laning.")
-            except Exception:
-                pass
-            
-            username = get_username_id(user_id)
-            safe_send_and_reply(message.chat.id, message.message_id,
-                    f"❌ <b>{username} uchun buyurtma bekor qilindi!</b>\n"
-                    f"🆔 ID: {user_id}")
-        else:
-            safe_send_and_reply(message.chat.id, message.message_id,
-                    f"⚠️ <b>{get_username_id(user_id)} uchun kutilayotgan buyurtma topilmadi!</b>")
+    
+    if order_id:
+        try:
+            safe_api(bot.send_message, user_id,
+                    "❌ <b>BUYURTMANGIZ BEKOR QILINDI!</b>\n\n"
+                    "Afsuski, to'lovingiz tasdiqlanmadi.\n"
+                    "Sabablari:\n"
+                    "• Chek aniq ko'rinmaydi\n"
+                    "• To'lov summasi to'g'ri emas\n"
+                    "• Boshqa texnik sabablar\n\n"
+                    "💡 Agar xato bo'lsa, admin bilan bog'laning.")
+        except Exception:
+            pass
+        
+        username = get_username_id(user_id)
+        safe_send_and_reply(message.chat.id, message.message_id,
+                f"❌ <b>{username} uchun buyurtma bekor qilindi!</b>\n"
+                f"🆔 ID: {user_id}")
+    else:
+        safe_send_and_reply(message.chat.id, message.message_id,
+                f"⚠️ <b>{get_username_id(user_id)} uchun kutilayotgan buyurtma topilmadi!</b>")
 
 # ============================ O'YIN FUNKSIYALARI (DAYDI RO'LI BILAN) ============================
+# Tiriklar ro'yxatidagi tugmalar: tur -> (belgi, callback nomi, tugma amal qiladigan bosqich)
+TARGET_BUTTONS = {
+    "mafia": ("🎯", "k", "night_mafia"),
+    "doctor": ("🩺", "s", "night_doctor"),
+    "comissar": ("🔍", "c", "night_comissar"),
+    "vote": ("🗳️", "v", "day"),
+}
+BUTTON_PHASES = {code: phase for _, code, phase in TARGET_BUTTONS.values()}
+
+def b36(n: int) -> str:
+    digits = "0123456789abcdefghijklmnopqrstuvwxyz"
+    out = ""
+    while True:
+        n, r = divmod(n, 36)
+        out = digits[r] + out
+        if not n:
+            return out
+
+def button_stamp(game: Dict[str, Any]) -> tuple:
+    """chat lock ostida: (token, tun raqami, o'yinchilar) - tugmalar shu holatga bog'lanadi"""
+    return game["token"], game.get("round", 0), tuple(game["players"])
+
+def button_data(stamp: tuple, kind: str, uid: int) -> str:
+    """"<nom>:<token>.<tun>.<o'yinchi indeksi>" (~15 bayt, chat ID siz)"""
+    token, rnd, players = stamp
+    return f"{TARGET_BUTTONS[kind][1]}:{token}.{b36(rnd)}.{b36(players.index(uid))}"
+
+def decode_button(code: str, args: str) -> Optional[tuple]:
+    """"<token>.<tun>.<o'yinchi indeksi>" -> (chat_id, token, tun, o'yinchi) yoki eskirgan bo'lsa None.
+
+    Lock olinmaydi: faqat lug'at o'qiladi. Tugallangan o'yin (token yo'q),
+    oldingi tun/kun yoki boshqa bosqich tugmalari shu yerda rad etiladi;
+    handler qolganini lock ostida tekshiradi.
+    """
+    try:
+        token, rnd, idx = args.split(".")
+        rnd, idx = int(rnd, 36), int(idx, 36)
+    except ValueError:
+        return None
+    key = game_tokens.get(token)
+    game = games.get(key) if key else None
+    if (not game or game.get("state") != "started" or game.get("round", 0) != rnd
+            or game.get("phase") != BUTTON_PHASES.get(code)):
+        return None
+    players = game["players"]
+    return (int(key), token, rnd, players[idx]) if idx < len(players) else None
+
+def game_button(fn):
+    """O'yin tugmasi handleri: callback_data decode qilinadi, eskirgani darhol rad etiladi"""
+    @functools.wraps(fn)
+    def wrapper(call):
+        decoded = decode_button(*call.route)
+        if decoded is None:
+            safe_answer_callback(call, "⌛ Bu tugma eskirgan!")
+            return
+        call.game_chat, call.token, call.round, call.target = decoded
+        return fn(call)
+    return wrapper
+
+def button_current(game: Dict[str, Any], call) -> bool:
+    """Lock ostida qayta tekshiruv: mailbox'da kutgan bosish keyingi tun/kunga
+    (yoki shu chatdagi yangi o'yinga) o'tmasin"""
+    return game.get("token") == call.token and game.get("round", 0) == call.round
+
+@ROUTER.callback("mafia_kill", "doctor_save", "comissar_check", "vote")
+def stale_button(call):
+    """Eski formatdagi (uid bilan) tugmalar"""
+    safe_answer_callback(call, "⌛ Bu tugma eskirgan!")
+
+def target_markup(chat_id: int, stamp: tuple, alive: List[int], kind: str,
+                  exclude: Optional[int] = None) -> types.InlineKeyboardMarkup:
+    """Tiriklar tugmalari (har qatorda bittadan).
+
+    Ismlar va tugmalar (callback_data - button_data) o'yin bo'yicha
+    keshlanadi: kalit - tun raqami, tiriklar ro'yxati (kimdir o'lsa yangi
+    versiya) va tur. Bir tun/kun ichidagi barcha rollar tayyor tugmalardan
+    foydalanadi; exclude (o'zini tanlay olmaydigan mafia/komissar) faqat
+    shu ro'yxatdan filtr.
+    """
+    key = cid_str(chat_id)
+    version = stamp[:2] + (tuple(alive),)
+    entry = target_renders.get(key)
+    names = entry[1] if entry else {}
+    if entry is None or entry[0] != version:
+        # Ismlar oldingi versiyadan olinadi: o'lim faqat tugmalarni qayta quradi.
+        # Yetishmagan ism get_chat bo'lishi mumkin - lock'dan tashqarida
+        names = {p: names.get(p) or get_username_id(p) for p in alive}
+    # Chat mailbox'i va OUTBOX (refresh_vote_tally) bir vaqtda chaqirishi mumkin
+    with chat_lock(chat_id):
+        entry = target_renders.get(key)
+        if entry is None or entry[0] != version:
+            entry = (version, names, {})
+            game = games.get(key)
+            # Faqat joriy holat keshlanadi: kechikkan eski chaqiruv yangisini almashtirmaydi
+            if game is not None and button_stamp(game)[:2] + (tuple(game.get("alive", [])),) == version:
+                target_renders[key] = entry
+        buttons = entry[2].get(kind)
+        if buttons is None:
+            label = TARGET_BUTTONS[kind][0]
+            buttons = entry[2][kind] = [
+                (p, types.InlineKeyboardButton(f"{label} {entry[1][p]}", callback_data=button_data(stamp, kind, p)))
+                for p in alive
+            ]
+    kb = types.InlineKeyboardMarkup()
+    kb.keyboard = [[button] for p, button in buttons if p != exclude]
+    return kb
+
 @bot.message_handler(commands=['startgame'])
+@in_chat_actor(chat_of_message)
 def startgame_cmd(message):
     if message.chat.type not in ("group", "supergroup"):
         safe_send_and_reply(message.chat.id, message.message_id, "⚠️ Bu buyruq faqat guruhlar uchun!")
@@ -1453,148 +3826,138 @@ def startgame_cmd(message):
     chat_id = message.chat.id
     key = cid_str(chat_id)
     
-    with LOCK:
-        if key in games and games[key].get("state") == "started":
-            safe_send_and_reply(message.chat.id, message.message_id, "😱 *O'YIN BOSHLANGAN!*\n\nYangi o'yin boshlash uchun avval buni tugating! ⏹️")
-            return
-        
-        games[key] = {
-            "state": "waiting",
-            "players": [],
-            "roles": {},
-            "alive": [],
-            "phase": None,
-            "votes": {},
-            "night_kill": None,
-            "doctor_save": None,
-            "join_msg_id": None,
-            "vote_msg_id": None,
-            "kill_count": {},
-            "started_at": None,
-            "current_night_msgs": [],
-            "phase_start_time": None,
-            "daydi_power_used": False,
-            "chat_allowed": True,  # Chat ochiq yoki yopiq
-            "bot_messages": [],  # Bot xabarlarini saqlash
-        }
-        persist_games()
+    with chat_lock(chat_id):
+        busy = key in games and games[key].get("state") == "started"
+        if not busy:
+            register_game(key, {
+                "state": "waiting",
+                "players": [],
+                "roles": {},
+                "alive": [],
+                "phase": None,
+                "votes": {},
+                "night_kill": None,
+                "doctor_save": None,
+                "join_msg_id": None,
+                "vote_msg_id": None,
+                "kill_count": {},
+                "started_at": None,
+                "current_night_msgs": [],
+                "phase_start_time": None,
+                "daydi_power_used": False,
+                "chat_allowed": True,  # Chat ochiq yoki yopiq
+                "bot_messages": [],  # Bot xabarlarini saqlash
+                "registration_started_at": int(time.time()),
+            })
+            journal_game(key, "registration")
+    
+    if busy:
+        safe_send_and_reply(message.chat.id, message.message_id, "😱 *O'YIN BOSHLANGAN!*\n\nYangi o'yin boshlash uchun avval buni tugating! ⏹️")
+        return
     
     start_text = funny_game_start_message()
     
     join_kb = types.InlineKeyboardMarkup()
     join_kb.add(types.InlineKeyboardButton("🕹️ O'yinga qo'shilish", callback_data="join_game"))
     
-    sent = safe_send_message(chat_id, start_text, reply_markup=join_kb)
-    
-    if sent:
-        with LOCK:
-            games[key]["join_msg_id"] = sent.message_id
-            games[key]["bot_messages"].append(sent.message_id)
-            persist_games()
-    
+    send_game_message(chat_id, start_text, field="join_msg_id", reply_markup=join_kb)
     start_registration_timer(chat_id)
 
-def start_registration_timer(chat_id: int):
-    def timer_func():
-        begin_game_by_chat(chat_id, auto=True)
-    
-    with LOCK:
-        key = cid_str(chat_id)
-        if key not in timers:
-            timers[key] = {}
-        
-        if "registration" in timers[key]:
-            timers[key]["registration"].cancel()
-        
-        timer = threading.Timer(REGISTRATION_TIMEOUT, timer_func)
-        timer.start()
-        timers[key]["registration"] = timer
+def start_registration_timer(chat_id: int, timeout: int = REGISTRATION_TIMEOUT):
+    schedule_chat_timer(chat_id, "registration", timeout, begin_game_by_chat, True)
 
 def cancel_registration_timer(chat_id: int):
-    with LOCK:
-        key = cid_str(chat_id)
-        if key in timers and "registration" in timers[key]:
-            timers[key]["registration"].cancel()
-            timers[key].pop("registration", None)
+    cancel_chat_timer(chat_id, "registration")
 
 def start_phase_timer(chat_id: int, timeout: int, callback_func):
-    def timer_func():
-        callback_func(chat_id)
-    
-    with LOCK:
-        key = cid_str(chat_id)
-        if key not in timers:
-            timers[key] = {}
-        
-        if "phase" in timers[key]:
-            timers[key]["phase"].cancel()
-        
-        timer = threading.Timer(timeout, timer_func)
-        timer.start()
-        timers[key]["phase"] = timer
+    schedule_chat_timer(chat_id, "phase", timeout, callback_func)
 
 def cancel_phase_timer(chat_id: int):
-    with LOCK:
-        key = cid_str(chat_id)
-        if key in timers and "phase" in timers[key]:
-            timers[key]["phase"].cancel()
-            timers[key].pop("phase", None)
+    cancel_chat_timer(chat_id, "phase")
+
+roster_flushed: Dict[str, float] = {}  # chat -> oxirgi ro'yxat tahriri (monotonic)
 
 def update_registration_message(chat_id: int) -> None:
+    """Ro'yxat xabarini yangilash (throttle): oraliq ichidagi qo'shilishlar bitta tahrirga yig'iladi"""
+    key = cid_str(chat_id)
+    if (key, "roster") in chat_timers:
+        return  # navbatdagi tahrir eng oxirgi ro'yxatni ko'rsatadi
+    wait = REGISTRATION_EDIT_INTERVAL - (time.monotonic() - roster_flushed.get(key, 0.0))
+    if wait > 0:
+        schedule_chat_timer(chat_id, "roster", wait, flush_registration_message)
+    else:
+        flush_registration_message(chat_id)
+
+def flush_registration_message(chat_id: int) -> None:
+    """Joriy ro'yxatni hozir navbatga qo'yish (o'yin boshlanishidan oldin ham chaqiriladi)"""
+    key = cid_str(chat_id)
+    cancel_chat_timer(chat_id, "roster")
+    with chat_lock(chat_id):
+        game = games.get(key)
+        players = list(game["players"]) if game and game.get("state") == "waiting" else None
+    if players is None:
+        roster_flushed.pop(key, None)
+        return
+    roster_flushed[key] = time.monotonic()
+    # Guruh navbatida bajariladi: ro'yxat xabari (join_msg_id) shu paytgacha yuborilgan bo'ladi
+    OUTBOX.call(chat_id, edit_registration_message, chat_id, registration_text(players))
+
+def registration_text(players: List[int]) -> str:
+    if not players:
+        return "🎲 *RO'YXAT BOSHLANDI!*\n\nHali hech kim qo'shilmadi...\nBirinchi bo'ling! 🏃‍♂️"
+    text = f"🎲 *RO'YXATDA {len(players)} TA O'YINCHI!*\n\n"
+    text += "📋 Ro'yxat:\n"
+    for i, uid in enumerate(players, 1):
+        text += f"{i}. {get_username_id(uid)}\n"
+    
+    if len(players) < MIN_PLAYERS:
+        text += f"\n⏳ Yana {MIN_PLAYERS - len(players)} kishi kerak!"
+    else:
+        text += "\n✅ O'yinni boshlash mumkin!\n/begin yoki 60 soniya kuting..."
+    return text
+
+def edit_registration_message(chat_id: int, text: str) -> None:
     key = cid_str(chat_id)
-    with LOCK:
+    with chat_lock(chat_id):
         game = games.get(key)
         if not game:
             return
-        players = list(game.get("players", []))
         msg_id = game.get("join_msg_id")
-    
-    if not players:
-        text = "🎲 *RO'YXAT BOSHLANDI!*\n\nHali hech kim qo'shilmadi...\nBirinchi bo'ling! 🏃‍♂️"
-    else:
-        text = f"🎲 *RO'YXATDA {len(players)} TA O'YINCHI!*\n\n"
-        text += "📋 Ro'yxat:\n"
-        for i, uid in enumerate(players, 1):
-            text += f"{i}. {get_username_id(uid)}\n"
-        
-        if len(players) < MIN_PLAYERS:
-            text += f"\n⏳ Yana {MIN_PLAYERS - len(players)} kishi kerak!"
-        else:
-            text += "\n✅ O'yinni boshlash mumkin!\n/begin yoki 60 soniya kuting..."
-    
-    join_kb = types.InlineKeyboardMarkup()
-    join_kb.add(types.InlineKeyboardButton("🕹️ O'yinga qo'shilish", callback_data="join_game"))
-    
-    try:
-        if msg_id:
-            safe_api(bot.edit_message_text, text, chat_id, msg_id, reply_markup=join_kb)
-        else:
-            sent = safe_send_message(chat_id, text, reply_markup=join_kb)
-            if sent:
-                with LOCK:
-                    games[key]["join_msg_id"] = sent.message_id
-                    games[key]["bot_messages"].append(sent.message_id)
-                    persist_games()
-    except Exception:
-        logger.exception("update_registration_message failed")
+        waiting = game.get("state") == "waiting"
+    
+    # O'yin boshlangandan keyin yetib kelgan oxirgi ro'yxat tugmasiz ko'rsatiladi
+    join_kb = None
+    if waiting:
+        join_kb = types.InlineKeyboardMarkup()
+        join_kb.add(types.InlineKeyboardButton("🕹️ O'yinga qo'shilish", callback_data="join_game"))
+    
+    if msg_id:
+        # Xato ko'tariladi: 429 va vaqtinchalik xatolarni OUTBOX qayta urinadi
+        call_api(bot.edit_message_text, text, chat_id, msg_id, reply_markup=join_kb)
+    else:
+        send_game_message(chat_id, text, field="join_msg_id", reply_markup=join_kb)
 
 # YANGI: Obuna tekshirish bilan o'yinga qo'shilish
-@bot.callback_query_handler(func=lambda c: c.data == "join_game")
+@ROUTER.callback("join_game")
+@in_chat_actor(callback_game_chat)
 def join_game_callback(call):
     try:
         chat_id = call.message.chat.id
         uid = call.from_user.id
         key = cid_str(chat_id)
         
-        with LOCK:
-            if key not in games or games[key]["state"] != "waiting":
-                safe_answer_callback(call, "❌ Ro'yxat yopilgan!")
-                return
-            
-            game = games[key]
-            if uid in game["players"]:
-                safe_answer_callback(call, "✅ Siz allaqachon ro'yxatdasiz!")
-                return
+        with chat_lock(chat_id):
+            game = games.get(key)
+            if not game or game["state"] != "waiting":
+                error = "❌ Ro'yxat yopilgan!"
+            elif uid in game["players"]:
+                error = "✅ Siz allaqachon ro'yxatdasiz!"
+            else:
+                error = None
+        
+        if error:
+            safe_answer_callback(call, error)
+            return
         
         # Obuna tekshirish
         if not check_user_subscribed(uid):
@@ -1616,20 +3979,24 @@ def join_game_callback(call):
             
             return
         
-        # Obuna bo'lgan bo'lsa, qo'shilish
-        with LOCK:
-            game["players"].append(uid)
-            game["kill_count"][uid_str(uid)] = 0
-            ensure_profile(uid, get_username_obj(call.from_user))
-            persist_games()
+        # Obuna bo'lgan bo'lsa, qo'shilish (tekshiruvdan keyin holat o'zgargan bo'lishi mumkin)
+        with chat_lock(chat_id):
+            game = games.get(key)
+            joined = bool(game) and game["state"] == "waiting" and uid not in game["players"]
+            if joined:
+                game["players"].append(uid)
+                game["kill_count"][uid_str(uid)] = 0
+                ensure_profile(uid, get_username_obj(call.from_user))
+                journal_game(key, "join", uid=uid)
+        
+        if not joined:
+            safe_answer_callback(call, "❌ Ro'yxat yopilgan!")
+            return
         
         join_text = funny_player_joined_message(get_username_obj(call.from_user))
         safe_answer_callback(call, "✅ Qo'shildingiz!")
         
-        try:
-            safe_api(bot.send_message, uid, f"✅ *Siz {call.message.chat.title} guruhidagi o'yinga qo'shildingiz!*\n\nRolingizni tez orada olasiz... 🎭")
-        except Exception:
-            pass
+        OUTBOX.send(uid, f"✅ *Siz {call.message.chat.title} guruhidagi o'yinga qo'shildingiz!*\n\nRolingizni tez orada olasiz... 🎭", track=False)
         
         update_registration_message(chat_id)
         
@@ -1638,6 +4005,7 @@ def join_game_callback(call):
 
 # YANGI: /start bilan kelgan foydalanuvchini avtomatik qo'shish
 @bot.message_handler(func=lambda m: m.text and m.text.startswith('/start join_'))
+@in_chat_actor(start_join_chat)
 def handle_auto_join_after_start(msg):
     """Botga /start bosgandan keyin avtomatik o'yinga qo'shilish"""
     if msg.chat.type != "private":
@@ -1655,21 +4023,23 @@ def handle_auto_join_after_start(msg):
     
     key = cid_str(chat_id)
     
-    with LOCK:
+    with chat_lock(chat_id):
         game = games.get(key)
         if not game or game.get("state") != "waiting":
-            safe_api(bot.send_message, uid, "⚠️ O'yin ro'yxati allaqachon yopilgan yoki o'yin boshlangan!")
-            return
-        
-        if uid in game["players"]:
-            safe_api(bot.send_message, uid, "✅ Siz allaqachon ro'yxatdasiz!")
-            return
-        
-        # Avtomatik qo'shilish
-        game["players"].append(uid)
-        game["kill_count"][uid_str(uid)] = 0
-        ensure_profile(uid, get_username_obj(msg.from_user))
-        persist_games()
+            error = "⚠️ O'yin ro'yxati allaqachon yopilgan yoki o'yin boshlangan!"
+        elif uid in game["players"]:
+            error = "✅ Siz allaqachon ro'yxatdasiz!"
+        else:
+            error = None
+            # Avtomatik qo'shilish
+            game["players"].append(uid)
+            game["kill_count"][uid_str(uid)] = 0
+            ensure_profile(uid, get_username_obj(msg.from_user))
+            journal_game(key, "join", uid=uid)
+    
+    if error:
+        safe_api(bot.send_message, uid, error)
+        return
     
     safe_api(bot.send_message, uid, 
             f"✅ *Siz avtomatik ravishda guruh o'yinga qo'shildingiz!*\n\n"
@@ -1677,83 +4047,94 @@ def handle_auto_join_after_start(msg):
     
     # Guruhda xabar
     join_text = funny_player_joined_message(get_username_obj(msg.from_user))
-    safe_send_message(chat_id, join_text)
+    OUTBOX.send(chat_id, join_text, priority=PRIORITY_COSMETIC)
     
     update_registration_message(chat_id)
 
+@in_chat_actor(chat_of_arg)
 def begin_game_by_chat(chat_id: int, auto: bool = False) -> None:
     key = cid_str(chat_id)
-    with LOCK:
+    if (key, "roster") in chat_timers:
+        # Kutilayotgan ro'yxat tahriri o'yin boshlanishidan oldin yuboriladi
+        flush_registration_message(chat_id)
+    roster_flushed.pop(key, None)
+    with chat_lock(chat_id):
         game = games.get(key)
         if not game or game.get("state") != "waiting":
-            if not auto:
-                safe_send_message(chat_id, "⚠️ *RO'YXAT YO'Q!*\n\n/startgame yozib ro'yxatni boshlang!")
-            return
-        
-        if len(game["players"]) < MIN_PLAYERS and not auto:
-            safe_send_message(chat_id, 
-                    f"❌ *O'YINCHILAR YETARLI EMAS!*\n\n{MIN_PLAYERS - len(game['players'])} kishi ko'proq kerak!")
-            return
-
-        cancel_registration_timer(chat_id)
-        players = list(game["players"])
-        
-        num_special = min(3, len(players))
-        roles_list = ["🤵🏻 Дон", "💉 Доктор", "🕵️ Комиссар"][:num_special]
-        
-        if len(players) >= 5:
-            roles_list.append("👴 Daydi")
-            num_special = min(4, len(players))
-        
-        guaranteed = [p for p in players if profiles.get(uid_str(p), {}).get("guaranteed_active_role")]
-        random.shuffle(guaranteed)
-        assigned: Dict[int, str] = {}
-        available_special = roles_list.copy()
-        
-        for p in guaranteed:
-            if not available_special:
-                break
-            assigned[p] = available_special.pop(0)
-            profiles[uid_str(p)]["guaranteed_active_role"] = False
-        
-        remaining = [p for p in players if p not in assigned]
-        random.shuffle(remaining)
-        remaining_roles = available_special + ["👨🏼 Мирный житель"] * (len(remaining) - len(available_special))
-        random.shuffle(remaining_roles)
-        
-        for p, r in zip(remaining, remaining_roles):
-            assigned[p] = r
-        
-        game["roles"] = {uid_str(p): assigned[p] for p in assigned}
-        game["state"] = "started"
-        game["alive"] = players.copy()
-        game["phase"] = "night_mafia"
-        game["votes"] = {}
-        game["night_kill"] = None
-        game["doctor_save"] = None
-        game["kill_count"] = {uid_str(p): 0 for p in players}
-        game["started_at"] = int(time.time())
-        game["phase_start_time"] = int(time.time())
-        game["current_night_msgs"] = []
-        game["daydi_power_used"] = False
-        game["chat_allowed"] = True
+            error = None if auto else "⚠️ *RO'YXAT YO'Q!*\n\n/startgame yozib ro'yxatni boshlang!"
+            players = None
+        elif len(game["players"]) < MIN_PLAYERS and not auto:
+            error = f"❌ *O'YINCHILAR YETARLI EMAS!*\n\n{MIN_PLAYERS - len(game['players'])} kishi ko'proq kerak!"
+            players = None
+        else:
+            error = None
+            players = list(game["players"])
         
-        # Har bir o'yinchiga roli haqida xabar
+        if players is not None:
+            cancel_registration_timer(chat_id)
+            
+            num_special = min(3, len(players))
+            roles_list = ["🤵🏻 Дон", "💉 Доктор", "🕵️ Комиссар"][:num_special]
+            
+            if len(players) >= 5:
+                roles_list.append("👴 Daydi")
+                num_special = min(4, len(players))
+            
+            assigned: Dict[int, str] = {}
+            available_special = roles_list.copy()
+            
+            with PROFILE_LOCK:
+                guaranteed = [p for p in players if profiles.get(uid_str(p), {}).get("guaranteed_active_role")]
+                random.shuffle(guaranteed)
+                
+                for p in guaranteed:
+                    if not available_special:
+                        break
+                    assigned[p] = available_special.pop(0)
+                    profiles[uid_str(p)]["guaranteed_active_role"] = False
+            
+            remaining = [p for p in players if p not in assigned]
+            random.shuffle(remaining)
+            remaining_roles = available_special + ["👨🏼 Мирный житель"] * (len(remaining) - len(available_special))
+            random.shuffle(remaining_roles)
+            
+            for p, r in zip(remaining, remaining_roles):
+                assigned[p] = r
+            
+            game["roles"] = {uid_str(p): assigned[p] for p in assigned}
+            game["state"] = "started"
+            game["alive"] = players.copy()
+            game["phase"] = "night_mafia"
+            game["votes"] = {}
+            game["night_kill"] = None
+            game["doctor_save"] = None
+            game["kill_count"] = {uid_str(p): 0 for p in players}
+            game["started_at"] = int(time.time())
+            game["phase_start_time"] = int(time.time())
+            game["current_night_msgs"] = []
+            game["daydi_power_used"] = False
+            game["chat_allowed"] = True
+            index_players(key, players)
+            journal_game(key, "roles", players=len(players))
+    
+    if players is None:
+        if error:
+            OUTBOX.send(chat_id, error, priority=PRIORITY_CRITICAL)
+        return
+    
+    # Har bir o'yinchiga roli haqida xabar (bir vaqtda)
+    fan_out({p: (funny_role_messages(assigned.get(p, "👨🏼 Мирный житель")), {}) for p in players},
+            functools.partial(report_unreachable, chat_id))
+    
+    names = {p: get_username_id(p) for p in players}
+    with PROFILE_LOCK:
         for p in players:
-            role = assigned.get(p, "👨🏼 Мирный житель")
-            try:
-                role_text = funny_role_messages(role)
-                safe_api(bot.send_message, p, role_text)
-                ensure_profile(p, get_username_id(p))
-                profiles[uid_str(p)]["doctor_save_used"] = False
-            except Exception:
-                logger.exception("failed send role to %s", p)
-        
-        persist_profiles()
-        persist_games()
+            ensure_profile(p, names[p])
+            profiles[uid_str(p)]["doctor_save_used"] = False
+    persist_profiles(*players)
     
     # Guruhga start xabari
-    players_list = "\n".join([f"{i}. {get_username_id(p)}" for i, p in enumerate(players, 1)])
+    players_list = "\n".join([f"{i}. {names[p]}" for i, p in enumerate(players, 1)])
     start_text = (
         "🎭 *O'YIN BOSHLANDI!*\n\n"
         "🤫 Har bir o'yinchi o'z rolini oldi!\n"
@@ -1762,15 +4143,11 @@ def begin_game_by_chat(chat_id: int, auto: bool = False) -> None:
         "🎮 Omad! 🍀"
     )
     
-    sent = safe_send_message(chat_id, start_text)
-    if sent:
-        with LOCK:
-            games[key]["bot_messages"].append(sent.message_id)
-            persist_games()
-    
+    send_game_message(chat_id, start_text)
     send_mafia_vote(chat_id)
 
 @bot.message_handler(commands=['begin'])
+@in_chat_actor(chat_of_message)
 def begin_cmd(message):
     if message.chat.type not in ("group", "supergroup"):
         safe_send_and_reply(message.chat.id, message.message_id, "⚠️ Bu buyruq faqat guruhlar uchun!")
@@ -1781,37 +4158,33 @@ def begin_cmd(message):
 def send_mafia_vote(chat_id: int) -> None:
     key = cid_str(chat_id)
     
-    night_text = funny_night_message()
-    sent = safe_send_message(chat_id, night_text)
-    if sent:
-        with LOCK:
-            if key in games:
-                games[key]["bot_messages"].append(sent.message_id)
-    
-    with LOCK:
+    with chat_lock(chat_id):
         game = games.get(key)
         if not game:
             return
         
+        # Yangi tun: oldingi tun/kun tugmalari eskiradi
+        game["round"] = game.get("round", 0) + 1
+        stamp = button_stamp(game)
         roles = game.get("roles", {})
         alive = list(game.get("alive", []))
         mafia = [int(uid) for uid, r in roles.items() if "Дон" in r and int(uid) in alive]
+        
+        if not mafia:
+            game["phase"] = "night_doctor"
+            game["phase_start_time"] = int(time.time())
+            persist_games(key)
+    
+    send_game_message(chat_id, funny_night_message())
     
     if not mafia:
-        with LOCK:
-            games[key]["phase"] = "night_doctor"
-            games[key]["phase_start_time"] = int(time.time())
-            persist_games()
         send_doctor_save(chat_id)
         return
     
     # Har bir mafia uchun ovoz berish tugmalari
+    prompts = {}
     for m in mafia:
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        for t in alive:
-            if t == m:
-                continue
-            kb.add(types.InlineKeyboardButton(f"🎯 {get_username_id(t)}", callback_data=f"mafia_kill:{t}"))
+        kb = target_markup(chat_id, stamp, alive, "mafia", exclude=m)
         
         mafia_text = (
             "😈 *MAFIA — TANLOV VAQTI!*\n\n"
@@ -1819,38 +4192,43 @@ def send_mafia_vote(chat_id: int) -> None:
             "🤔 O'ylab ko'ring — qaroringiz muhim!"
         )
         
-        safe_api(bot.send_message, m, mafia_text, reply_markup=kb)
+        prompts[m] = (mafia_text, {"reply_markup": kb})
     
+    fan_out(prompts, functools.partial(report_unreachable, chat_id))
     start_phase_timer(chat_id, NIGHT_TIMEOUT, night_timeout)
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("mafia_kill:"))
+@ROUTER.callback("k")
+@game_button
+@in_chat_actor(callback_game_chat)
 def mafia_kill_callback(call):
     try:
         voter = call.from_user.id
-        target = int(call.data.split(":", 1)[1])
-        chat_id = call.message.chat.id
+        target = call.target
+        chat_id = callback_game_chat(call)
         key = cid_str(chat_id)
         
-        with LOCK:
+        with chat_lock(chat_id):
             game = games.get(key)
-            if not game or game.get("state") != "started":
-                safe_answer_callback(call, "⚠️ O'yin faol emas!")
-                return
-            
-            if game.get("phase") != "night_mafia":
-                safe_answer_callback(call, "⚠️ Mafia tanlov vaqti emas!")
-                return
-            
-            roles = game.get("roles", {})
+            roles = (game or {}).get("roles", {})
             voter_role = roles.get(uid_str(voter))
-            if not voter_role or "Дон" not in voter_role:
-                safe_answer_callback(call, "⚠️ Siz mafia emassiz!")
-                return
-            
-            game["night_kill"] = target
-            game["phase"] = "night_doctor"
-            game["phase_start_time"] = int(time.time())
-            persist_games()
+            if not game or game.get("state") != "started":
+                error = "⚠️ O'yin faol emas!"
+            elif not button_current(game, call):
+                error = "⌛ Bu tugma eskirgan!"
+            elif game.get("phase") != "night_mafia":
+                error = "⚠️ Mafia tanlov vaqti emas!"
+            elif not voter_role or "Дон" not in voter_role:
+                error = "⚠️ Siz mafia emassiz!"
+            else:
+                error = None
+                game["night_kill"] = target
+                game["phase"] = "night_doctor"
+                game["phase_start_time"] = int(time.time())
+                journal_game(key, "mafia_kill", voter=voter, target=target)
+        
+        if error:
+            safe_answer_callback(call, error)
+            return
         
         safe_answer_callback(call, f"✅ {get_username_id(target)} ni tanladingiz!")
         send_doctor_save(chat_id)
@@ -1861,28 +4239,29 @@ def mafia_kill_callback(call):
 def send_doctor_save(chat_id: int) -> None:
     key = cid_str(chat_id)
     
-    with LOCK:
+    with chat_lock(chat_id):
         game = games.get(key)
         if not game:
             return
         
+        stamp = button_stamp(game)
         roles = game.get("roles", {})
         alive = list(game.get("alive", []))
         doctors = [int(uid) for uid, r in roles.items() if "Доктор" in r and int(uid) in alive]
+        
+        if not doctors:
+            game["phase"] = "night_comissar"
+            game["phase_start_time"] = int(time.time())
+            persist_games(key)
     
     if not doctors:
-        with LOCK:
-            games[key]["phase"] = "night_comissar"
-            games[key]["phase_start_time"] = int(time.time())
-            persist_games()
         send_comissar_check(chat_id)
         return
     
     # Har bir doktor uchun tugmalar
+    prompts = {}
     for d in doctors:
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        for t in alive:
-            kb.add(types.InlineKeyboardButton(f"🩺 {get_username_id(t)}", callback_data=f"doctor_save:{t}"))
+        kb = target_markup(chat_id, stamp, alive, "doctor")
         
         doctor_text = (
             "💉 *DOKTOR — QUTQARISH VAQTI!*\n\n"
@@ -1890,45 +4269,51 @@ def send_doctor_save(chat_id: int) -> None:
             "💊 Bir kishini davolashingiz mumkin!"
         )
         
-        safe_api(bot.send_message, d, doctor_text, reply_markup=kb)
+        prompts[d] = (doctor_text, {"reply_markup": kb})
     
+    fan_out(prompts, functools.partial(report_unreachable, chat_id))
     start_phase_timer(chat_id, NIGHT_TIMEOUT, night_timeout)
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("doctor_save:"))
+@ROUTER.callback("s")
+@game_button
+@in_chat_actor(callback_game_chat)
 def doctor_save_callback(call):
     try:
         voter = call.from_user.id
-        target = int(call.data.split(":", 1)[1])
-        chat_id = call.message.chat.id
+        target = call.target
+        chat_id = callback_game_chat(call)
         key = cid_str(chat_id)
         
-        with LOCK:
+        with chat_lock(chat_id):
             game = games.get(key)
-            if not game or game.get("state") != "started":
-                safe_answer_callback(call, "⚠️ O'yin faol emas!")
-                return
-            
-            if game.get("phase") != "night_doctor":
-                safe_answer_callback(call, "⚠️ Doktor tanlov vaqti emas!")
-                return
-            
-            roles = game.get("roles", {})
+            roles = (game or {}).get("roles", {})
             voter_role = roles.get(uid_str(voter))
-            if not voter_role or "Доктор" not in voter_role:
-                safe_answer_callback(call, "⚠️ Siz doktor emassiz!")
-                return
-            
-            prof = ensure_profile(voter)
-            if prof["doctor_save_used"]:
-                safe_answer_callback(call, "⚠️ Siz allaqachon qutqardingiz!")
-                return
-            
-            game["doctor_save"] = target
-            prof["doctor_save_used"] = True
-            game["phase"] = "night_comissar"
-            game["phase_start_time"] = int(time.time())
-            persist_games()
-            persist_profiles()
+            if not game or game.get("state") != "started":
+                error = "⚠️ O'yin faol emas!"
+            elif not button_current(game, call):
+                error = "⌛ Bu tugma eskirgan!"
+            elif game.get("phase") != "night_doctor":
+                error = "⚠️ Doktor tanlov vaqti emas!"
+            elif not voter_role or "Доктор" not in voter_role:
+                error = "⚠️ Siz doktor emassiz!"
+            else:
+                with PROFILE_LOCK:
+                    prof = ensure_profile(voter)
+                    if prof["doctor_save_used"]:
+                        error = "⚠️ Siz allaqachon qutqardingiz!"
+                    else:
+                        error = None
+                        prof["doctor_save_used"] = True
+                        persist_profiles(voter)
+                if not error:
+                    game["doctor_save"] = target
+                    game["phase"] = "night_comissar"
+                    game["phase_start_time"] = int(time.time())
+                    journal_game(key, "doctor_save", voter=voter, target=target)
+        
+        if error:
+            safe_answer_callback(call, error)
+            return
         
         safe_answer_callback(call, f"✅ {get_username_id(target)} ni qutqardingiz!")
         send_comissar_check(chat_id)
@@ -1939,30 +4324,29 @@ def doctor_save_callback(call):
 def send_comissar_check(chat_id: int) -> None:
     key = cid_str(chat_id)
     
-    with LOCK:
+    with chat_lock(chat_id):
         game = games.get(key)
         if not game:
             return
         
+        stamp = button_stamp(game)
         roles = game.get("roles", {})
         alive = list(game.get("alive", []))
         comissars = [int(uid) for uid, r in roles.items() if "Комиссар" in r and int(uid) in alive]
+        
+        if not comissars:
+            game["phase"] = "day"
+            game["phase_start_time"] = int(time.time())
+            persist_games(key)
     
     if not comissars:
-        with LOCK:
-            games[key]["phase"] = "day"
-            games[key]["phase_start_time"] = int(time.time())
-            persist_games()
         start_day(chat_id)
         return
     
     # Har bir komissar uchun tugmalar
+    prompts = {}
     for c in comissars:
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        for t in alive:
-            if t == c:
-                continue
-            kb.add(types.InlineKeyboardButton(f"🔍 {get_username_id(t)}", callback_data=f"comissar_check:{t}"))
+        kb = target_markup(chat_id, stamp, alive, "comissar", exclude=c)
         
         comissar_text = (
             "🕵️ *KOMISSAR — TEKSHIRISH VAQTI!*\n\n"
@@ -1970,38 +4354,43 @@ def send_comissar_check(chat_id: int) -> None:
             "🎭 Rolni aniqlang va haqiqatni oching!"
         )
         
-        safe_api(bot.send_message, c, comissar_text, reply_markup=kb)
+        prompts[c] = (comissar_text, {"reply_markup": kb})
     
+    fan_out(prompts, functools.partial(report_unreachable, chat_id))
     start_phase_timer(chat_id, NIGHT_TIMEOUT, night_timeout)
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("comissar_check:"))
+@ROUTER.callback("c")
+@game_button
+@in_chat_actor(callback_game_chat)
 def comissar_check_callback(call):
     try:
         voter = call.from_user.id
-        target = int(call.data.split(":", 1)[1])
-        chat_id = call.message.chat.id
+        target = call.target
+        chat_id = callback_game_chat(call)
         key = cid_str(chat_id)
         
-        with LOCK:
+        with chat_lock(chat_id):
             game = games.get(key)
-            if not game or game.get("state") != "started":
-                safe_answer_callback(call, "⚠️ O'yin faol emas!")
-                return
-            
-            if game.get("phase") != "night_comissar":
-                safe_answer_callback(call, "⚠️ Komissar tanlov vaqti emas!")
-                return
-            
-            roles = game.get("roles", {})
+            roles = (game or {}).get("roles", {})
             voter_role = roles.get(uid_str(voter))
-            if not voter_role or "Комиссар" not in voter_role:
-                safe_answer_callback(call, "⚠️ Siz komissar emassiz!")
-                return
-            
-            target_role = roles.get(uid_str(target), "👨🏼 Мирный житель")
-            game["phase"] = "day"
-            game["phase_start_time"] = int(time.time())
-            persist_games()
+            if not game or game.get("state") != "started":
+                error = "⚠️ O'yin faol emas!"
+            elif not button_current(game, call):
+                error = "⌛ Bu tugma eskirgan!"
+            elif game.get("phase") != "night_comissar":
+                error = "⚠️ Komissar tanlov vaqti emas!"
+            elif not voter_role or "Комиссар" not in voter_role:
+                error = "⚠️ Siz komissar emassiz!"
+            else:
+                error = None
+                target_role = roles.get(uid_str(target), "👨🏼 Мирный житель")
+                game["phase"] = "day"
+                game["phase_start_time"] = int(time.time())
+                journal_game(key, "comissar_check", voter=voter, target=target)
+        
+        if error:
+            safe_answer_callback(call, error)
+            return
         
         safe_answer_callback(call, f"✅ {get_username_id(target)} ning roli: {target_role}")
         start_day(chat_id)
@@ -2009,9 +4398,10 @@ def comissar_check_callback(call):
     except Exception as e:
         logger.exception("comissar_check_callback failed: %s", e)
 
+@in_chat_actor(chat_of_arg)
 def night_timeout(chat_id: int) -> None:
     key = cid_str(chat_id)
-    with LOCK:
+    with chat_lock(chat_id):
         game = games.get(key)
         if not game:
             return
@@ -2027,13 +4417,13 @@ def night_timeout(chat_id: int) -> None:
         
         game["phase"] = "day"
         game["phase_start_time"] = int(time.time())
-        persist_games()
+        journal_game(key, "night_timeout", night_kill=game.get("night_kill"))
     
     start_day(chat_id)
 
 def start_day(chat_id: int) -> None:
     key = cid_str(chat_id)
-    with LOCK:
+    with chat_lock(chat_id):
         game = games.get(key)
         if not game:
             return
@@ -2043,32 +4433,18 @@ def start_day(chat_id: int) -> None:
         prevented_by_protection = False
         
         if victim is not None:
-            vic_prof = ensure_profile(victim, get_username_id(victim))
-            if vic_prof.get("protection_active"):
-                prevented_by_protection = True
-                vic_prof["protection_active"] = False
-                persist_profiles()
-        
+            with PROFILE_LOCK:
+                vic_prof = ensure_profile(victim)
+                if vic_prof.get("protection_active"):
+                    prevented_by_protection = True
+                    vic_prof["protection_active"] = False
+                    persist_profiles(victim)
+        
+        killed = False
         if victim is not None and victim != saved and not prevented_by_protection:
             if victim in game["alive"]:
                 game["alive"].remove(victim)
-                day_text = f"☠️ *KECHASI O'LDI:* {get_username_id(victim)}\n\nKim qildi? Nima uchun? 🤔"
-                sent = safe_send_message(chat_id, day_text)
-                if sent:
-                    game["bot_messages"].append(sent.message_id)
-            else:
-                day_text = funny_day_message()
-                sent = safe_send_message(chat_id, day_text)
-                if sent:
-                    game["bot_messages"].append(sent.message_id)
-        else:
-            if prevented_by_protection:
-                day_text = "☀️ *ERTALAB...*\n\n🎉 Hamma tirik!\n🛡 Kimdir himoya qildi!"
-            else:
-                day_text = funny_day_message()
-            sent = safe_send_message(chat_id, day_text)
-            if sent:
-                game["bot_messages"].append(sent.message_id)
+                killed = True
         
         game["night_kill"] = None
         game["doctor_save"] = None
@@ -2077,7 +4453,15 @@ def start_day(chat_id: int) -> None:
         game["phase_start_time"] = int(time.time())
         game["chat_allowed"] = True  # Kun davomida chat ochiq
         alive_now = list(game.get("alive", []))
-        persist_games()
+        journal_game(key, "day", victim=victim, saved=saved)
+    
+    if killed:
+        day_text = f"☠️ *KECHASI O'LDI:* {get_username_id(victim)}\n\nKim qildi? Nima uchun? 🤔"
+    elif prevented_by_protection:
+        day_text = "☀️ *ERTALAB...*\n\n🎉 Hamma tirik!\n🛡 Kimdir himoya qildi!"
+    else:
+        day_text = funny_day_message()
+    send_game_message(chat_id, day_text)
     
     # Tirik o'yinchilar ro'yxati
     alive_list = "\n".join([f"{i}. {get_username_id(p)}" for i, p in enumerate(alive_now, 1)]) or "—"
@@ -2087,88 +4471,103 @@ def start_day(chat_id: int) -> None:
         f"🗣 Muhokama qiling! (Chat ochiq)\n⏳ Vaqt: {DAY_TIMEOUT} soniya"
     )
     
-    sent = safe_send_message(chat_id, day_info)
-    if sent:
-        with LOCK:
-            if key in games:
-                games[key]["bot_messages"].append(sent.message_id)
-                persist_games()
-    
+    send_game_message(chat_id, day_info)
     send_day_vote_buttons(chat_id)
     start_phase_timer(chat_id, DAY_TIMEOUT, day_timeout)
 
+def day_vote_text(votes: Dict[str, int], alive: List[int]) -> str:
+    text = (
+        "⚖️ *OVOZ BERISH VAQTI!*\n\n"
+        "Kim shubhali?\nKim haqiqatni yashirayapti?\n\n"
+        "👇 Tanlang va boshlang!"
+    )
+    if votes:
+        counts = Counter(votes.values())
+        text += f"\n\n📊 *OVOZLAR* ({len(votes)}/{len(alive)}):\n"
+        text += "\n".join(f"{get_username_id(target)} — {n} 🗳" for target, n in counts.most_common())
+    return text
+
 def send_day_vote_buttons(chat_id: int) -> None:
     key = cid_str(chat_id)
-    with LOCK:
+    with chat_lock(chat_id):
         game = games.get(key)
         if not game:
             return
         alive = list(game.get("alive", []))
+        stamp = button_stamp(game)
     
     if not alive:
         return
     
-    kb = types.InlineKeyboardMarkup(row_width=2)
-    for p in alive:
-        kb.add(types.InlineKeyboardButton(f"🗳️ {get_username_id(p)}", callback_data=f"vote:{p}"))
-    
-    vote_text = (
-        "⚖️ *OVOZ BERISH VAQTI!*\n\n"
-        "Kim shubhali?\nKim haqiqatni yashirayapti?\n\n"
-        "👇 Tanlang va boshlang!"
-    )
+    send_game_message(chat_id, day_vote_text({}, alive), field="vote_msg_id",
+                      reply_markup=target_markup(chat_id, stamp, alive, "vote"))
+
+def schedule_vote_tally(chat_id: int) -> None:
+    """Ovozlar jadvalini yangilash (debounce): oraliq ichidagi ovozlar bitta tahrirga yig'iladi"""
+    if (cid_str(chat_id), "tally") not in chat_timers:
+        schedule_chat_timer(chat_id, "tally", VOTE_TALLY_INTERVAL, update_vote_tally)
+
+def update_vote_tally(chat_id: int) -> None:
+    # Guruh navbatida bajariladi: ovoz berish xabari (vote_msg_id) shu paytgacha yuborilgan bo'ladi
+    OUTBOX.call(chat_id, refresh_vote_tally, chat_id, priority=PRIORITY_COSMETIC)
+
+def refresh_vote_tally(chat_id: int) -> None:
+    key = cid_str(chat_id)
+    with chat_lock(chat_id):
+        game = games.get(key)
+        if not game or game.get("phase") != "day" or not game.get("vote_msg_id"):
+            return
+        votes = dict(game.get("votes", {}))
+        alive = list(game.get("alive", []))
+        msg_id = game["vote_msg_id"]
+        stamp = button_stamp(game)
     
-    sent = safe_send_message(chat_id, vote_text, reply_markup=kb)
-    if sent:
-        with LOCK:
-            games[key]["vote_msg_id"] = sent.message_id
-            games[key]["bot_messages"].append(sent.message_id)
-            persist_games()
+    # Xato ko'tariladi: 429 va vaqtinchalik xatolarni OUTBOX qayta urinadi
+    call_api(bot.edit_message_text, day_vote_text(votes, alive), chat_id, msg_id,
+             reply_markup=target_markup(chat_id, stamp, alive, "vote"))
 
-@bot.callback_query_handler(func=lambda c: c.data and c.data.startswith("vote:"))
+@ROUTER.callback("v")
+@game_button
+@in_chat_actor(callback_game_chat)
 def vote_handler(call):
     try:
         voter = call.from_user.id
-        target = int(call.data.split(":", 1)[1])
-        chat_id = call.message.chat.id
+        target = call.target
+        chat_id = callback_game_chat(call)
         key = cid_str(chat_id)
         
-        with LOCK:
+        with chat_lock(chat_id):
             game = games.get(key)
             if not game or game.get("state") != "started":
-                safe_answer_callback(call, "⚠️ O'yin faol emas!")
-                return
-            
-            if game.get("phase") != "day":
-                safe_answer_callback(call, "⚠️ Ovoz berish vaqti emas!")
-                return
-            
-            if voter not in game["alive"]:
-                safe_answer_callback(call, "☠️ Siz o'liksiz! Ovoz bera olmaysiz!")
-                return
-            
-            if target not in game.get("alive", []):
-                safe_answer_callback(call, "⚠️ Bu o'yinchi o'lik!")
-                return
-            
-            game["votes"][uid_str(voter)] = target
-            persist_games()
+                error = "⚠️ O'yin faol emas!"
+            elif not button_current(game, call):
+                error = "⌛ Bu tugma eskirgan!"
+            elif game.get("phase") != "day":
+                error = "⚠️ Ovoz berish vaqti emas!"
+            elif voter not in game["alive"]:
+                error = "☠️ Siz o'liksiz! Ovoz bera olmaysiz!"
+            elif target not in game.get("alive", []):
+                error = "⚠️ Bu o'yinchi o'lik!"
+            else:
+                error = None
+                game["votes"][uid_str(voter)] = target
+                journal_game(key, "vote", voter=voter, target=target)
+        
+        if error:
+            safe_answer_callback(call, error)
+            return
         
-        vote_text = funny_vote_message(get_username_id(voter), get_username_id(target))
         safe_answer_callback(call, "✅ Ovozingiz qabul qilindi!")
-        sent = safe_send_message(chat_id, vote_text)
-        if sent:
-            with LOCK:
-                if key in games:
-                    games[key]["bot_messages"].append(sent.message_id)
-                    persist_games()
+        schedule_vote_tally(chat_id)
         
     except Exception as e:
         logger.exception("vote_handler failed: %s", e)
 
+@in_chat_actor(chat_of_arg)
 def day_timeout(chat_id: int) -> None:
     key = cid_str(chat_id)
-    with LOCK:
+    cancel_chat_timer(chat_id, "tally")
+    with chat_lock(chat_id):
         game = games.get(key)
         if not game:
             return
@@ -2178,6 +4577,8 @@ def day_timeout(chat_id: int) -> None:
         
         votes = game.get("votes", {})
         alive = list(game.get("alive", []))
+        victim = None
+        by_daydi = False
         
         # Daydi ni aniqlash
         daydi_player = None
@@ -2197,56 +4598,50 @@ def day_timeout(chat_id: int) -> None:
             # Daydi o'z ovozini bergan odamni tanlash
             if daydi_vote in alive:
                 victim = daydi_vote
-                
-                if victim in alive:
-                    alive.remove(victim)
-                    game["alive"] = alive
-                    
-                    victim_role = game["roles"].get(uid_str(victim), "👨🏼 Мирный житель")
-                    execution_text = f"👴 *DAYDI KUCHI ISHLATILDI!*\n\n{funny_execution_message(get_username_id(victim), victim_role)}"
-                    sent = safe_send_message(chat_id, execution_text)
-                    if sent:
-                        game["bot_messages"].append(sent.message_id)
-                    
-                    # G'alaba tekshiruvi
-                    check_victory(chat_id)
-                    return
+                by_daydi = True
         
         # Agar Daydi kuchi ishlatilmagan yoki Daydi yo'q bo'lsa, oddiy ovoz hisoblash
-        vote_counts = Counter(votes.values())
-        if vote_counts:
-            max_votes = max(vote_counts.values())
-            candidates = [uid for uid, count in vote_counts.items() if count == max_votes]
-            
-            if len(candidates) == 1 and max_votes >= 1:
-                victim = candidates[0]
-                if victim in alive:
-                    alive.remove(victim)
-                    game["alive"] = alive
-                    
-                    victim_role = game["roles"].get(uid_str(victim), "👨🏼 Мирный житель")
-                    execution_text = funny_execution_message(get_username_id(victim), victim_role)
-                    sent = safe_send_message(chat_id, execution_text)
-                    if sent:
-                        game["bot_messages"].append(sent.message_id)
-                    
-                    check_victory(chat_id)
-                    return
-        
-        sent = safe_send_message(chat_id, "🤝 *HECH KIM O'LMAYDI!*\n\nOvozlar teng bo'ldi yoki kam!")
-        if sent:
-            game["bot_messages"].append(sent.message_id)
+        if victim is None:
+            vote_counts = Counter(votes.values())
+            if vote_counts:
+                max_votes = max(vote_counts.values())
+                candidates = [uid for uid, count in vote_counts.items() if count == max_votes]
+                
+                if len(candidates) == 1 and max_votes >= 1 and candidates[0] in alive:
+                    victim = candidates[0]
         
-        game["phase"] = "night_mafia"
-        game["phase_start_time"] = int(time.time())
-        game["votes"] = {}
-        persist_games()
+        if victim is not None:
+            alive.remove(victim)
+            game["alive"] = alive
+            victim_role = game["roles"].get(uid_str(victim), "👨🏼 Мирный житель")
+            if by_daydi:
+                journal_game(key, "execution", victim=victim, daydi=True)
+            else:
+                journal_game(key, "execution", victim=victim)
+        else:
+            game["phase"] = "night_mafia"
+            game["phase_start_time"] = int(time.time())
+            game["votes"] = {}
+            journal_game(key, "execution", victim=None)
     
-    send_mafia_vote(chat_id)
+    if victim is not None:
+        execution_text = funny_execution_message(get_username_id(victim), victim_role)
+        if by_daydi:
+            execution_text = f"👴 *DAYDI KUCHI ISHLATILDI!*\n\n{execution_text}"
+    else:
+        execution_text = "🤝 *HECH KIM O'LMAYDI!*\n\nOvozlar teng bo'ldi yoki kam!"
+    
+    send_game_message(chat_id, execution_text)
+    
+    if victim is not None:
+        # G'alaba tekshiruvi
+        check_victory(chat_id)
+    else:
+        send_mafia_vote(chat_id)
 
 def check_victory(chat_id: int) -> None:
     key = cid_str(chat_id)
-    with LOCK:
+    with chat_lock(chat_id):
         game = games.get(key)
         if not game:
             return
@@ -2262,44 +4657,53 @@ def check_victory(chat_id: int) -> None:
         
         # G'alaba tekshiruvi
         if mafia_count == 0:
-            for uid in alive:
-                if "Дон" not in roles.get(uid_str(uid), ""):
-                    prof = ensure_profile(uid)
-                    prof["money"] += 20
-                    prof["games_played"] = prof.get("games_played", 0) + 1
-                    prof["wins"] = prof.get("wins", 0) + 1
-            persist_profiles()
-            send_final_stats_and_cleanup(chat_id, "Мирные жители")
+            winner = "Мирные жители"
+            with PROFILE_LOCK:
+                for uid in alive:
+                    if "Дон" not in roles.get(uid_str(uid), ""):
+                        prof = ensure_profile(uid)
+                        prof["money"] += 20
+                        prof["games_played"] = prof.get("games_played", 0) + 1
+                        prof["wins"] = prof.get("wins", 0) + 1
+                persist_profiles(*alive)
         
         elif mafia_count >= civilian_count:
-            for uid in alive:
-                if "Дон" in roles.get(uid_str(uid), ""):
-                    prof = ensure_profile(uid)
-                    prof["money"] += 10
-                    prof["games_played"] = prof.get("games_played", 0) + 1
-                    prof["wins"] = prof.get("wins", 0) + 1
-            persist_profiles()
-            send_final_stats_and_cleanup(chat_id, "Мафия")
+            winner = "Мафия"
+            with PROFILE_LOCK:
+                for uid in alive:
+                    if "Дон" in roles.get(uid_str(uid), ""):
+                        prof = ensure_profile(uid)
+                        prof["money"] += 10
+                        prof["games_played"] = prof.get("games_played", 0) + 1
+                        prof["wins"] = prof.get("wins", 0) + 1
+                persist_profiles(*alive)
         
         else:
+            winner = None
             game["phase"] = "night_mafia"
             game["phase_start_time"] = int(time.time())
             game["votes"] = {}
-            persist_games()
-            send_mafia_vote(chat_id)
+            journal_game(key, "night")
+    
+    if winner:
+        send_final_stats_and_cleanup(chat_id, winner)
+    else:
+        send_mafia_vote(chat_id)
 
+@in_chat_actor(chat_of_arg)
 def send_final_stats_and_cleanup(chat_id: int, winner: str) -> None:
     key = cid_str(chat_id)
-    with LOCK:
+    with chat_lock(chat_id):
         game = games.get(key)
-        if not game:
+        if not game or game.get("finishing"):
+            # Yakunlash boshqa oqimda allaqachon boshlangan
             return
+        game["finishing"] = True
         
         players = list(game.get("players", []))
         roles = dict(game.get("roles", {}))
         alive_now = set(game.get("alive", []))
         started = game.get("started_at") or int(time.time())
-        bot_messages = list(game.get("bot_messages", []))
     
     victory_text = funny_victory_message(winner)
     
@@ -2316,41 +4720,45 @@ def send_final_stats_and_cleanup(chat_id: int, winner: str) -> None:
     stats_text += f"🏆 G'olib: {winner}\n\n"
     stats_text += "🎮 Keyingi o'yinga tayyormisiz? /startgame"
     
-    sent = safe_send_message(chat_id, victory_text + stats_text)
-    
-    # 10 soniyadan so'ng bot xabarlarini o'chirish
-    threading.Timer(10, lambda: cleanup_game_messages(chat_id, bot_messages)).start()
+    # Natija xabari guruh navbatida oxirgi: undan oldingi xabarlar ID lari o'yinga
+    # yozib bo'lingan. 10 soniyadan so'ng bot xabarlarini o'chirish
+    def schedule_cleanup(_sent):
+        bot_messages = list(game.get("bot_messages", []))
+        SCHEDULER.call_later(10, lambda: cleanup_game_messages(chat_id, bot_messages))
+    OUTBOX.send(chat_id, victory_text + stats_text, on_sent=schedule_cleanup, priority=PRIORITY_CRITICAL)
     
     # Tarixga qo'shish va o'yinni tozalash
-    with LOCK:
-        history.append({
+    with chat_lock(chat_id):
+        append_history({
             "chat_id": chat_id,
-            "finished_at": int(time.time()),
+            "started_at": started,
+            "finished_at": started + took,
+            "duration": took,
             "winner": winner,
             "players": players,
             "roles": roles,
         })
-        persist_history()
-        games.pop(key, None)
-        persist_games()
+        # Yakuniy holat "victory" bilan birga yoziladi; yozuv va jurnal cleanup'da o'chiriladi
+        game["state"] = "finished"
+        journal_game(key, "victory", winner=winner)
+        unregister_game(key)
     
     cancel_phase_timer(chat_id)
     cancel_registration_timer(chat_id)
 
+@in_chat_actor(chat_of_arg)
 def cleanup_game_messages(chat_id: int, message_ids: List[int]) -> None:
     """O'yin tugagandan so'ng bot xabarlarini o'chirish"""
-    for msg_id in message_ids:
-        try:
-            safe_api(bot.delete_message, chat_id, msg_id)
-        except Exception:
-            # Agar xabar allaqachon o'chirilgan bo'lsa, xato berishi mumkin
-            pass
+    queue_deletes(chat_id, message_ids)
     
     # Global tarixdan ham o'chirish
     key = cid_str(chat_id)
-    with LOCK:
+    with chat_lock(chat_id):
         if key in bot_message_history:
             bot_message_history.pop(key, None)
+        # Tugagan o'yin yozuvi jurnali bilan o'chiriladi (chatda yangi o'yin bo'lmasa)
+        if key not in games:
+            persist_games(key)
 
 # ============================ PROFIL VA DO'KON ============================
 @bot.message_handler(commands=['profile'])
@@ -2380,19 +4788,21 @@ def cmd_profile(msg):
     
     safe_api(bot.send_message, uid, profile_text, reply_markup=profile_reply_markup(uid=uid))
 
-@bot.message_handler(func=lambda m: m.chat.type == "private" and m.text == "💠 Olmos ishlatish")
+@ROUTER.text("💠 Olmos ishlatish")
 def use_diamond(msg):
     uid = msg.from_user.id
     prof = ensure_profile(uid, get_username_obj(msg.from_user))
     
-    with LOCK:
-        if prof["diamonds"] <= 0:
-            safe_api(bot.send_message, uid, "😕 *OLMOSLARINGIZ YO'Q!*\n\nDo'konga boring va sotib oling! 🛒")
-            return
-        
-        prof["diamonds"] -= 1
-        prof["guaranteed_active_role"] = True
-        persist_profiles()
+    with PROFILE_LOCK:
+        has_diamond = prof["diamonds"] > 0
+        if has_diamond:
+            prof["diamonds"] -= 1
+            prof["guaranteed_active_role"] = True
+            persist_profiles(uid)
+    
+    if not has_diamond:
+        safe_api(bot.send_message, uid, "😕 *OLMOSLARINGIZ YO'Q!*\n\nDo'konga boring va sotib oling! 🛒")
+        return
     
     diamond_text = (
         "✨ *OLMOS ISHLATILDI!*\n\n"
@@ -2403,26 +4813,30 @@ def use_diamond(msg):
     
     safe_api(bot.send_message, uid, diamond_text, reply_markup=profile_reply_markup(uid=uid))
 
-@bot.message_handler(func=lambda m: m.chat.type == "private" and m.text.startswith("🛡 Himoya sotib olish"))
+@ROUTER.text("🛡 Himoya sotib olish")
 def use_money_for_protection(msg):
     uid = msg.from_user.id
     prof = ensure_profile(uid, get_username_obj(msg.from_user))
     
-    with LOCK:
-        if prof["protection_active"]:
-            safe_api(bot.send_message, uid, "🛡️ *SIZDA ALLAQACHON HIMOYA BOR!*\n\nBir marta ishlata olasiz!")
-            return
-        
-        if prof["money"] < 100:
-            safe_api(bot.send_message, uid, 
-                    f"💰 *PUL YETARLI EMAS!*\n\n"
-                    f"100 so'm kerak, sizda {prof['money']} so'm bor.\n"
-                    f"O'yinda g'alaba qilib pul ishlang!")
-            return
-        
-        prof["money"] -= 100
-        prof["protection_active"] = True
-        persist_profiles()
+    with PROFILE_LOCK:
+        already_active = prof["protection_active"]
+        money = prof["money"]
+        bought = not already_active and money >= 100
+        if bought:
+            prof["money"] -= 100
+            prof["protection_active"] = True
+            persist_profiles(uid)
+    
+    if already_active:
+        safe_api(bot.send_message, uid, "🛡️ *SIZDA ALLAQACHON HIMOYA BOR!*\n\nBir marta ishlata olasiz!")
+        return
+    
+    if not bought:
+        safe_api(bot.send_message, uid, 
+                f"💰 *PUL YETARLI EMAS!*\n\n"
+                f"100 so'm kerak, sizda {money} so'm bor.\n"
+                f"O'yinda g'alaba qilib pul ishlang!")
+        return
     
     protection_text = (
         "✅ *HIMOYA SOTIB OLINDI!*\n\n"
@@ -2434,7 +4848,7 @@ def use_money_for_protection(msg):
     safe_api(bot.send_message, uid, protection_text, reply_markup=profile_reply_markup(uid=uid))
 
 # ============================ BOSH MENYU TUGMALARI ============================
-@bot.message_handler(func=lambda m: m.chat.type == "private" and m.text == "🎮 O'ynash")
+@ROUTER.text("🎮 O'ynash")
 def private_play(msg):
     play_text = (
         "🎮 *O'YIN BOSHLASH UCHUN:*\n\n"
@@ -2450,11 +4864,11 @@ def private_play(msg):
     
     safe_api(bot.send_message, msg.from_user.id, play_text, reply_markup=kb)
 
-@bot.message_handler(func=lambda m: m.chat.type == "private" and m.text == "👤 Mening profilim")
+@ROUTER.text("👤 Mening profilim")
 def private_profile(msg):
     cmd_profile(msg)
 
-@bot.message_handler(func=lambda m: m.chat.type == "private" and m.text == "💎 Olmoslar")
+@ROUTER.text("💎 Olmoslar")
 def diamonds_menu(msg):
     uid = msg.from_user.id
     prof = ensure_profile(uid, get_username_obj(msg.from_user))
@@ -2477,7 +4891,7 @@ def diamonds_menu(msg):
     
     safe_api(bot.send_message, uid, diamond_text, reply_markup=kb)
 
-@bot.message_handler(func=lambda m: m.chat.type == "private" and m.text == "ℹ️ Yordam")
+@ROUTER.text("ℹ️ Yordam")
 def private_help_button(msg):
     help_text = (
         "❓ *TRUE MAFIA — YORDAM*\n\n"
@@ -2503,7 +4917,7 @@ def private_help_button(msg):
     
     safe_api(bot.send_message, msg.from_user.id, help_text)
 
-@bot.message_handler(func=lambda m: m.chat.type == "private" and m.text == "🏠 Bosh menyu")
+@ROUTER.text("🏠 Bosh menyu")
 def back_to_main(msg):
     main_text = "🏠 *BOSH MENYU*\n\nKerakli bo'limni tanlang:"
     
@@ -2515,6 +4929,7 @@ def back_to_main(msg):
 
 # ============================ BOSHQA KOMANDALAR ============================
 @bot.message_handler(commands=['endgame'])
+@in_chat_actor(chat_of_message)
 def endgame_cmd(message):
     if message.chat.type not in ("group", "supergroup"):
         safe_send_and_reply(message.chat.id, message.message_id, "⚠️ Bu buyruq faqat guruhlar uchun!")
@@ -2523,8 +4938,7 @@ def endgame_cmd(message):
     chat_id = message.chat.id
     key = cid_str(chat_id)
     
-    with LOCK:
-        game = games.get(key)
+    game = games.get(key)
     
     if not game or game.get("state") != "started":
         safe_send_and_reply(message.chat.id, message.message_id, "⚠️ Faol o'yin yo'q!")
@@ -2539,24 +4953,45 @@ def endgame_cmd(message):
 
 # ============================ BOSHLANG'ICH YUKLASH ============================
 def startup_restore() -> None:
+    """Snapshot + jurnaldan tiklangan o'yinlarni davom ettirish (taymerlarni qayta qo'yish)"""
     ensure_data_dir()
-    changed = False
-    with LOCK:
-        for cid, g in list(games.items()):
-            if g.get("state") == "started":
-                try:
-                    safe_send_message(int(cid), 
-                            "⚠️ *BOT QAYTA ISHGA TUSHDI!*\n\nO'yin to'xtatildi. Yangi o'yin boshlang! 🔄")
-                except Exception:
-                    pass
-                g["state"] = "waiting"
-                g["phase"] = None
-                g["phase_start_time"] = None
-                changed = True
-        if changed:
-            persist_games()
+    now = int(time.time())
+    with GAMES_LOCK:
+        restored = [(cid, dict(g)) for cid, g in games.items()]
+    
+    for cid, g in restored:
+        chat_id = int(cid)
+        state = g.get("state")
+        phase = g.get("phase")
+        
+        if state == "waiting":
+            started = g.get("registration_started_at")
+            if started:
+                remaining = REGISTRATION_TIMEOUT - (now - started)
+                start_registration_timer(chat_id, max(remaining, RESUME_GRACE))
+            continue
+        
+        if state != "started":
+            continue
+        
+        if phase == "day":
+            timeout, callback = DAY_TIMEOUT, day_timeout
+        else:
+            timeout, callback = NIGHT_TIMEOUT, night_timeout
+        elapsed = now - (g.get("phase_start_time") or now)
+        start_phase_timer(chat_id, max(timeout - elapsed, RESUME_GRACE), callback)
+        
+        OUTBOX.send(chat_id, "♻️ *BOT QAYTA ISHGA TUSHDI!*\n\nO'yin to'xtagan joyidan davom etmoqda! 🎭",
+                    priority=PRIORITY_CRITICAL)
+        logger.info("O'yin tiklandi: %s (%s)", cid, phase)
+    
+    BROADCASTER.resume()
+
+# Servis buyruqlari (python Mafia123.py <buyruq>) botni ishga tushirmaydi
+CLI_ARGS = sys.argv[1:] if __name__ == "__main__" else []
 
-startup_restore()
+if not CLI_ARGS:
+    startup_restore()
 
 # ============================ WEBHOOK APPY ============================
 from flask import Flask, request
@@ -2572,16 +5007,56 @@ def home():
     <p>Bog'lanish: @True_mafia_kawai_bot</p>
     """
 
+class UpdateDispatcher(KeyedWorkerPool):
+    """Kiruvchi update'lar pool'i: bitta chat (yoki foydalanuvchi) update'lari tartib bilan"""
+
+    @staticmethod
+    def order_key(update: types.Update) -> Any:
+        for obj in (update.message, update.edited_message, update.my_chat_member, update.chat_member):
+            if obj is not None:
+                return obj.chat.id
+        call = update.callback_query
+        if call is not None:
+            return call.message.chat.id if call.message else call.from_user.id
+        return ("update", update.update_id)
+
+    def submit_update(self, update: types.Update, block: bool = False) -> bool:
+        return self.submit(self.order_key(update), update, block=block)
+
+    def _execute(self, key, update) -> None:
+        bot.handle_updates([update])
+
+UPDATES = UpdateDispatcher("updates", UPDATE_WORKERS, UPDATE_QUEUE_LIMIT, UPDATE_CHAT_QUEUE_LIMIT)
+atexit.register(UPDATES.drain, 5)  # OUTBOX'dan oldin: handlerlar yana xabar qo'yishi mumkin
+
 # Webhook endpoint
 @app.route('/' + TOKEN, methods=['POST'])
 def webhook():
     if request.headers.get('content-type') == 'application/json':
         json_string = request.get_data().decode('utf-8')
         update = types.Update.de_json(json_string)
-        bot.process_new_updates([update])
+        # Darhol javob beriladi; navbat to'lgan bo'lsa Telegram keyinroq qayta yuboradi
+        if not UPDATES.submit_update(update):
+            logger.warning("Update navbati to'la, %s qaytarildi", update.update_id)
+            return '', 503
         return ''
     return ''
 
+# Monitoring uchun hisoblagichlar (JSON)
+@app.route('/metrics')
+def metrics():
+    return {
+        "api_errors": api_error_stats(),
+        "http": HTTP.stats(),
+        "outbox": OUTBOX.stats(),
+        "updates": UPDATES.stats(),
+        "chats": ACTORS.stats(),
+        "timers": SCHEDULER.stats(),
+        "active_games": active_games_count(),
+        "broadcast": BROADCASTER.stats(),
+        "dispatch": ROUTER.stats(),
+    }
+
 # Webhookni o'rnatish
 @app.route('/setwebhook')
 def set_webhook():
@@ -2590,7 +5065,295 @@ def set_webhook():
     bot.set_webhook(url=webhook_url)
     return f"✅ Webhook o'rnatildi!<br>URL: {webhook_url}"
 
+# ============================ SERVIS BUYRUQLARI ============================
+def benchmark_storage(n_profiles: int = 100_000, n_history: int = 1_000_000, ops: int = 200) -> None:
+    """JSON va SQLite backendlarni solishtirish (vaqtinchalik papkada)"""
+    template = {
+        "name": "bench", "money": 0, "diamonds": 0, "doctor_save_used": False,
+        "guaranteed_active_role": False, "protection_active": False, "games_played": 0, "wins": 0,
+    }
+    players = list(range(1, 9))
+    roles = {str(p): "👨🏼 Мирный житель" for p in players}
+
+    def hist_record(i: int) -> Dict[str, Any]:
+        return {"chat_id": -1001234567890, "finished_at": i, "winner": "Мафия", "players": players, "roles": roles}
+
+    print(f"profiles={n_profiles} history={n_history} ops={ops}")
+    print(f"{'backend':<8} {'load profiles':>14} {'profile write':>14} {'history append':>15} {'history tail':>13}")
+    for backend in ("json", "sqlite"):
+        with tempfile.TemporaryDirectory() as tmp:
+            storage = JsonStorage(tmp) if backend == "json" else SqliteStorage(os.path.join(tmp, "mafia.db"))
+            data = {str(i): dict(template) for i in range(n_profiles)}
+            storage.snapshot("profiles", {k: dump_record(v) for k, v in data.items()})
+            storage.append_history([hist_record(i) for i in range(n_history)])
+
+            t0 = time.perf_counter()
+            storage.load("profiles")
+            load_s = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            for i in range(ops):
+                key = str(i % n_profiles)
+                data[key]["money"] += 1
+                storage.write("profiles", {key: dump_record(data[key])})
+            write_ms = (time.perf_counter() - t0) / ops * 1000
+
+            t0 = time.perf_counter()
+            for i in range(ops):
+                storage.append_history([hist_record(n_history + i)])
+            hist_ms = (time.perf_counter() - t0) / ops * 1000
+
+            t0 = time.perf_counter()
+            storage.load_history(HISTORY_TAIL)
+            tail_ms = (time.perf_counter() - t0) * 1000
+
+            if backend == "sqlite":
+                storage.conn.close()
+        print(f"{backend:<8} {load_s:>12.2f} s {write_ms:>11.3f} ms {hist_ms:>12.3f} ms {tail_ms:>10.3f} ms")
+
+class FakeApiResponse:
+    """Servis buyruqlari uchun Telegram javobi (tarmoqqa chiqmasdan)"""
+
+    status_code = 200
+    reason = "OK"
+
+    def __init__(self, payload: Dict[str, Any]) -> None:
+        self.payload = payload
+        self.text = json.dumps(payload)
+
+    def json(self) -> Dict[str, Any]:
+        return self.payload
+
+def fake_api_result(url: str, params: Optional[Dict[str, Any]], message_ids) -> Any:
+    if url.endswith("sendMessage"):
+        chat_id = int((params or {}).get("chat_id", 0))
+        return {"message_id": next(message_ids), "date": 0,
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}}
+    return True
+
+def fake_api_sender(latency_ms: float):
+    message_ids = itertools.count(1)
+
+    def send(method, url, params=None, files=None, timeout=None, proxies=None, **kwargs):
+        time.sleep(latency_ms / 1000)
+        return FakeApiResponse({"ok": True, "result": fake_api_result(url, params, message_ids)})
+    return send
+
+def fake_async_request(latency_ms: float):
+    """asyncio rejimi uchun asyncio_helper._process_request o'rnini bosuvchi"""
+    message_ids = itertools.count(1)
+
+    async def process(token, url, method="get", params=None, files=None, **kwargs):
+        await asyncio.sleep(latency_ms / 1000)
+        return fake_api_result(url, params, message_ids)
+    return process
+
+def bench_engine(n_games: int = 2000, latency_ms: float = 50, players: int = 6) -> None:
+    """Joriy ENGINE da n_games ta o'yinning taymerlari va DM fan-out'ini o'lchash (soxta API bilan).
+
+    Har bir o'yin 1 soniya ichida tasodifiy paytda taymer qo'yadi; taymer
+    guruhga xabar va har bir o'yinchiga DM navbatga qo'yadi.
+    """
+    if EVENT_LOOP:
+        from telebot import asyncio_helper
+        saved = ("async", asyncio_helper._process_request)
+        asyncio_helper._process_request = fake_async_request(latency_ms)
+    else:
+        saved = ("sync", apihelper.CUSTOM_REQUEST_SENDER)
+        apihelper.CUSTOM_REQUEST_SENDER = fake_api_sender(latency_ms)
+    fired = threading.Semaphore(0)
+
+    def phase(chat_id: int) -> None:
+        OUTBOX.send(chat_id, "bench", track=False)
+        for p in range(players):
+            OUTBOX.send(chat_id * 100 + p + 1, "bench", track=False)
+        fired.release()
+
+    try:
+        t0 = time.perf_counter()
+        for g in range(n_games):
+            SCHEDULER.call_later(random.random(), functools.partial(phase, g + 1))
+        for _ in range(n_games):
+            fired.acquire()
+        OUTBOX.drain()
+        elapsed = time.perf_counter() - t0
+    finally:
+        if saved[0] == "async":
+            asyncio_helper._process_request = saved[1]
+        else:
+            apihelper.CUSTOM_REQUEST_SENDER = saved[1]
+    sends = n_games * (players + 1)
+    sched, outbox = SCHEDULER.stats(), OUTBOX.stats()
+    print(f"engine={ENGINE} games={n_games} sends={sends} api={latency_ms}ms")
+    print(f"  vaqt {elapsed:.2f}s, {sends / elapsed:.0f} xabar/s, oqimlar {threading.active_count()}")
+    print(f"  taymer kechikishi {sched['late_avg_ms']:.1f} / {sched['late_max_ms']:.1f} ms, "
+          f"navbat kutishi {outbox['wait_avg_ms']:.1f} / {outbox['wait_max_ms']:.1f} ms")
+
+def stress_locks(max_groups: int = 16, threads_per_group: int = 4, ops: int = 100,
+                 hold_ms: float = 5, latency_ms: float = 20) -> bool:
+    """Per-chat lock'lar yuklama testi (soxta Telegram API va vaqtinchalik papka bilan).
+
+    Har bir guruhda threads_per_group ta oqim ops tadan ovoz beradi: chat_lock
+    ostida hold_ms ish + ovoz tugmasi ROUTER orqali (API kechikishi latency_ms) + PROFILE_LOCK
+    ostida umumiy hisoblagich. Mustaqil guruhlar bir-birini kutmagani uchun
+    ops/s guruhlar soniga qarab deyarli chiziqli o'sishi kerak (bitta global
+    lock bilan u o'zgarmas edi); yuqori chegara - CHAT_WORKERS. Oxirida yo'qolgan yangilanishlar va deadlock
+    tekshiriladi.
+    """
+    global STORAGE
+    saved_storage, saved_sender = STORAGE, apihelper.CUSTOM_REQUEST_SENDER
+    ok = True
+    with tempfile.TemporaryDirectory() as tmp:
+        STORAGE = JsonStorage(tmp)
+        apihelper.CUSTOM_REQUEST_SENDER = fake_api_sender(latency_ms)
+        print(f"threads/group={threads_per_group} ops/thread={ops} hold={hold_ms}ms api={latency_ms}ms")
+        print(f"{'groups':>6} {'threads':>8} {'ops/s':>10} {'speedup':>8}")
+        base = None
+        groups = 1
+        try:
+            while groups <= max_groups:
+                chats = [-1009000000000 - g for g in range(groups)]
+                counter = f"stress:{groups}"
+                with PROFILE_LOCK:
+                    profiles[counter] = {"name": counter, "money": 0}
+                for g, chat_id in enumerate(chats):
+                    players = [1_000_000 + g * 100 + i for i in range(threads_per_group + 1)]
+                    register_game(cid_str(chat_id), {
+                        "state": "started", "phase": "day", "players": players, "alive": list(players),
+                        "roles": {}, "votes": {}, "bot_messages": [],
+                    })
+
+                def worker(chat_id: int, voter: int, target: int) -> None:
+                    with chat_lock(chat_id):
+                        data = button_data(button_stamp(games[cid_str(chat_id)]), "vote", target)
+                    for i in range(ops):
+                        call = types.CallbackQuery.de_json({
+                            "id": f"{voter}-{i}", "chat_instance": "stress", "data": data,
+                            "from": {"id": voter, "is_bot": False, "first_name": "stress"},
+                            "message": {"message_id": 1, "date": 0, "text": "vote",
+                                        "chat": {"id": chat_id, "type": "supergroup", "title": "stress"}},
+                        })
+                        with chat_lock(chat_id):
+                            time.sleep(hold_ms / 1000)
+                        ROUTER.dispatch_callback(call)
+                        with PROFILE_LOCK:
+                            profiles[counter]["money"] += 1
+
+                threads = []
+                for g, chat_id in enumerate(chats):
+                    players = games[cid_str(chat_id)]["players"]
+                    for t in range(threads_per_group):
+                        threads.append(threading.Thread(target=worker, args=(chat_id, players[t], players[-1]), daemon=True))
+                t0 = time.perf_counter()
+                for th in threads:
+                    th.start()
+                deadline = time.monotonic() + 120
+                for th in threads:
+                    th.join(max(deadline - time.monotonic(), 0))
+                # vote_handler o'yin mailbox'iga qo'yiladi - ular ham bajarilishini kutish
+                drained = ACTORS.drain(max(deadline - time.monotonic(), 0))
+                elapsed = time.perf_counter() - t0
+                if not drained or any(th.is_alive() for th in threads):
+                    print(f"{groups:>6} DEADLOCK: oqimlar 120 soniyada tugamadi")
+                    return False
+
+                total = len(threads) * ops
+                rate = total / elapsed
+                base = base or rate
+                print(f"{groups:>6} {len(threads):>8} {rate:>10.0f} {rate / base:>7.1f}x")
+                # Yo'qolgan yangilanishlar yo'qligini tekshirish
+                with PROFILE_LOCK:
+                    lost = total - profiles.pop(counter)["money"]
+                for chat_id in chats:
+                    game = unregister_game(cid_str(chat_id))
+                    if len(game["votes"]) != threads_per_group:
+                        print(f"  xato: {chat_id} ovozlari {len(game['votes'])} ta")
+                        ok = False
+                if lost:
+                    print(f"  xato: {lost} ta profil yangilanishi yo'qoldi")
+                    ok = False
+                groups *= 2
+        finally:
+            OUTBOX.drain(60)
+            flush_dirty()
+            STORAGE, apihelper.CUSTOM_REQUEST_SENDER = saved_storage, saved_sender
+    print("OK" if ok else "XATO")
+    return ok
+
+def bench_dispatch(max_routes: int = 1000, n: int = 200_000) -> None:
+    """Router (lug'at) va telebot uslubidagi filtrlar ro'yxatini handlerlar soniga qarab solishtirish"""
+    class Call:
+        __slots__ = ("data", "route")
+
+        def __init__(self, data: str) -> None:
+            self.data = data
+
+    def noop(call) -> None:
+        pass
+
+    sizes = [10]
+    while sizes[-1] * 10 <= max_routes:
+        sizes.append(sizes[-1] * 10)
+    for size in sizes:
+        router = Router()
+        filters = []
+        for i in range(size):
+            router.callback(f"r{i}")(noop)
+            filters.append((lambda c, prefix=f"r{i}:": c.data and c.data.startswith(prefix), noop))
+        calls = [Call(f"r{random.randrange(size)}:{j}") for j in range(1000)]
+        rounds = max(n // len(calls), 1)
+
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            for call in calls:
+                router.dispatch_callback(call)
+        routed = (time.perf_counter() - t0) / (rounds * len(calls))
+
+        t0 = time.perf_counter()
+        for _ in range(rounds):
+            for call in calls:
+                for check, fn in filters:
+                    if check(call):
+                        fn(call)
+                        break
+        scanned = (time.perf_counter() - t0) / (rounds * len(calls))
+        print(f"handlerlar={size:>5}: lug'at {routed * 1e9:8.0f} ns, filtrlar {scanned * 1e9:10.0f} ns")
+
+def run_cli(args: List[str]) -> int:
+    cmd = args[0]
+    if cmd == "migrate-sqlite":
+        path = args[1] if len(args) > 1 else SQLITE_FILE
+        print(migrate_json_to_sqlite(path))
+        return 0
+    if cmd == "history-stats":
+        # Oxirgi N kun (yoki butun tarix) bo'yicha statistikani segmentlardan hisoblash
+        since = int(time.time()) - int(args[1]) * 86400 if len(args) > 1 else None
+        print(json.dumps(build_history_stats(iter_history(since)), ensure_ascii=False, indent=2))
+        return 0
+    if cmd == "stress-locks":
+        nums = [float(a) if i >= 3 else int(a) for i, a in enumerate(args[1:6])]
+        return 0 if stress_locks(*nums) else 1
+    if cmd == "bench-engine":
+        nums = [float(a) if i == 1 else int(a) for i, a in enumerate(args[1:4])]
+        bench_engine(*nums)
+        return 0
+    if cmd == "bench-dispatch":
+        bench_dispatch(*[int(a) for a in args[1:3]])
+        return 0
+    if cmd == "bench-storage":
+        nums = [int(a) for a in args[1:4]]
+        benchmark_storage(*nums)
+        return 0
+    print("Buyruqlar: migrate-sqlite [db_path] | history-stats [days] | bench-storage [profiles] [history] [ops]\n"
+          "          stress-locks [groups] [threads] [ops] [hold_ms] [api_ms]\n"
+          "          bench-engine [games] [api_ms] [players]  (MAFIA_ENGINE=asyncio bilan solishtiring)\n"
+          "          bench-dispatch [max_routes] [n]")
+    return 2
+
 # ============================ ISHGA TUSHIRISH ============================
+if __name__ == "__main__" and CLI_ARGS:
+    sys.exit(run_cli(CLI_ARGS))
+
 if __name__ == "__main__":
     print("🎭 True Mafia Bot ishga tushdi...")
     print("🤖 O'zbekcha versiya")
@@ -2600,6 +5363,7 @@ if __name__ == "__main__":
     print("👴 Yangi rol: Daydi - ovoz berishda maxsus kuch")
     print("🧹 Faqat bot xabarlarini tozalash faol")
     print("🤖 Obuna tekshirish faol")
+    print(f"⚙️ Ishlash rejimi: {ENGINE}")
     
     if TOKEN == "REPLACE_ME" or not BOT_USERNAME:
         logger.error("⚠️ MAFIA_BOT_TOKEN va MAFIA_BOT_USERNAME o'rnating!")